@@ -46,19 +46,13 @@ def evaluate_model_on_ablations(
         # find test accuracy
         with t.no_grad():
             for base_input_lists in tqdm(dataloader, desc=f"Ablations on {hook_point}"):
-                base_input: tuple[Tensor, Tensor, Tensor] = (x.to(DEVICE) for x in base_input_lists) # type: ignore
+                base_input: tuple[Tensor, Tensor, Tensor] = tuple(x.to(DEVICE) for x in base_input_lists) # type: ignore
                 for hl_node, ll_nodes in model_pair.corr.items():
                     if isinstance(test_set, ImagePVRDataset):
-                        ablated_input_pre = test_set.patch_batch_at_hl(
-                            list(base_input),
-                            list(base_input_lists),
-                            hl_node,
+                        # input, label, intermediate_data
+                        ablated_input = test_set.patch_batch_tensors_at_hl(
+                            base_input[0], base_input[2], hl_node
                         )
-                        ablated_input = (
-                            t.stack(ablated_input_pre[0]).to(DEVICE),  # input
-                            t.stack(ablated_input_pre[1]).to(DEVICE),  # label
-                            t.stack(ablated_input_pre[2]).to(DEVICE),
-                        )  # intermediate_data
                     else:
                         raise ValueError(f"patch_batch_at_hl not implemented for this dataset type: {type(test_set)}")
                     
@@ -8,7 +8,9 @@ import torch as t
 from tqdm import tqdm
 from iit.utils.plotter import plot_probe_stats
 from iit.utils.iit_dataset import IITDataset
+from iit.utils.activation_store import ActivationStore
 import os
+from typing import Optional
 import wandb
 from datetime import datetime
 
@@ -22,7 +24,12 @@ def evaluate_model_on_probes(
     use_wandb: bool = False,
     verbose: bool = False,
     save_probes: bool = False,
+    activation_store_dir: Optional[str] = None,
 ) -> dict:
+    """
+    With activation_store_dir, the activations of ll_model at every hook point are stored there
+    once per dataset and shared by the probes of all hook points.
+    """
     print("reached evaluate_model!")
     probe_stats_per_layer = {}
     log_stats_per_layer = {}
@@ -33,6 +40,19 @@ def evaluate_model_on_probes(
         # add training args to wandb config
         wandb.config.update(probe_training_args)
 
+    train_store, test_store = None, None
+    if activation_store_dir is not None:
+        train_store, test_store = (
+            ActivationStore.load_or_build(
+                ll_model,
+                dataset,
+                os.path.join(activation_store_dir, split),
+                get_hook_points(ll_model),
+                batch_size=probe_training_args["batch_size"],
+            )
+            for split, dataset in [("train", train_set), ("test", test_set)]
+        )
+
     for hook_point in tqdm(get_hook_points(ll_model), desc="Hook points"):
         _, hl_model, corr = get_alignment(
             task,
@@ -50,7 +70,7 @@ def evaluate_model_on_probes(
 
         input_shape = train_set.get_input_shape() # type: ignore
         trainer_out = train_probes_on_model_pair(
-            model_pair, input_shape, train_set, probe_training_args
+            model_pair, input_shape, train_set, probe_training_args, activation_store=train_store
         )
         # get everything but probes from trainer_out
         log_stats_per_layer[hook_point] = {
@@ -70,7 +90,7 @@ def evaluate_model_on_probes(
 
         # find test accuracy
         evals_out = evaluate_probe(
-            trainer_out["probes"], model_pair, test_set, nn.CrossEntropyLoss()
+            trainer_out["probes"], model_pair, test_set, nn.CrossEntropyLoss(), activation_store=test_store
         )
         if verbose:
             print(f"hook_point: {hook_point}")
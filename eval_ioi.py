@@ -44,6 +44,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--use-wandb", action="store_true", help="Use wandb for logging"
     )
+    parser.add_argument(
+        "--compact-vocab", action="store_true", help="Model was trained with a compact vocabulary"
+    )
 
     args = parser.parse_args()
     namespace = IOIArgParseNamespace(**vars(args))
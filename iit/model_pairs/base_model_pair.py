@@ -1,5 +1,8 @@
+import hashlib
+import json
+import os
 from abc import ABC, abstractmethod
-from typing import Any, Callable, final, Optional
+from typing import Any, Callable, final, Iterable, Optional
 
 import numpy as np
 import torch as t
@@ -11,11 +14,16 @@ from transformer_lens.hook_points import HookedRootModule, HookPoint # type: ign
 
 import wandb # type: ignore
 from iit.model_pairs.ll_model import LLModel
+from iit.tasks.hl_model import HLModel
+import iit.utils.activation_stats as activation_stats
+import iit.utils.node_picker as node_picker
 from iit.utils.nodes import HLNode, LLNode
 from iit.utils.correspondence import Correspondence
 from iit.utils.iit_dataset import IITDataset
 from iit.utils.index import Ix, TorchIndex
+from iit.utils.intervention_planner import InterventionPlanner
 from iit.utils.metric import MetricStoreCollection, MetricType
+from iit.utils.subspace import patch_subspace
 from iit.utils.tqdm import tqdm
 
 
@@ -30,7 +38,9 @@ class BaseModelPair(ABC):
     wandb_method: str
     rng: np.random.Generator
     dataset_class: 'IITDataset'
+    intervention_planner: InterventionPlanner
     stopping_epoch: int | None = None
+    hl_targets: dict[str, Tensor] | None = None # precomputed hl outputs of the current batch
 
     ##########################################
     # Abstract methods you need to implement #
@@ -50,6 +60,10 @@ class BaseModelPair(ABC):
     def make_test_metrics() -> MetricStoreCollection:
         pass
 
+    def make_eval_metrics(self) -> MetricStoreCollection:
+        """Metrics filled by run_eval_step: make_test_metrics plus any that depend on this model pair."""
+        return self.make_test_metrics()
+
     @abstractmethod
     def run_train_step(
         self,
@@ -82,28 +96,104 @@ class BaseModelPair(ABC):
         ablation_x, ablation_y = ablation_input[0:2]
         base_x, base_y = base_input[0:2]
 
-        hl_ablation_output, self.hl_cache = self.hl_model.run_with_cache(ablation_input)
-        ll_ablation_output, self.ll_cache = self.ll_model.run_with_cache(ablation_x)
         ll_nodes = self.corr[hl_node]
-
-        hl_output = self.hl_model.run_with_hooks(
-            base_input, fwd_hooks=[(hl_node.name, self.make_hl_ablation_hook(hl_node))]
+        # only cache the hooks that are read back by the ablation hooks
+        ll_ablation_output, self.ll_cache = self.ll_model.run_with_cache(
+            ablation_x, names_filter=node_picker.get_hook_names(ll_nodes)
         )
+
+        hl_output = self.get_hl_intervention_output(base_input, ablation_input, hl_node)
         ll_output = self.ll_model.run_with_hooks(
-            base_x,
-            fwd_hooks=[
-                (ll_node.name, self.make_ll_ablation_hook(ll_node))
-                for ll_node in ll_nodes
-            ],
+            base_x, fwd_hooks=self.make_ll_ablation_hooks(ll_nodes)
         )
 
         if verbose:
             print(f"{base_x=}, {base_y.item()=}")
-            print(f"{hl_ablation_output=}, {ll_ablation_output.shape=}")
+            print(f"{ll_ablation_output.shape=}")
             print(f"{hl_node=}, {ll_nodes=}")
             print(f"{hl_output=}")
         return hl_output, ll_output
 
+    def do_batched_intervention(
+        self,
+        base_input: tuple[Tensor, Tensor, Tensor],
+        ablation_input: tuple[Tensor, Tensor, Tensor],
+        hl_nodes: list[HLNode],
+    ) -> tuple[Tensor, Tensor]:
+        """
+        Runs the interventions for all hl_nodes with one hl and one ll hooked forward pass.
+        The base batch is tiled once per node and replica i is only patched at hl_nodes[i].
+        Returns hl and ll outputs of shape (len(hl_nodes) * batch, ...), grouped by node.
+        """
+        ablation_x = ablation_input[0]
+        base_x = base_input[0]
+        batch_size = base_x.shape[0]
+        num_replicas = len(hl_nodes)
+
+        replica_nodes = [list(self.corr[hl_node]) for hl_node in hl_nodes]
+        _, self.ll_cache = self.ll_model.run_with_cache(
+            ablation_x, names_filter=node_picker.get_hook_names(node for nodes in replica_nodes for node in nodes)
+        )
+
+        if self.hl_targets is not None:
+            hl_output = t.cat([self.hl_targets[hl_node.name] for hl_node in hl_nodes])
+        else:
+            _, self.hl_cache = self.hl_model.run_with_cache(
+                ablation_input, names_filter=[hl_node.name for hl_node in hl_nodes]
+            )
+            hl_output = self.hl_model.run_with_hooks(
+                self.tile_input(base_input, num_replicas),
+                fwd_hooks=[
+                    (hl_node.name, self.make_hl_replica_ablation_hook([(replica, hl_node)], batch_size))
+                    for replica, hl_node in enumerate(hl_nodes)
+                ],
+            )
+        ll_output = self.ll_model.run_with_hooks(
+            self.tile_input((base_x,), num_replicas)[0],
+            fwd_hooks=self.make_ll_replica_ablation_hooks(replica_nodes, batch_size),
+        )
+        return hl_output, ll_output
+
+    @staticmethod
+    def tile_input(input: tuple, num_replicas: int) -> tuple:
+        """
+        Repeats every tensor in input num_replicas times along the batch dimension.
+        """
+        return tuple(
+            x.repeat(num_replicas, *([1] * (x.dim() - 1))) if isinstance(x, Tensor) else x
+            for x in input
+        )
+
+    def uses_dual_batch_hl(self) -> bool:
+        return (
+            self.training_args["use_dual_batch_hl"]
+            and isinstance(self.hl_model, HLModel)
+            and self.hl_model.supports_dual_batch_intervention()
+        )
+
+    def get_hl_intervention_output(
+        self,
+        base_input: tuple[Tensor, Tensor, Tensor],
+        ablation_input: tuple[Tensor, Tensor, Tensor],
+        hl_node: HLNode,
+    ) -> Tensor:
+        """
+        Returns the hl_model output on base_input with hl_node patched from ablation_input.
+        Symbolic hl models do this in a single forward pass over both batches.
+        If the batch came with precomputed hl targets, these are returned instead.
+        """
+        if self.hl_targets is not None:
+            return self.hl_targets[hl_node.name]
+        if self.uses_dual_batch_hl():
+            assert isinstance(self.hl_model, HLModel)
+            return self.hl_model.run_dual_batch_intervention(base_input, ablation_input, hl_node)
+        _, self.hl_cache = self.hl_model.run_with_cache(
+            ablation_input, names_filter=[hl_node.name]
+        )
+        return self.hl_model.run_with_hooks(
+            base_input, fwd_hooks=[(hl_node.name, self.make_hl_ablation_hook(hl_node))]
+        )
+
     @staticmethod
     def get_label_idxs() -> TorchIndex:
         '''
@@ -115,6 +205,13 @@ class BaseModelPair(ABC):
     def set_corr(self, corr: Correspondence) -> None:
         self.corr = corr
 
+    def get_node_granularity(self) -> dict[str, Optional[int]]:
+        """Keyword arguments of node_picker.get_all_nodes setting how finely ll nodes are split."""
+        return {
+            "head_dims_per_node": self.training_args.get("head_dims_per_node"),
+            "mlp_neurons_per_node": self.training_args.get("mlp_neurons_per_node"),
+        }
+
     def sample_hl_name(self) -> HLNode:
         return self.rng.choice(np.array(list(self.corr.keys())))
 
@@ -150,13 +247,48 @@ class BaseModelPair(ABC):
         out = self.hl_cache[hook.name]
         return out
 
-    # TODO extend to position and subspace...
+    def make_hl_replica_ablation_hook(
+        self, replicas: list[tuple[int, HLNode]], batch_size: int
+    ) -> Callable[[Tensor, HookPoint], Tensor]:
+        """
+        Hook for a tiled base batch: rows of replica i are patched at its node from self.hl_cache.
+        """
+        def hl_replica_ablation_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
+            out = hook_point_out.clone()
+            for replica, hl_node in replicas:
+                index = hl_node.index if hl_node.index is not None else Ix[[None]]
+                rows = out[replica * batch_size : (replica + 1) * batch_size]
+                rows[index.as_index] = self.hl_cache[hook.name][index.as_index]
+            return out
+
+        return hl_replica_ablation_hook
+
+    def make_ll_replica_ablation_hooks(
+        self, replica_nodes: list[list[LLNode]], batch_size: int
+    ) -> list[tuple[str, Callable[[Tensor, HookPoint], Tensor]]]:
+        """
+        Hooks for a tiled base batch: rows of replica i are patched at replica_nodes[i] from
+        self.ll_cache, with one hook (and one torch.where) per hook point.
+        See InterventionPlanner.make_replica_patch_hooks.
+        """
+        return self.intervention_planner.make_replica_patch_hooks(
+            replica_nodes, batch_size, lambda hook_name: self.ll_cache[hook_name]
+        )
+
+    @staticmethod
+    def get_ll_patch(ll_node: LLNode, base: Tensor, source: Tensor) -> Tensor:
+        """
+        Returns the patched values of ll_node: the source values, or
+        base + P(source - base) if the node has a subspace.
+        """
+        if ll_node.subspace is None:
+            return source
+        return patch_subspace(base, source, ll_node.subspace)
+
+    # TODO extend to position...
     def make_ll_ablation_hook(
         self, ll_node: LLNode
     ) -> Callable[[Tensor, HookPoint], Tensor]:
-        if ll_node.subspace is not None:
-            raise NotImplementedError
-
         def ll_ablation_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
             # This works because out is being used in a computation that autograd can track later on
             # So the clone is still connected to the original tensor's computation graph
@@ -164,11 +296,24 @@ class BaseModelPair(ABC):
             # see here: https://discuss.pytorch.org/t/why-is-the-clone-operation-part-of-the-computation-graph-is-it-even-differentiable/67054/4
             out = hook_point_out.clone()
             index = ll_node.index if ll_node.index is not None else Ix[[None]]
-            out[index.as_index] = self.ll_cache[hook.name][index.as_index]
+            out[index.as_index] = self.get_ll_patch(
+                ll_node, out[index.as_index], self.ll_cache[hook.name][index.as_index]
+            )
             return out
 
         return ll_ablation_hook
 
+    def make_ll_ablation_hooks(
+        self, ll_nodes: Iterable[LLNode]
+    ) -> list[tuple[str, Callable[[Tensor, HookPoint], Tensor]]]:
+        """
+        Returns one hook per hook point, patching the union of the ll_nodes on it
+        from self.ll_cache with a single precomputed mask.
+        """
+        return self.intervention_planner.make_patch_hooks(
+            ll_nodes, lambda hook_name: self.ll_cache[hook_name]
+        )
+
     def get_IIT_loss_over_batch(
         self,
         base_input: tuple[Tensor, Tensor, Tensor],
@@ -177,6 +322,14 @@ class BaseModelPair(ABC):
         loss_fn: Callable[[Tensor, Tensor], Tensor],
     ) -> Tensor:
         hl_output, ll_output = self.do_intervention(base_input, ablation_input, hl_node)
+        return self.get_IIT_loss_from_outputs(hl_output, ll_output, loss_fn)
+
+    def get_IIT_loss_from_outputs(
+        self,
+        hl_output: Tensor,
+        ll_output: Tensor,
+        loss_fn: Callable[[Tensor, Tensor], Tensor],
+    ) -> Tensor:
         label_idx = self.get_label_idxs()
         # IIT loss is only computed on the tokens we care about
         loss = loss_fn(ll_output[label_idx.as_index], hl_output[label_idx.as_index])
@@ -238,11 +391,18 @@ class BaseModelPair(ABC):
         #     "ll_model and hl_model are not on the same device"
         # )
 
+        if training_args["precompute_hl_targets"]:
+            self.precompute_hl_targets(train_set, "train")
+            self.precompute_hl_targets(test_set, "test")
+
         train_loader, test_loader = self.make_loaders(
             train_set,
             test_set,
             training_args["batch_size"],
             training_args["num_workers"],
+            pin_memory=training_args.get("pin_memory", True),
+            prefetch_factor=training_args.get("prefetch_factor", None),
+            persistent_workers=training_args.get("persistent_workers", False),
         )
 
         early_stop = training_args["early_stop"]
@@ -327,15 +487,73 @@ class BaseModelPair(ABC):
     # Immutable methods- might change later #
     #########################################
     @final
+    def precompute_hl_targets(self, dataset: IITDataset, split: str) -> None:
+        """
+        Precomputes the hl intervention outputs of every pair of dataset for every hl node,
+        so that training and evaluation on it never run the hl model.
+        Tables are saved to training_args["hl_targets_dir"] if it is set, under a key of the
+        pairs, the base and ablation data, the hl model and the hl nodes.
+        """
+        hl_nodes = list(self.corr.keys())
+        hl_node_names = [hl_node.name for hl_node in hl_nodes]
+        path = None
+        fingerprints = None
+        if self.training_args["hl_targets_dir"] is not None:
+            batch_size = self.training_args["batch_size"]
+            base_fingerprint = activation_stats.get_dataset_fingerprint(dataset.base_data, batch_size)
+            fingerprints = {
+                "base_data": base_fingerprint,
+                "ablation_data": (
+                    base_fingerprint
+                    if dataset.ablation_data is dataset.base_data
+                    else activation_stats.get_dataset_fingerprint(dataset.ablation_data, batch_size)
+                ),
+                "hl_model": type(self.hl_model).__qualname__,
+                "hl_weights": activation_stats.get_weights_fingerprint(self.hl_model),
+            }
+            metadata = dataset.get_hl_targets_metadata(hl_node_names, fingerprints)
+            digest = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()[:16]
+            os.makedirs(self.training_args["hl_targets_dir"], exist_ok=True)
+            path = os.path.join(self.training_args["hl_targets_dir"], f"{split}_hl_targets_{digest}.pt")
+
+        def get_targets(base_input: tuple, ablation_input: tuple) -> dict[str, Tensor]:
+            return {
+                hl_node.name: self.get_hl_intervention_output(base_input, ablation_input, hl_node)
+                for hl_node in hl_nodes
+            }
+
+        self.hl_targets = None
+        with t.no_grad():
+            dataset.precompute_hl_targets(
+                get_targets,
+                hl_node_names,
+                self.training_args["batch_size"],
+                path,
+                fingerprints,
+            )
+
     @staticmethod
     def make_loaders(
         dataset: IITDataset,
         test_dataset: IITDataset,
         batch_size : int,
         num_workers : int,
+        pin_memory: bool = True,
+        prefetch_factor: Optional[int] = None,
+        persistent_workers: bool = False,
     ) -> tuple[DataLoader, DataLoader]:
-        loader = dataset.make_loader(batch_size, num_workers)
-        test_loader = test_dataset.make_loader(batch_size, num_workers)
+        loader, test_loader = (
+            data.make_loader(
+                batch_size,
+                num_workers,
+                pin_memory=pin_memory,
+                prefetch_factor=prefetch_factor,
+                persistent_workers=persistent_workers,
+                fixed_pairs=fixed_pairs,
+            )
+            # the test set is scored on the same pairs every epoch
+            for data, fixed_pairs in ((dataset, False), (test_dataset, True))
+        )
         return loader, test_loader
 
     @final
@@ -348,11 +566,14 @@ class BaseModelPair(ABC):
         ) -> MetricStoreCollection:
         self.ll_model.train()
         train_metrics = self.make_train_metrics()
-        for i, (base_input, ablation_input) in enumerate(loader):
+        for i, batch in enumerate(loader):
+            base_input, ablation_input = batch[0:2]
+            self.hl_targets = batch[2] if len(batch) > 2 else None
             train_metrics.update(
                 self.run_train_step(base_input, ablation_input, loss_fn, optimizer)
             )
             pbar.update(1)
+        self.hl_targets = None
         return train_metrics
 
     @final
@@ -362,12 +583,15 @@ class BaseModelPair(ABC):
         loss_fn: Callable[[Tensor, Tensor], Tensor]
         ) -> MetricStoreCollection:
         self.ll_model.eval()
-        test_metrics = self.make_test_metrics()
+        test_metrics = self.make_eval_metrics()
         with t.no_grad():
-            for i, (base_input, ablation_input) in enumerate(loader):
+            for i, batch in enumerate(loader):
+                base_input, ablation_input = batch[0:2]
+                self.hl_targets = batch[2] if len(batch) > 2 else None
                 test_metrics.update(
                     self.run_eval_step(base_input, ablation_input, loss_fn)
                 )
+        self.hl_targets = None
         return test_metrics
 
     def _check_early_stop_condition(self, test_metrics: MetricStoreCollection) -> bool:
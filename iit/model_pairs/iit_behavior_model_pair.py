@@ -7,8 +7,8 @@ from transformer_lens.hook_points import HookedRootModule  # type: ignore
 from iit.model_pairs.iit_model_pair import IITModelPair
 from iit.model_pairs.ll_model import LLModel
 from iit.utils.correspondence import Correspondence
+import iit.utils.node_sweep as node_sweep
 from iit.utils.metric import MetricStore, MetricStoreCollection, MetricType
-from iit.utils.nodes import HLNode
 
 
 class IITBehaviorModelPair(IITModelPair):
@@ -25,11 +25,17 @@ class IITBehaviorModelPair(IITModelPair):
             "iit_weight": 1.0,
             "behavior_weight": 1.0,
             "val_IIA_sampling": "random",  # random or all
+            "val_IIA_node_parallel": True,  # if True, val_IIA_sampling="all" scores all nodes in one forward pass
+            "eval_node_chunk_size": None,  # max number of nodes tiled into one forward pass, None to fit eval_memory_budget
+            "eval_memory_budget": 2**30,  # bytes of activations per tiled forward pass, see ChunkSizer
             "use_all_tokens_for_behavior": False,  # if True, all tokens are used for behavior loss, else only the tokens in label_idxs
         }
         training_args = {**default_training_args, **training_args}
         super().__init__(hl_model, ll_model, corr=corr, training_args=training_args)
         self.wandb_method = "iit_and_behavior"
+        self.eval_chunk_sizer = node_sweep.ChunkSizer(
+            self.training_args["eval_node_chunk_size"], self.training_args["eval_memory_budget"]
+        )
 
     @staticmethod
     def make_train_metrics() -> MetricStoreCollection:
@@ -55,6 +61,11 @@ class IITBehaviorModelPair(IITModelPair):
     ) -> Tensor:
         base_x, base_y = base_input[0:2]
         output = self.ll_model(base_x)
+        return self.get_behaviour_loss_from_output(output, base_y, loss_fn)
+
+    def get_behaviour_loss_from_output(
+        self, output: Tensor, base_y: Tensor, loss_fn: Callable[[Tensor, Tensor], Tensor]
+    ) -> Tensor:
         label_indx = self.get_label_idxs()
         if not self.training_args["use_all_tokens_for_behavior"]:
             output = output[label_indx.as_index]
@@ -63,6 +74,14 @@ class IITBehaviorModelPair(IITModelPair):
         behaviour_loss = loss_fn(output, base_y)
         return behaviour_loss
 
+    def chunk_nodes(self, nodes: list, x: Tensor) -> list[list]:
+        """
+        Splits nodes into chunks of at most training_args["eval_node_chunk_size"] nodes, by default
+        as many as keep the activations of a forward on x tiled once per node within
+        training_args["eval_memory_budget"] bytes, bounding the tiled batch of the node-parallel evals.
+        """
+        return self.eval_chunk_sizer.chunk(self.ll_model, x, nodes)
+
     def step_on_loss(self, loss: Tensor, optimizer: t.optim.Optimizer) -> None:
         optimizer.zero_grad()
         loss.backward()  # type: ignore
@@ -113,8 +132,7 @@ class IITBehaviorModelPair(IITModelPair):
         # compute IIT loss and accuracy
         label_idx = self.get_label_idxs()
 
-        def get_node_IIT_info(hl_node: HLNode) -> tuple[float, Tensor]:
-            hl_output, ll_output = self.do_intervention(base_input, ablation_input, hl_node)
+        def get_IIT_info(hl_output: Tensor, ll_output: Tensor) -> tuple[float, Tensor]:
             hl_output = hl_output.to(ll_output.device)
             hl_output = hl_output[label_idx.as_index]
             ll_output = ll_output[label_idx.as_index]
@@ -133,14 +151,30 @@ class IITBehaviorModelPair(IITModelPair):
 
         if self.training_args["val_IIA_sampling"] == "random":
             hl_node = self.sample_hl_name()
-            IIA, loss = get_node_IIT_info(hl_node)
+            IIA, loss = get_IIT_info(*self.do_intervention(base_input, ablation_input, hl_node))
         elif self.training_args["val_IIA_sampling"] == "all":
             iias = []
             losses = []
-            for hl_node in self.corr.keys():
-                IIA, loss = get_node_IIT_info(hl_node)
-                iias.append(IIA)
-                losses.append(loss)
+            hl_nodes = list(self.corr.keys())
+            if self.training_args["val_IIA_node_parallel"]:
+                # score all nodes at once, on a batch tiled once per node
+                for node_chunk in self.chunk_nodes(hl_nodes, base_input[0]):
+                    hl_outputs, ll_outputs = self.do_batched_intervention(
+                        base_input, ablation_input, node_chunk
+                    )
+                    for hl_output, ll_output in zip(
+                        hl_outputs.chunk(len(node_chunk)), ll_outputs.chunk(len(node_chunk))
+                    ):
+                        IIA, loss = get_IIT_info(hl_output, ll_output)
+                        iias.append(IIA)
+                        losses.append(loss)
+            else:
+                for hl_node in hl_nodes:
+                    IIA, loss = get_IIT_info(
+                        *self.do_intervention(base_input, ablation_input, hl_node)
+                    )
+                    iias.append(IIA)
+                    losses.append(loss)
             IIA = sum(iias) / len(iias)
             loss = t.stack(losses).mean()
         else:
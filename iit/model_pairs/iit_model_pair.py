@@ -7,6 +7,7 @@ from transformer_lens.hook_points import HookedRootModule #type: ignore
 
 from iit.model_pairs.base_model_pair import BaseModelPair
 from iit.utils.correspondence import Correspondence
+from iit.utils.intervention_planner import InterventionPlanner
 from iit.utils.metric import MetricStore, MetricStoreCollection, MetricType
 from iit.model_pairs.ll_model import LLModel
 
@@ -23,10 +24,15 @@ class IITModelPair(BaseModelPair):
         self.hl_model.requires_grad_(False)
 
         self.corr = corr
+        self.intervention_planner = InterventionPlanner()
         assert all([str(k) in self.hl_model.hook_dict for k in self.corr.keys()])
         default_training_args = {
             "batch_size": 256,
             "num_workers": 0,
+            # only used with num_workers > 0
+            "pin_memory": True,
+            "prefetch_factor": 2,
+            "persistent_workers": True,
             "early_stop": True,
             "early_stop_accuracy_threshold": 99.5,
             "lr_scheduler": None,
@@ -37,6 +43,12 @@ class IITModelPair(BaseModelPair):
             "seed": 0,
             "lr": 0.001,
             "detach_while_caching": True,
+            "use_dual_batch_hl": True, # single-pass hl interventions for hl models that support it
+            "precompute_hl_targets": False, # deterministic hl models only
+            "hl_targets_dir": None,
+            # split heads and mlps into finer off-circuit nodes, see node_picker.get_all_nodes
+            "head_dims_per_node": None,
+            "mlp_neurons_per_node": None,
             "optimizer_cls": t.optim.Adam,
             "optimizer_kwargs" : {
                 "betas": (0.9, 0.9)
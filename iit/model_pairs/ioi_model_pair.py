@@ -9,8 +9,8 @@ from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
 from iit.model_pairs.ll_model import LLModel
 from iit.utils.correspondence import Correspondence
 from iit.utils.config import DEVICE
+from iit.utils.eval_metrics import get_label_ids
 from iit.utils.metric import MetricStore, MetricType, MetricStoreCollection, PerTokenMetricStore
-from iit.utils.nodes import HLNode
 import iit.utils.index as index
 
 
@@ -59,6 +59,7 @@ class IOI_ModelPair(StrictIITModelPair):
 
     @staticmethod
     def get_label_idxs() -> index.TorchIndex:
+        # prompts are left-padded or bucketed by length, so every sample's label is at its last position
         return index.Ix[:, -1]
 
     @staticmethod
@@ -73,18 +74,16 @@ class IOI_ModelPair(StrictIITModelPair):
             ]
         )
 
-    def get_IIT_loss_over_batch(
+    def get_IIT_loss_from_outputs(
         self,
-        base_input: tuple[Tensor, Tensor, Tensor],
-        ablation_input: tuple[Tensor, Tensor, Tensor],
-        hl_node: HLNode,
+        hl_output: Tensor,
+        ll_output: Tensor,
         loss_fn: Callable[[Tensor, Tensor], Tensor],
     ) -> Tensor:
-        hl_output, ll_output = self.do_intervention(base_input, ablation_input, hl_node)
         # hl_output = t.nn.functional.softmax(hl_output, dim=-1)
-        hl_argmax = t.argmax(hl_output[:, -1, :], dim=-1)
+        hl_label = get_label_ids(hl_output)[:, -1]
 
-        loss = loss_fn(ll_output[:, -1, :], hl_argmax)
+        loss = loss_fn(ll_output[:, -1, :], hl_label)
         return loss
 
     def run_eval_step(
@@ -96,18 +95,12 @@ class IOI_ModelPair(StrictIITModelPair):
         # compute IIT loss and accuracy on last token position only
         hl_node = self.sample_hl_name()
         hl_output, ll_output = self.do_intervention(base_input, ablation_input, hl_node)
-        # CrossEntropyLoss needs target probs, not logits
-        # hl_output = t.nn.functional.softmax(hl_output, dim=-1)
-        hl_argmax = t.argmax(hl_output[:, -1, :], dim=-1)
-        hl_one_hot = t.nn.functional.one_hot(hl_argmax, num_classes=hl_output.shape[-1])
-        hl_probs = hl_one_hot.float()
+        # hl outputs can be sparse ids, one-hot vectors or logits
+        hl_label = get_label_ids(hl_output)[:, -1]
         assert self.hl_model.is_categorical()
-        loss = loss_fn(ll_output[:, -1, :], hl_probs)
-        if ll_output.shape == hl_output.shape:
-            # To handle the case when labels are one-hot
-            hl_output = t.argmax(hl_output, dim=-1)
+        loss = loss_fn(ll_output[:, -1, :], hl_label)
         top1 = t.argmax(ll_output, dim=-1)
-        accuracy = (top1[:, -1] == hl_output[:, -1]).float().mean().item()
+        accuracy = (top1[:, -1] == hl_label).float().mean().item()
         IIA = accuracy
 
         # compute behavioral accuracy
@@ -122,29 +115,8 @@ class IOI_ModelPair(StrictIITModelPair):
 
 
         # strict accuracy
-        base_x, base_y = base_input[0:2]
-        ablation_x, ablation_y = ablation_input[0:2]
-        # ll_node = self.sample_ll_node() 
-        _, cache = self.ll_model.run_with_cache(ablation_x)
-        self.ll_cache = cache
-        label_idx = self.get_label_idxs()
-        base_y = base_y[label_idx.as_index].to(self.ll_model.cfg.device)
-        if self.hl_model.is_categorical:
-            if len(base_y.shape) == 2:
-                base_y = t.argmax(base_y, dim=-1)
-        accuracies = []
-        for node in self.nodes_not_in_circuit:
-            out = self.ll_model.run_with_hooks(
-                base_x, fwd_hooks=[(node.name, self.make_ll_ablation_hook(node))]
-            )
-            ll_output = out[label_idx.as_index]
-            if self.hl_model.is_categorical:
-                top1 = t.argmax(ll_output, dim=-1)
-                accuracy = (top1 == base_y).float().mean().item()
-            else:
-                accuracy = ((ll_output - base_y).abs() < self.training_args["atol"]).float().mean().item()
-            accuracies.append(accuracy)
-        strict_accuracy = np.mean(accuracies)
+        strict_accuracies = self.get_strict_accuracies(base_input, ablation_input)
+        strict_accuracy = strict_accuracies.mean().item() if len(strict_accuracies) > 0 else 1.0
 
         return {
             "val/iit_loss": loss.item(),
@@ -156,6 +128,7 @@ class IOI_ModelPair(StrictIITModelPair):
             ),
             "val/strict_accuracy": strict_accuracy,
             "val/per_token_accuracy": per_token_accuracy,
+            "val/per_node_strict_accuracy": strict_accuracies.cpu().numpy(),
         }
 
     @staticmethod
@@ -111,6 +111,7 @@ class LLModel:
         incl_bwd: bool = False,
         reset_hooks_end: bool = True,
         clear_contexts: bool = False,
+        bwd_metric: Optional[Callable[[Tensor], Tensor]] = None,
         **model_kwargs,
     ) -> Tuple[Tensor, ActivationCache]:
         """
@@ -133,6 +134,8 @@ class LLModel:
                 end of the run. Defaults to True.
             clear_contexts (bool, optional): If True, clears hook contexts whenever hooks are reset.
                 Defaults to False.
+            bwd_metric (Callable, optional): With incl_bwd, maps the model output to the scalar to call
+                backward on, instead of the model output itself. Defaults to None.
             **model_kwargs: Keyword arguments for the model.
 
         Returns:
@@ -151,7 +154,7 @@ class LLModel:
         ):
             model_out = self.model(*model_args, **model_kwargs)
             if incl_bwd:
-                model_out.backward()
+                (model_out if bwd_metric is None else bwd_metric(model_out)).backward()
         cache_dict = ActivationCache(
                 cache_dict, self, has_batch_dim=not remove_batch_dim
         )
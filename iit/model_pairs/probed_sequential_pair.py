@@ -100,7 +100,10 @@ class IITProbeSequentialPair(IITModelPair):
             train_set, 
             test_set, 
             training_args["batch_size"],
-            training_args["num_workers"]
+            training_args["num_workers"],
+            pin_memory=training_args.get("pin_memory", True),
+            prefetch_factor=training_args.get("prefetch_factor", None),
+            persistent_workers=training_args.get("persistent_workers", False),
             )
         params = list(self.ll_model.parameters())
         for p in probes.values():
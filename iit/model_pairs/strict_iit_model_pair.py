@@ -8,7 +8,7 @@ from iit.model_pairs.iit_behavior_model_pair import IITBehaviorModelPair
 from iit.model_pairs.ll_model import LLModel
 import iit.utils.node_picker as node_picker
 from iit.utils.nodes import LLNode
-from iit.utils.metric import MetricStore, MetricStoreCollection, MetricType
+from iit.utils.metric import MetricStore, MetricStoreCollection, MetricType, PerNodeMetricStore
 from iit.utils.correspondence import Correspondence
 
 
@@ -23,10 +23,13 @@ class StrictIITModelPair(IITBehaviorModelPair):
         default_training_args = {
             "strict_weight": 1.0,
             "siit_sampling" : "individual", # individual, sample_all, all
+            "fused_train_step": False, # with use_single_loss, compute all losses from one tiled forward pass
         }
         training_args = {**default_training_args, **training_args}
         super().__init__(hl_model, ll_model, corr=corr, training_args=training_args)
-        self.nodes_not_in_circuit = node_picker.get_nodes_not_in_circuit(self.ll_model, self.corr)
+        self.nodes_not_in_circuit = node_picker.get_nodes_not_in_circuit(
+            self.ll_model, self.corr, **self.get_node_granularity()
+        )
         assert (
             self.training_args["iit_weight"] > 0
             or self.training_args["behavior_weight"] > 0
@@ -50,6 +53,11 @@ class StrictIITModelPair(IITBehaviorModelPair):
             + [MetricStore("val/strict_accuracy", MetricType.ACCURACY)],
         )
 
+    def make_eval_metrics(self) -> MetricStoreCollection:
+        metrics = self.make_test_metrics()
+        metrics.metrics.append(PerNodeMetricStore("val/per_node_strict_accuracy", self.nodes_not_in_circuit))
+        return metrics
+
     def sample_ll_nodes(self) -> list[LLNode]:
         if self.training_args['siit_sampling'] == 'individual':
             ll_nodes = [self.rng.choice(np.array(self.nodes_not_in_circuit, dtype=object)),]
@@ -71,14 +79,21 @@ class StrictIITModelPair(IITBehaviorModelPair):
         base_x, base_y = base_input[0:2]
         ablation_x, _ = ablation_input[0:2]
         ll_nodes = self.sample_ll_nodes()
-        _, cache = self.ll_model.run_with_cache(ablation_x)
+        _, cache = self.ll_model.run_with_cache(
+            ablation_x, names_filter=node_picker.get_hook_names(ll_nodes)
+        )
         self.ll_cache = cache
-        hooks = []
-        for ll_node in ll_nodes:
-            hooks.append((ll_node.name, self.make_ll_ablation_hook(ll_node)))
         out = self.ll_model.run_with_hooks(
-            base_x, fwd_hooks=hooks
+            base_x, fwd_hooks=self.make_ll_ablation_hooks(ll_nodes)
         )
+        return self.get_SIIT_loss_from_output(out, base_y, loss_fn)
+
+    def get_SIIT_loss_from_output(
+            self,
+            out: Tensor,
+            base_y: Tensor,
+            loss_fn: Callable[[Tensor, Tensor], Tensor]
+    ) -> Tensor:
         # print(out.shape, base_y.shape)
         label_idx = self.get_label_idxs()
         siit_loss = (
@@ -95,6 +110,8 @@ class StrictIITModelPair(IITBehaviorModelPair):
         optimizer: t.optim.Optimizer,
     ) -> dict:
         use_single_loss = self.training_args["use_single_loss"]
+        if use_single_loss and self.training_args["fused_train_step"]:
+            return self.run_fused_train_step(base_input, ablation_input, loss_fn, optimizer)
 
         iit_loss = t.zeros(1)
         siit_loss = t.zeros(1)
@@ -137,6 +154,76 @@ class StrictIITModelPair(IITBehaviorModelPair):
             "train/strict_loss": siit_loss.item(),
         }
 
+    def run_fused_train_step(
+        self,
+        base_input: tuple[Tensor, Tensor, Tensor],
+        ablation_input: tuple[Tensor, Tensor, Tensor],
+        loss_fn: Callable[[Tensor, Tensor], Tensor],
+        optimizer: t.optim.Optimizer,
+    ) -> dict:
+        """
+        Single loss train step with one ablation cache run shared by IIT and SIIT, and one
+        ll forward pass over the base batch tiled into [clean, IIT patched, SIIT patched] rows.
+        Only used with use_single_loss and fused_train_step, as tiling changes the batch
+        statistics seen by batch dependent layers (e.g. BatchNorm in train mode).
+        """
+        base_x, base_y = base_input[0:2]
+        ablation_x = ablation_input[0]
+        batch_size = base_x.shape[0]
+
+        iit_loss = t.zeros(1)
+        siit_loss = t.zeros(1)
+        behavior_loss = t.zeros(1)
+
+        # one replica of the base batch per loss, each with the nodes patched in that replica
+        objectives: list[str] = []
+        patched_nodes: list[list[LLNode]] = []
+        if self.training_args["behavior_weight"] > 0:
+            objectives.append("behavior")
+            patched_nodes.append([])
+        if self.training_args["iit_weight"] > 0:
+            hl_node = self.sample_hl_name()  # sample a high-level variable to ablate
+            objectives.append("iit")
+            patched_nodes.append(list(self.corr[hl_node]))
+        if self.training_args["strict_weight"] > 0:
+            objectives.append("strict")
+            patched_nodes.append(list(self.sample_ll_nodes()))
+
+        hook_names = node_picker.get_hook_names(node for nodes in patched_nodes for node in nodes)
+        if len(hook_names) > 0:
+            _, self.ll_cache = self.ll_model.run_with_cache(ablation_x, names_filter=hook_names)
+        out = self.ll_model.run_with_hooks(
+            self.tile_input((base_x,), len(objectives))[0],
+            fwd_hooks=self.make_ll_replica_ablation_hooks(patched_nodes, batch_size),
+        )
+        outputs = dict(zip(objectives, out.chunk(len(objectives))))
+
+        if "iit" in outputs:
+            hl_output = self.get_hl_intervention_output(base_input, ablation_input, hl_node)
+            iit_loss = (
+                self.get_IIT_loss_from_outputs(hl_output, outputs["iit"], loss_fn)
+                * self.training_args["iit_weight"]
+            )
+        if "strict" in outputs:
+            siit_loss = (
+                self.get_SIIT_loss_from_output(outputs["strict"], base_y, loss_fn)
+                * self.training_args["strict_weight"]
+            )
+        if "behavior" in outputs:
+            behavior_loss = (
+                self.get_behaviour_loss_from_output(outputs["behavior"], base_y, loss_fn)
+                * self.training_args["behavior_weight"]
+            )
+
+        total_loss = iit_loss + behavior_loss + siit_loss
+        self.step_on_loss(total_loss, optimizer)
+
+        return {
+            "train/iit_loss": iit_loss.item(),
+            "train/behavior_loss": behavior_loss.item(),
+            "train/strict_loss": siit_loss.item(),
+        }
+
     def run_eval_step(
             self, 
             base_input: tuple[Tensor, Tensor, Tensor],
@@ -144,38 +231,56 @@ class StrictIITModelPair(IITBehaviorModelPair):
             loss_fn: Callable[[Tensor, Tensor], Tensor]
             ) -> dict:
         eval_returns = super().run_eval_step(base_input, ablation_input, loss_fn)
-        base_x, base_y = base_input[0:2]
-        ablation_x, ablation_y = ablation_input[0:2]
+        accuracies = self.get_strict_accuracies(base_input, ablation_input)
+        if len(accuracies) > 0:
+            accuracy = accuracies.mean().item()
+        else:
+            accuracy = 1.0
+
+        eval_returns["val/strict_accuracy"] = accuracy
+        eval_returns["val/per_node_strict_accuracy"] = accuracies.cpu().numpy()
+        return eval_returns
 
-        _, cache = self.ll_model.run_with_cache(ablation_x)
+
+    def get_strict_accuracies(
+            self,
+            base_input: tuple[Tensor, Tensor, Tensor],
+            ablation_input: tuple[Tensor, Tensor, Tensor],
+    ) -> Tensor:
+        """
+        Returns the accuracy wrt base_y after resample ablating each node in
+        self.nodes_not_in_circuit, in the same order.
+        The base batch is tiled once per node so that the nodes of each chunk (see chunk_nodes)
+        share one hooked forward pass.
+        """
+        base_x, base_y = base_input[0:2]
+        ablation_x = ablation_input[0]
+        batch_size = base_x.shape[0]
         label_idx = self.get_label_idxs()
         base_y = base_y[label_idx.as_index].to(self.ll_model.cfg.device)
-        self.ll_cache = cache
+
+        _, self.ll_cache = self.ll_model.run_with_cache(
+            ablation_x, names_filter=node_picker.get_hook_names(self.nodes_not_in_circuit)
+        )
         accuracies = []
-        for node in self.nodes_not_in_circuit:
+        for node_chunk in self.chunk_nodes(self.nodes_not_in_circuit, base_x):
             out = self.ll_model.run_with_hooks(
-                base_x, fwd_hooks=[(node.name, self.make_ll_ablation_hook(node))]
+                self.tile_input((base_x,), len(node_chunk))[0],
+                fwd_hooks=self.make_ll_replica_ablation_hooks([[node] for node in node_chunk], batch_size),
             )
-            ll_output = out[label_idx.as_index]
+            ll_output = out.reshape(len(node_chunk), batch_size, *out.shape[1:])
+            ll_output = ll_output[(slice(None), *label_idx.as_index)]
             if self.hl_model.is_categorical():
-                if ll_output.shape == base_y.shape:
+                if ll_output.shape[1:] == base_y.shape:
                     base_y = t.argmax(base_y, dim=-1)
-                top1 = t.argmax(ll_output, dim=-1)
-                accuracy = (top1 == base_y).float().mean().item()
+                correct = t.argmax(ll_output, dim=-1) == base_y
             else:
-                accuracy = (
-                    ((ll_output - base_y).abs() < self.training_args["atol"]).float().mean().item()
-                )
-            accuracies.append(accuracy)
-
-        if len(accuracies) > 0:
-            accuracy = float(np.mean(accuracies))
-        else:
-            accuracy = 1.0
-
-        eval_returns["val/strict_accuracy"] = accuracy
-        return eval_returns
+                correct = (ll_output - base_y).abs() < self.training_args["atol"]
+            accuracies.append(correct.float().reshape(len(node_chunk), -1).mean(dim=-1))
 
+        if len(accuracies) == 0:
+            return t.zeros(0)
+        return t.cat(accuracies)
 
     def _check_early_stop_condition(self, test_metrics: MetricStoreCollection) -> bool:
         metrics_to_check = []
@@ -1,8 +1,30 @@
 from abc import ABC, abstractmethod
 
+from torch import Tensor
+
+from iit.utils.nodes import HLNode
+
 
 class HLModel(ABC):
 
     @abstractmethod
     def is_categorical(self) -> bool:
-        pass
\ No newline at end of file
+        pass
+
+    def supports_dual_batch_intervention(self) -> bool:
+        """
+        Whether the model implements run_dual_batch_intervention.
+        """
+        return False
+
+    def run_dual_batch_intervention(
+        self,
+        base_input: tuple,
+        ablation_input: tuple,
+        hl_node: HLNode,
+    ) -> Tensor:
+        """
+        Returns the output on base_input with hl_node patched from ablation_input,
+        computed in a single forward pass instead of a cache run followed by a hooked run.
+        """
+        raise NotImplementedError
@@ -1,4 +1,5 @@
-from .utils import make_ioi_dataset_and_hl
+from .utils import make_ioi_dataset_and_hl, make_ioi_vocab_from_config, get_gpt2_cfg
+from .vocab import CompactVocab
 from .ioi_config import NAMES
 from .ioi_hl import IOI_HL
 from .ioi_dataset_tl import IOIDataset, IOIDatasetWrapper
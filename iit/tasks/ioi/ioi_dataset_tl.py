@@ -5,10 +5,14 @@ HuggingFace evaluate library if you want to do anything properly. This is howeve
 it and want to eg cheaply and roughly compare models you've trained to baselines.
 """
 
+import hashlib
+import json
+import os
 import random
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import einops
+import numpy as np
 import torch as t
 from torch import Tensor
 import tqdm.auto as tqdm
@@ -19,6 +23,7 @@ from transformers import AutoTokenizer
 from transformer_lens import utils, HookedTransformer
 from iit.utils.config import DEVICE
 from iit.utils.iit_dataset import dataset_len
+from iit.tasks.ioi.vocab import CompactVocab
 
 
 # %%
@@ -172,6 +177,11 @@ def evaluate(
 
 
 # %%
+# bump when the layout of the on-disk IOI cache changes
+IOI_CACHE_VERSION = 1
+IOI_CACHE_ARRAYS = ["prompt_ids", "prompt_lengths", "io_ids", "s_ids", "template_ids"]
+
+
 class IOIDataset(Dataset):
     """
     Dataset for Indirect Object Identification tasks.
@@ -201,8 +211,22 @@ class IOIDataset(Dataset):
         ... )
         >>> print(round(ioi_eval(model, dataset=ds)["Logit Difference"], 3))
         5.397
+
+    All samples are tokenized once at construction (see tokenize_samples). If cache_dir is
+    given, the tokenized dataset is saved under a key of the names, templates, nouns, seed and
+    tokenizer, and later constructions with the same key memory-map it instead of regenerating.
+    If vocab is given, all token ids are remapped into that compact vocabulary.
+    Prompts are left-padded to max_sentence_length if the tokenizer has a pad token,
+    unless pad_prompts is False (e.g. for length-bucketed batches, see get_lengths).
     """
 
+    # tokenized samples, see tokenize_samples
+    prompt_ids: np.ndarray
+    prompt_lengths: np.ndarray
+    io_ids: np.ndarray
+    s_ids: np.ndarray
+    template_ids: np.ndarray
+
     def __init__(
         self,
         tokenizer: AutoTokenizer,
@@ -214,10 +238,15 @@ class IOIDataset(Dataset):
         prepend_bos: bool = True,
         seed: int = 42,
         device: t.device = DEVICE,
+        cache_dir: Optional[str] = None,
+        vocab: Optional[CompactVocab] = None,
+        pad_prompts: bool = True,
     ):
         self.tokenizer = tokenizer
         self.prepend_bos = prepend_bos
         self.device = device
+        self.vocab = vocab
+        self.pad_prompts = pad_prompts
 
         self.templates = templates if templates is not None else self.get_default_templates()
         self.names = names if names is not None else self.get_default_names()
@@ -227,10 +256,21 @@ class IOIDataset(Dataset):
         ), ValueError("The dataset only supports names that are encoded to a single token.")
         self.nouns = nouns if nouns is not None else self.get_default_nouns()
 
+        cache_path = None
+        if cache_dir is not None:
+            cache_key = self.get_cache_key(num_samples, symmetric, seed)
+            cache_path = os.path.join(cache_dir, f"ioi_{cache_key}")
+            if os.path.exists(os.path.join(cache_path, "meta.json")):
+                self.load_cache(cache_path)
+                self.apply_vocab()
+                return
+
+        # local generators, so that the global random state is the same whether or not the cache is hit
+        length_rng = random.Random(seed)
         self.max_sentence_length = 0
         for template in self.templates:
             for noun_type, noun_list in self.nouns.items():
-                template = template.replace(f"[{noun_type}]", random.choice(noun_list))
+                template = template.replace(f"[{noun_type}]", length_rng.choice(noun_list))
             sample = template.replace("[A]", self.names[0])
             sample = sample.replace("[B]", self.names[1])
             prompt = self.tokenizer.encode(sample)
@@ -239,51 +279,151 @@ class IOIDataset(Dataset):
             self.max_sentence_length = max(self.max_sentence_length, len(prompt))
 
         self.samples = []
-        random.seed(seed)
+        rng = random.Random(seed)
         for _ in range(num_samples // 2 if symmetric else num_samples):
             # If symmetric, get_sample will return two samples
-            self.samples.extend(self.get_sample(symmetric=symmetric))
+            self.samples.extend(self.get_sample(symmetric=symmetric, rng=rng))
+
+        self.tokenize_samples()
+        if cache_path is not None:
+            self.save_cache(cache_path)
+        self.apply_vocab()
 
     def __len__(self) -> int:
         return len(self.samples)
 
-    def __getitem__(self, idx: int, pad_token: bool = False) -> Dict[str, Tensor]:
-        sample = self.samples[idx]
-        prompt = self.tokenizer.encode(sample["text"])
-        if self.prepend_bos:
-            prompt = [self.tokenizer.bos_token_id] + prompt
+    def get_prompt(self, idx: int) -> List[int]:
+        prompt = self.prompt_ids[idx, : self.prompt_lengths[idx]].tolist()
+        if self.pad_prompts and self.tokenizer.pad_token_id:
+            prompt = [self.pad_token_id] * (self.max_sentence_length - len(prompt)) + prompt
+        return prompt
+
+    @property
+    def d_vocab(self) -> int:
+        return len(self.vocab) if self.vocab is not None else self.tokenizer.vocab_size
+
+    @property
+    def pad_token_id(self) -> Optional[int]:
         pad_token = self.tokenizer.pad_token_id
-        if pad_token:
-            prompt = [pad_token] * (self.max_sentence_length - len(prompt)) + prompt
+        if pad_token is None or self.vocab is None:
+            return pad_token
+        return int(self.vocab.compact(np.array(pad_token)))
+
+    def apply_vocab(self) -> None:
+        """Remaps the tokenized arrays into self.vocab. The cache always holds original ids."""
+        if self.vocab is None:
+            return
+        in_prompt = np.arange(self.prompt_ids.shape[1]) < self.prompt_lengths[:, None]
+        # the right padding of prompt_ids is not necessarily in the vocabulary
+        prompt_ids = np.where(in_prompt, self.prompt_ids, self.prompt_ids[:, :1])
+        self.prompt_ids = np.where(in_prompt, self.vocab.compact(prompt_ids), 0)
+        self.io_ids = self.vocab.compact(self.io_ids)
+        self.s_ids = self.vocab.compact(self.s_ids)
+
+    def __getitem__(self, idx: int, pad_token: bool = False) -> Dict[str, Tensor]:
+        prompt = self.get_prompt(idx)
         idx_to_ablate = len(prompt) - 2
 
         return {
             "prompt": t.LongTensor(prompt),
-            "IO": t.LongTensor(self.tokenizer.encode(sample["IO"])),
-            "S": t.LongTensor(self.tokenizer.encode(sample["S"])),
+            "IO": t.LongTensor([int(self.io_ids[idx])]),
+            "S": t.LongTensor([int(self.s_ids[idx])]),
             "idx_to_ablate": t.LongTensor((idx_to_ablate,)),
         }
 
-    def get_sample(self, symmetric: bool = False) -> List[Dict[str, str]]:
-        template: str = random.choice(self.templates)
+    def tokenize_samples(self) -> None:
+        """
+        Tokenizes all samples with one batched tokenizer call into right-padded
+        prompt ids, prompt lengths, IO and S ids, so that __getitem__ never tokenizes.
+        """
+        texts = [sample["text"] for sample in self.samples]
+        prompts = self.tokenizer(texts)["input_ids"] if len(texts) > 0 else []
+        if self.prepend_bos:
+            prompts = [[self.tokenizer.bos_token_id] + prompt for prompt in prompts]
+        self.prompt_lengths = np.array([len(prompt) for prompt in prompts], dtype=np.int64)
+        self.prompt_ids = np.zeros((len(prompts), max(self.prompt_lengths, default=0)), dtype=np.int64)
+        for i, prompt in enumerate(prompts):
+            self.prompt_ids[i, : len(prompt)] = prompt
+
+        names = sorted({sample[key] for sample in self.samples for key in ["IO", "S"]})
+        name_ids = dict(zip(names, self.tokenizer(names)["input_ids"] if len(names) > 0 else []))
+        # names are single tokens, see the assert in __init__
+        self.io_ids = np.array([name_ids[sample["IO"]][0] for sample in self.samples], dtype=np.int64)
+        self.s_ids = np.array([name_ids[sample["S"]][0] for sample in self.samples], dtype=np.int64)
+        self.template_ids = np.array([sample["template_id"] for sample in self.samples], dtype=np.int64)
+
+    def get_tokenizer_fingerprint(self) -> str:
+        vocab = sorted(self.tokenizer.get_vocab().items())
+        return hashlib.sha256(
+            json.dumps([self.tokenizer.name_or_path, self.prepend_bos, self.tokenizer.bos_token_id, vocab]).encode()
+        ).hexdigest()
+
+    def get_cache_key(self, num_samples: int, symmetric: bool, seed: int) -> str:
+        key = {
+            "version": IOI_CACHE_VERSION,
+            "names": self.names,
+            "templates": self.templates,
+            "nouns": self.nouns,
+            "num_samples": num_samples,
+            "symmetric": symmetric,
+            "seed": seed,
+            "tokenizer": self.get_tokenizer_fingerprint(),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    def save_cache(self, cache_path: str) -> None:
+        """
+        Writes the tokenized dataset to cache_path as .npy arrays plus the sample texts.
+        meta.json is written last, so a partially written cache is never loaded.
+        """
+        os.makedirs(cache_path, exist_ok=True)
+        for name in IOI_CACHE_ARRAYS:
+            np.save(os.path.join(cache_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(cache_path, "samples.json"), "w") as f:
+            json.dump(self.samples, f)
+        with open(os.path.join(cache_path, "meta.json"), "w") as f:
+            json.dump({"version": IOI_CACHE_VERSION, "max_sentence_length": self.max_sentence_length}, f)
+
+    def load_cache(self, cache_path: str) -> None:
+        """Opens a cache written by save_cache, memory-mapping the token arrays."""
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta["version"] == IOI_CACHE_VERSION, ValueError(
+            f"IOI cache version {meta['version']} at {cache_path}, expected {IOI_CACHE_VERSION}"
+        )
+        self.max_sentence_length = meta["max_sentence_length"]
+        for name in IOI_CACHE_ARRAYS:
+            setattr(self, name, np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r"))
+        with open(os.path.join(cache_path, "samples.json")) as f:
+            self.samples = json.load(f)
+
+    def get_sample(self, symmetric: bool = False, rng: Optional[random.Random] = None) -> List[Dict[str, Any]]:
+        """Draws a sample (two if symmetric) from rng, or from the global random state if it is None."""
+        choice, sample_names = (random.choice, random.sample) if rng is None else (rng.choice, rng.sample)
+        template: str = choice(self.templates)
+        template_id = self.templates.index(template)
         for noun_type, noun_list in self.nouns.items():
-            template = template.replace(f"[{noun_type}]", random.choice(noun_list))
+            template = template.replace(f"[{noun_type}]", choice(noun_list))
 
-        samples: List[Dict[str, str]] = []
+        samples: List[Dict[str, Any]] = []
 
         # Sample two names without replacement
-        names = random.sample(self.names, 3)
+        names = sample_names(self.names, 3)
         sample = template.replace("[A]", names[0])
         sample = sample.replace("[B]", names[1])
         sample = sample.replace("[C]", names[2])
         # Prepend spaces to IO and S so that the target is e.g. " Mary" and not "Mary"
-        samples.append({"text": sample, "IO": " " + names[0], "S": " " + names[1]})
+        samples.append(
+            {"text": sample, "IO": " " + names[0], "S": " " + names[1], "template_id": template_id}
+        )
 
         if symmetric:
             sample_2 = template.replace("[A]", names[1])
             sample_2 = sample_2.replace("[B]", names[0])
             sample = sample.replace("[C]", names[2])
-            samples.append({"text": sample_2, "IO": " " + names[1], "S": " " + names[0]})
+            samples.append(
+                {"text": sample_2, "IO": " " + names[1], "S": " " + names[0], "template_id": template_id}
+            )
 
         return samples
 
@@ -387,20 +527,56 @@ def ioi_eval(
 
 
 class IOIDatasetWrapper(IOIDataset):
-    def get_inputs(self) -> Tensor:
-        items = [self.__getitem__(i) for i in range(len(self))]
-        inputs = [item[0] for item in items]
-        inputs_tensor = t.stack(inputs)
-        return inputs_tensor
+    """
+    Returns (prompt[:-1], next token labels, IO token). Labels are int64 token ids,
+    or dense one-hot vectors over the vocabulary if one_hot_labels is set.
+    """
+
+    def __init__(self, *args: Any, one_hot_labels: bool = False, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.one_hot_labels = one_hot_labels
+
+    def get_length_groups(self) -> dict[int, np.ndarray]:
+        """Indices of the samples of each input length, in dataset order."""
+        lengths = self.get_lengths()
+        return {length: np.flatnonzero(lengths == length) for length in np.unique(lengths).tolist()}
+
+    def get_inputs(self) -> Tensor | dict[int, Tensor]:
+        """
+        All inputs, stacked. If they are not all of one length (pad_prompts=False), a dict from
+        each input length to the stacked inputs of that length, in the order of get_length_groups.
+        """
+        groups = self.get_length_groups()
+        stacked = {
+            length: t.stack([t.LongTensor(self.get_prompt(i))[:-1] for i in indices.tolist()]).to(self.device)
+            for length, indices in groups.items()
+        }
+        if len(stacked) == 1:
+            return next(iter(stacked.values()))
+        return stacked
+
+    def get_targets(self) -> list[Tensor] | dict[int, Tensor]:
+        """All labels, grouped and stacked by input length like get_inputs if there are several lengths."""
+        groups = self.get_length_groups()
+        if len(groups) <= 1:
+            return [self.__getitem__(i)[1] for i in range(len(self))]
+        return {
+            length: t.stack([self.__getitem__(i)[1] for i in indices.tolist()])
+            for length, indices in groups.items()
+        }
 
-    def get_targets(self) -> list[Tensor]:
-        items = [self.__getitem__(i) for i in range(len(self))]
-        targets = [item[1] for item in items]
-        return targets
+    def get_lengths(self) -> np.ndarray:
+        """Length of each input (the prompt without its last token), including padding."""
+        if self.pad_prompts and self.tokenizer.pad_token_id:
+            lengths = np.maximum(self.prompt_lengths, self.max_sentence_length)
+        else:
+            lengths = np.asarray(self.prompt_lengths)
+        return lengths - 1
 
     def __getitem__(self, idx: int) -> tuple[Tensor, Tensor, Tensor]:  # type: ignore
         x = super().__getitem__(idx)
         prompt = x["prompt"]
-        y_list = list(prompt[1:])
-        y = t.nn.functional.one_hot(t.tensor(y_list), num_classes=self.tokenizer.vocab_size).float()
+        y = prompt[1:].clone()
+        if self.one_hot_labels:
+            y = t.nn.functional.one_hot(y, num_classes=self.d_vocab).float()
         return (x["prompt"][:-1].to(self.device), (y).to(self.device), (x["IO"]).to(self.device))
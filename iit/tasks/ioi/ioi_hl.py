@@ -1,11 +1,12 @@
 from argparse import Namespace
-from typing import Callable
+from typing import Callable, Optional
 
 import torch as t
 from torch import Tensor
 from transformer_lens.hook_points import HookedRootModule, HookPoint
 
 from iit.tasks.hl_model import HLModel
+from iit.utils.nodes import HLNode
 
 
 class DuplicateHead(t.nn.Module):
@@ -115,7 +116,12 @@ class IOI_HL(HookedRootModule, HLModel):
         names: Tensor,
         device: t.device = t.device("cuda") if t.cuda.is_available() else t.device("cpu"),
         return_one_hot: bool = True,
+        return_ids: bool = False,
     ):
+        """
+        The output is (batch, seq, d_vocab) name mover logits, or their one-hot argmax if
+        return_one_hot is set. With return_ids, it is the (batch, seq) int64 argmax token ids.
+        """
         super().__init__()
         assert isinstance(names, Tensor), ValueError(
             f"Expected a tensor, got {type(names)}"
@@ -136,6 +142,7 @@ class IOI_HL(HookedRootModule, HLModel):
             d_vocab_out=d_vocab,
             device=device,
             return_one_hot=return_one_hot,
+            return_ids=return_ids,
         )
         self.setup()
 
@@ -146,27 +153,82 @@ class IOI_HL(HookedRootModule, HLModel):
     def is_categorical(self) -> bool:
         return True
 
-    def forward(self, args: Tensor | tuple, verbose: bool = False) -> Tensor:
-        show: Callable[[t.Any], None] = lambda *args, **kwargs: (
-            print(*args, **kwargs) if verbose else None
-        )
+    def supports_dual_batch_intervention(self) -> bool:
+        return True
+
+    @staticmethod
+    def _get_tokens(args: Tensor | tuple) -> Tensor:
         if isinstance(args, Tensor):
-            input = args
+            return args
         elif isinstance(args, tuple):
-            input = args[0]
-        else:
-            raise ValueError(f"Expected a tensor or tuple, got {type(args)}")
+            return args[0]
+        raise ValueError(f"Expected a tensor or tuple, got {type(args)}")
+
+    def forward(self, args: Tensor | tuple, verbose: bool = False) -> Tensor:
+        input = self._get_tokens(args)
         batched = True
         if len(input.shape) == 1:
             batched = False
             input = input[None, ...]
-        # print([a.shape for a in args])
-        # duplicate, previous, induction, s_inhibition, name_mover = [intermediate_data[:, i] for i in range(5)]
-        # print(f"intermediate_data is a {type(intermediate_data)}; duplicate is a {type(duplicate)}")
+        out = self._run_circuit(input, verbose=verbose)
+        if not batched:
+            out = out[0]
+        return out
+
+    def run_dual_batch_intervention(
+        self,
+        base_input: Tensor | tuple,
+        ablation_input: Tensor | tuple,
+        hl_node: HLNode,
+    ) -> Tensor:
+        base_tokens = self._get_tokens(base_input)
+        ablation_tokens = self._get_tokens(ablation_input)
+        batched = True
+        if len(base_tokens.shape) == 1:
+            batched = False
+            base_tokens = base_tokens[None, ...]
+            ablation_tokens = ablation_tokens[None, ...]
+        input = t.cat([base_tokens, ablation_tokens], dim=0)
+        out = self._run_circuit(input, intervention=(hl_node, base_tokens.shape[0]))
+        if not batched:
+            out = out[0]
+        return out
+
+    def _run_circuit(
+        self,
+        input: Tensor,
+        intervention: Optional[tuple[HLNode, int]] = None,
+        verbose: bool = False,
+    ) -> Tensor:
+        """
+        Runs the circuit on a batch of tokens.
+        If intervention=(hl_node, batch) is given, input holds the base batch followed by
+        the ablation batch. The value at hl_node is patched from the ablation rows into the
+        base rows, and only the base rows are carried downstream of hl_node.
+        """
+        show: Callable[[t.Any], None] = lambda *args, **kwargs: (
+            print(*args, **kwargs) if verbose else None
+        )
+
+        def is_patched_at(name: str) -> bool:
+            return intervention is not None and intervention[0].name == name
+
+        def patch(value: Tensor) -> Tensor:
+            assert intervention is not None
+            hl_node, batch = intervention
+            patched = value[:batch]
+            patched[hl_node.index.as_index] = value[batch:][hl_node.index.as_index]
+            return patched
+
         input = self.all_nodes_hook(input)
+        if is_patched_at("all_nodes_hook"):
+            input = patch(input)
         duplicate = self.duplicate_head(input)
         assert duplicate.shape == input.shape
         duplicate = self.hook_duplicate(duplicate)
+        if is_patched_at("hook_duplicate"):
+            duplicate = patch(duplicate)
+            input = input[: duplicate.shape[0]]
         show(f"duplicate: {duplicate}")
         # previous = self.previous_head(input)
         # assert previous.shape == input.shape
@@ -175,17 +237,27 @@ class IOI_HL(HookedRootModule, HLModel):
         s_inhibition = self.s_inhibition_head(input, duplicate)
         assert s_inhibition.shape == input.shape
         s_inhibition = self.hook_s_inhibition(s_inhibition)
+        if is_patched_at("hook_s_inhibition"):
+            s_inhibition = patch(s_inhibition)
+            input = input[: s_inhibition.shape[0]]
         show(f"s_inhibition: {s_inhibition}")
         out = self.name_mover_head(input, s_inhibition)
-        if self.cfg.return_one_hot:
-            out = t.nn.functional.one_hot(
-                t.argmax(out, dim=-1), num_classes=self.d_vocab
-            ).float()
-        assert out.shape == input.shape + (self.d_vocab,)
+        if self.cfg.return_ids:
+            out = t.argmax(out, dim=-1)
+            assert out.shape == input.shape
+        else:
+            if self.cfg.return_one_hot:
+                out = t.nn.functional.one_hot(
+                    t.argmax(out, dim=-1), num_classes=self.d_vocab
+                ).float()
+            assert out.shape == input.shape + (self.d_vocab,)
         out = self.hook_name_mover(out)
-        show(f"out: {t.argmax(out, dim=-1)}")
-        if not batched:
-            out = out[0]
+        if is_patched_at("hook_name_mover"):
+            out = patch(out)
+        if intervention is not None:
+            # nodes that are not on the forward path leave the base rows unchanged
+            out = out[: intervention[1]]
+        show(f"out: {out if self.cfg.return_ids else t.argmax(out, dim=-1)}")
         return out
 
 
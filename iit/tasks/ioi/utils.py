@@ -1,4 +1,9 @@
+import json
+import os
+from typing import Optional
+
 import torch as t
+from transformers import AutoTokenizer
 
 from iit.model_pairs.ll_model import LLModel
 from iit.utils.config import DEVICE
@@ -6,6 +11,18 @@ from iit.utils.config import DEVICE
 from .ioi_config import ALL_TEMPLATES, NAMES, OBJECTS, PLACES
 from .ioi_dataset_tl import IOIDataset, IOIDatasetWrapper
 from .ioi_hl import IOI_HL
+from .vocab import CompactVocab, make_ioi_vocab
+
+GPT2_CFG_PATH = os.path.join(os.path.dirname(__file__), "gpt2_cfg.json")
+
+
+def get_gpt2_cfg() -> dict:
+    """
+    The config of HookedTransformer.from_pretrained("gpt2") (with fold_ln), as a dict.
+    It is shipped with the package, so no pretrained weights are downloaded or instantiated.
+    """
+    with open(GPT2_CFG_PATH) as f:
+        return json.load(f)
 
 
 def make_ioi_dataset_and_hl(
@@ -20,17 +37,42 @@ def make_ioi_dataset_and_hl(
         "PLACE": PLACES,
     },
     templates: list[str] = ALL_TEMPLATES,
+    one_hot_labels: bool = False,
+    cache_dir: Optional[str] = None,
+    vocab: Optional[CompactVocab] = None,
+    pad_prompts: bool = True,
 ) -> tuple[IOIDatasetWrapper, IOI_HL]:
+    """
+    By default labels and hl outputs are sparse token ids;
+    one_hot_labels switches both to dense one-hot vectors over the vocabulary.
+    If cache_dir is given, the tokenized dataset is cached there (see IOIDataset).
+    If vocab is given (see make_ioi_vocab_from_config), dataset and hl model use compact
+    token ids, and ll_model is expected to have d_vocab = d_vocab_out = len(vocab).
+    With pad_prompts=False, prompts keep their own length; batch them with
+    IITDataset(bucket_by_length=True).
+    """
     ioi_dataset_tl = IOIDataset(
         num_samples=num_samples,
         tokenizer=ll_model.tokenizer,
         names=names,
+        cache_dir=cache_dir,
     )
 
     ioi_names = t.tensor(
         [ll_model.tokenizer.encode(" " + name) for name in ioi_dataset_tl.names]
-    ).flatten().to(device)
-    hl_model = IOI_HL(d_vocab=ll_model.cfg.d_vocab_out, names=ioi_names, device=device)
+    ).flatten()
+    if vocab is not None:
+        assert ll_model.cfg.d_vocab_out == len(vocab), ValueError(
+            f"ll_model has d_vocab_out={ll_model.cfg.d_vocab_out}, expected {len(vocab)} for a compact vocab"
+        )
+        ioi_names = vocab.compact(ioi_names)
+    ioi_names = ioi_names.to(device)
+    hl_model = IOI_HL(
+        d_vocab=ll_model.cfg.d_vocab_out,
+        names=ioi_names,
+        device=device,
+        return_ids=not one_hot_labels,
+    )
 
     ioi_dataset = IOIDatasetWrapper(
         num_samples=num_samples,
@@ -39,6 +81,10 @@ def make_ioi_dataset_and_hl(
         device=device,
         nouns=nouns_dict,
         templates=templates,
+        one_hot_labels=one_hot_labels,
+        cache_dir=cache_dir,
+        vocab=vocab,
+        pad_prompts=pad_prompts,
     )
 
     if verbose:
@@ -50,3 +96,17 @@ def make_ioi_dataset_and_hl(
         print(sentence, detokenised)
 
     return ioi_dataset, hl_model
+
+
+def make_ioi_vocab_from_config(
+    tokenizer: AutoTokenizer,
+    names: list[str] = NAMES,
+    nouns_dict: dict[str, list[str]] = {
+        "LOCATION": PLACES,
+        "OBJECT": OBJECTS,
+        "PLACE": PLACES,
+    },
+    templates: list[str] = ALL_TEMPLATES,
+) -> CompactVocab:
+    """The compact vocabulary of the datasets made by make_ioi_dataset_and_hl with the same arguments."""
+    return make_ioi_vocab(tokenizer, templates, names, nouns_dict)
@@ -0,0 +1,98 @@
+from typing import Iterable, Optional, TypeVar
+
+import numpy as np
+import torch as t
+from torch import Tensor
+from transformers import AutoTokenizer
+
+Ids = TypeVar("Ids", np.ndarray, Tensor)
+
+
+class CompactVocab:
+    """
+    Reversible mapping between the token ids a task actually uses and a dense
+    vocabulary [0, len(vocab)). Compact id i is the i-th smallest original id.
+    """
+
+    def __init__(self, token_ids: Iterable[int], original_size: int):
+        self.original_ids = np.unique(np.fromiter(token_ids, dtype=np.int64))
+        assert len(self.original_ids) > 0 and self.original_ids[0] >= 0, ValueError(
+            "Expected a non-empty set of non-negative token ids"
+        )
+        assert self.original_ids[-1] < original_size, ValueError(
+            f"Token id {self.original_ids[-1]} is out of range for a vocabulary of size {original_size}"
+        )
+        self.original_size = original_size
+        # -1 marks original ids that are not in the compact vocabulary
+        self.compact_ids = np.full(original_size, -1, dtype=np.int64)
+        self.compact_ids[self.original_ids] = np.arange(len(self.original_ids))
+
+    def __len__(self) -> int:
+        return len(self.original_ids)
+
+    def __contains__(self, token_id: int) -> bool:
+        return 0 <= token_id < self.original_size and bool(self.compact_ids[token_id] >= 0)
+
+    def compact(self, ids: Ids) -> Ids:
+        """Maps original token ids to compact ids."""
+        if isinstance(ids, Tensor):
+            return t.from_numpy(self.compact(ids.cpu().numpy())).to(ids.device)
+        compact_ids = self.compact_ids[np.asarray(ids)]
+        if (compact_ids < 0).any():
+            missing = np.unique(np.asarray(ids)[compact_ids < 0])
+            raise ValueError(f"Token ids {missing.tolist()} are not in the compact vocabulary")
+        return compact_ids
+
+    def expand(self, ids: Ids) -> Ids:
+        """Maps compact token ids back to the original ids."""
+        if isinstance(ids, Tensor):
+            return t.from_numpy(self.expand(ids.cpu().numpy())).to(ids.device)
+        return self.original_ids[np.asarray(ids)]
+
+    def decode(self, tokenizer: AutoTokenizer, ids: Ids, **kwargs: bool) -> str:
+        return tokenizer.decode(self.expand(ids).tolist(), **kwargs)
+
+    def state_dict(self) -> dict:
+        return {"original_ids": self.original_ids.tolist(), "original_size": self.original_size}
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "CompactVocab":
+        return cls(state["original_ids"], state["original_size"])
+
+
+def make_ioi_vocab(
+    tokenizer: AutoTokenizer,
+    templates: list[str],
+    names: list[str],
+    nouns: dict[str, list[str]],
+    extra_token_ids: Optional[list[int]] = None,
+) -> CompactVocab:
+    """
+    Collects every token an IOIDataset over these templates, names and nouns can produce.
+    Only depends on the arguments, not on the sampled prompts, so train and eval runs
+    with the same config get the same mapping.
+    Each placeholder is filled with every candidate once, with the other placeholders held fixed.
+    This covers all combinations as long as the tokenizer pre-splits on words (as GPT-2's BPE does).
+    """
+    fillers = {f"[{noun_type}]": noun_list for noun_type, noun_list in nouns.items()}
+    for placeholder in ["[A]", "[B]", "[C]"]:
+        fillers[placeholder] = names
+    default = {placeholder: candidates[0] for placeholder, candidates in fillers.items()}
+
+    texts = [" " + name for name in names]
+    for template in templates:
+        for placeholder, candidates in fillers.items():
+            if placeholder not in template:
+                continue
+            for candidate in candidates:
+                text = template.replace(placeholder, candidate)
+                for other, value in default.items():
+                    text = text.replace(other, value)
+                texts.append(text)
+
+    token_ids = {token for ids in tokenizer(texts)["input_ids"] for token in ids}
+    for special in [tokenizer.bos_token_id, tokenizer.pad_token_id]:
+        if special is not None:
+            token_ids.add(special)
+    token_ids.update(extra_token_ids or [])
+    return CompactVocab(sorted(token_ids), len(tokenizer))
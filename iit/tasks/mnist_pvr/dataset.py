@@ -1,3 +1,6 @@
+import hashlib
+import json
+import os
 from typing import Optional
 
 import torch as t
@@ -5,11 +8,58 @@ from torch import Tensor
 import torchvision
 import torchvision.datasets as datasets
 from torch.utils.data import Dataset
-from PIL import Image, ImageOps
+from PIL import Image
 import numpy as np
 from .utils import *
 from iit.utils.index import Ix, TorchIndex
 from iit.utils.nodes import HLNode
+from iit.utils.sample_cache import LRUSampleCache, SlotSampleCache, make_sample_cache
+
+
+class ImageStore:
+    """
+    A whole image classification dataset as one padded uint8 (N, C, H, W) tensor and an
+    int64 (N,) label tensor, built once. torchvision's MNIST is read from its data and
+    targets tensors directly; other datasets are converted item by item.
+    """
+
+    def __init__(self, images: Tensor, labels: Tensor, pad_size: int = 0):
+        if images.dim() == 3:
+            images = images.unsqueeze(1)
+        assert images.dtype == t.uint8 and images.dim() == 4, ValueError(
+            f"Expected uint8 images of shape (N, H, W) or (N, C, H, W), got {images.dtype} {tuple(images.shape)}"
+        )
+        if pad_size > 0:
+            images = t.nn.functional.pad(images, (pad_size,) * 4)
+        self.images = images
+        self.labels = labels.long()
+        # indices grouped by label, to sample from all images but one class directly
+        self.order = t.argsort(self.labels, stable=True)
+        self.class_counts = t.bincount(self.labels)
+        self.class_starts = t.cumsum(self.class_counts, dim=0) - self.class_counts
+
+    @classmethod
+    def from_dataset(cls, base_dataset: Dataset, pad_size: int = 0) -> "ImageStore":
+        if isinstance(getattr(base_dataset, "data", None), Tensor) and hasattr(base_dataset, "targets"):
+            return cls(base_dataset.data, t.as_tensor(base_dataset.targets), pad_size)  # type: ignore
+        items = [base_dataset[i] for i in range(len(base_dataset))]  # type: ignore
+        images = t.stack([
+            image if isinstance(image, Tensor) else torchvision.transforms.functional.pil_to_tensor(image)
+            for image, _ in items
+        ])
+        return cls(images, t.tensor([label for _, label in items]), pad_size)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def sample_excluding_labels(self, labels: Tensor, rng: np.random.Generator) -> Tensor:
+        """For each label, the index of an image drawn uniformly from the images of any other label."""
+        labels = labels.cpu()
+        counts, starts = self.class_counts[labels], self.class_starts[labels]
+        assert t.all(counts < len(self)), ValueError("Every image has the same label, cannot sample another one")
+        draws = t.from_numpy(rng.integers(0, len(self) - counts.numpy()))
+        # skip over the block of the excluded label in self.order
+        return self.order[draws + (draws >= starts) * counts]
 
 
 class ImagePVRDataset(Dataset):
@@ -17,6 +67,14 @@ class ImagePVRDataset(Dataset):
     Turns the regular dataset into a PVR dataset.
     Images are concatenated into a 2x2 square.
     The label is the class of the image in position class_map[label of top left].
+    Samples are composed from an ImageStore of the base dataset with tensor indexing,
+    one batch at a time (see get_batch). Sample i only depends on (seed, i).
+
+    With use_cache, composed samples are cached as uint8 in a cache_backend from
+    iit.utils.sample_cache.SAMPLE_CACHE_BACKENDS, using about cache_max_bytes (None: no bound,
+    only for the memory backend; the shared and mmap backends preallocate cache_max_bytes).
+    The "shared" and "mmap" backends are shared by all DataLoader workers, and "mmap"
+    (under cache_dir) also by later runs over the same dataset.
     """
 
     def __init__(
@@ -29,14 +87,15 @@ class ImagePVRDataset(Dataset):
         iid: bool = True,
         pad_size: int = 0,
         unique_per_quad: bool = False,
+        cache_backend: str = "memory",
+        cache_max_bytes: Optional[int] = None,
+        cache_dir: Optional[str] = None,
     ):
         self.base_dataset = base_dataset
         self.class_map = class_map
         self.seed = seed
         self.rng = np.random.default_rng(seed)
         assert all(v in {1, 2, 3} for v in class_map.values())
-        self.cache: dict[int, tuple[Tensor, Tensor, Tensor]] = {}
-        self.use_cache = False
         self.length = length
         self.iid = iid
         self.pad_size = pad_size
@@ -47,9 +106,31 @@ class ImagePVRDataset(Dataset):
             assert (
                 len(self.base_dataset) >= 4 * self.length
             ), "Dataset is too small for non-iid mode"
+        self.store = ImageStore.from_dataset(base_dataset, pad_size)
+        self.class_map_table = t.zeros(max(class_map) + 1, dtype=t.long)
+        for label, pointer in class_map.items():
+            self.class_map_table[label] = pointer
+        self.cache: Optional[LRUSampleCache | SlotSampleCache] = None
+        if use_cache:
+            channels, height, width = self.store.images.shape[1:]
+            self.cache = make_sample_cache(
+                cache_backend,
+                fields=[((3 if channels == 1 else channels, 2 * height, 2 * width), t.uint8), ((), t.long), ((4,), t.long)],
+                length=length,
+                max_bytes=cache_max_bytes,
+                path=None if cache_dir is None else os.path.join(cache_dir, f"pvr_{self.get_fingerprint()}"),
+            )
         self.input_shape: Optional[t.Size] = None
         self.set_input_shape(self[0][0].unsqueeze(0).shape)
 
+    def get_fingerprint(self) -> str:
+        """Hash of everything that determines the samples."""
+        config = [self.seed, self.length, self.iid, self.pad_size, self.unique_per_quad, sorted(self.class_map.items())]
+        digest = hashlib.sha256(json.dumps(config).encode())
+        digest.update(self.store.images.numpy().tobytes())
+        digest.update(self.store.labels.numpy().tobytes())
+        return digest.hexdigest()[:16]
+
     def set_input_shape(self, shape: t.Size) -> None:
         self.input_shape = shape
 
@@ -80,48 +161,62 @@ class ImagePVRDataset(Dataset):
         new_label = t.tensor(intermediate_vars[pointer].item())
         return new_label
 
-    def __getitem__(self, index: int) -> tuple[Tensor, Tensor, Tensor]:
-        if index in self.cache and self.use_cache:
-            return self.cache[index]
+    def get_labels_from_intermediate(self, intermediate_vars: Tensor) -> Tensor:
+        """Batched make_label_from_intermediate over (B, 4) intermediate vars."""
+        pointers = self.class_map_table.to(intermediate_vars.device)[intermediate_vars[:, 0]]
+        return intermediate_vars.gather(1, pointers[:, None])[:, 0]
+
+    def get_source_indices(self, index: int) -> np.ndarray:
+        """Indices into the base dataset of the four quadrants of sample index."""
         if self.iid:
             self.rng = np.random.default_rng(self.seed * self.length + index)
-            base_items = [
-                self.base_dataset[self.rng.integers(0, len(self.base_dataset))]
-                for i in range(4)
-            ]
+            source = self.rng.integers(0, len(self.store), size=4)
         else:
-            base_items = [self.base_dataset[i] for i in range(index * 4, index * 4 + 4)]
+            source = np.arange(index * 4, index * 4 + 4)
 
         if self.unique_per_quad:
             # keep sampling until we get 4 different classes
-            while len(set([item[1] for item in base_items])) < 4:
-                base_items = [
-                    self.base_dataset[self.rng.integers(0, len(self.base_dataset))]
-                    for i in range(4)
-                ]
-
-        images = [base_item[0] for base_item in base_items]
-        if self.pad_size > 0:
-            images = [
-                ImageOps.expand(image, border=self.pad_size, fill="black")
-                for image in images
-            ]
-            # print(f"Padding images by {self.pad_size}")
-        new_image = self.concatenate_2x2(images)
-        new_image_output = torchvision.transforms.functional.to_tensor(new_image)
-
-        base_label = base_items[0][1]
-        pointer = self.class_map[base_label]
-        new_label = t.tensor(base_items[pointer][1])
-        intermediate_vars = t.tensor([base_items[i][1] for i in range(4)], dtype=t.long)
-        new_label_from_func = self.make_label_from_intermediate(intermediate_vars)
-        assert (
-            new_label == new_label_from_func
-        ), f"new_label: {new_label}; new_label_from_func: {new_label_from_func}"
-        ret = new_image_output, new_label, intermediate_vars
-        if self.use_cache:
-            self.cache[index] = ret
-        return ret
+            while len(set(self.store.labels[source].tolist())) < 4:
+                source = self.rng.integers(0, len(self.store), size=4)
+        return source
+
+    def compose(self, source: Tensor) -> Tensor:
+        """
+        Composes the (B, 4) quadrant indices into (B, 3, 2H, 2W) uint8 images,
+        with quadrants in the order top left, top right, bottom left, bottom right.
+        """
+        quads = self.store.images[source]  # B 4 C H W
+        if quads.shape[2] == 1:
+            quads = quads.expand(-1, -1, 3, -1, -1)
+        top = t.cat([quads[:, 0], quads[:, 1]], dim=-1)
+        bottom = t.cat([quads[:, 2], quads[:, 3]], dim=-1)
+        return t.cat([top, bottom], dim=-2)
+
+    def get_batch(self, indices: list[int], as_uint8: bool = False) -> tuple[Tensor, Tensor, Tensor]:
+        """Returns the stacked images, labels and intermediate vars of the samples at indices."""
+        source = t.from_numpy(np.stack([self.get_source_indices(index) for index in indices]))
+        intermediate_vars = self.store.labels[source]
+        labels = self.get_labels_from_intermediate(intermediate_vars)
+        images = self.compose(source)
+        return images if as_uint8 else images.float().div(255), labels, intermediate_vars
+
+    def __getitems__(self, indices: list[int]) -> list[tuple[Tensor, Tensor, Tensor]]:
+        items = {}
+        for index in indices:
+            cached = self.cache.get(index) if self.cache is not None else None
+            if cached is not None:
+                items[index] = cached
+        missing = [index for index in indices if index not in items]
+        if missing:
+            images, labels, intermediate_vars = self.get_batch(missing, as_uint8=True)
+            for i, index in enumerate(missing):
+                items[index] = images[i], labels[i], intermediate_vars[i]
+                if self.cache is not None:
+                    self.cache.put(index, items[index])
+        return [(items[index][0].float().div(255), items[index][1], items[index][2]) for index in indices]
+
+    def __getitem__(self, index: int) -> tuple[Tensor, Tensor, Tensor]:
+        return self.__getitems__([index])[0]
 
     def __len__(self) -> int:
         return self.length
@@ -136,29 +231,42 @@ class ImagePVRDataset(Dataset):
         """
         Patches the input and label to be compatible with the PVR model.
         """
-        # sample new image until image at pointer is different from the original
-        new_input = input.clone().detach()
-        while True:
-            quad_items = self.base_dataset[self.rng.integers(0, len(self.base_dataset))]
-            quad_image = quad_items[0]
-            if self.pad_size > 0:
-                quad_image = ImageOps.expand(
-                    quad_image, border=self.pad_size, fill="black"
-                )
-            quad_image = torchvision.transforms.functional.to_tensor(quad_image).to(
-                input.device
-            )
-            if quad_image.shape[0] == 1:
-                quad_image = quad_image.repeat(3, 1, 1)
-            quad_label = quad_items[1]
-            if quad_label != intermediate_var[idx_to_intermediate]:
-                new_input[idx.as_index] = quad_image
-                new_intermediate_var = intermediate_var.clone().detach()
-                new_intermediate_var[idx_to_intermediate] = quad_label
-                new_label = self.make_label_from_intermediate(new_intermediate_var)
-                break
-
-        return new_input, new_intermediate_var, new_label
+        new_input, new_label, new_intermediate_var = self.patch_quadrant(
+            input[None], intermediate_var[None], idx, idx_to_intermediate
+        )
+        return new_input[0], new_intermediate_var[0], new_label[0]
+
+    def patch_quadrant(
+        self,
+        inputs: Tensor,
+        intermediate_vars: Tensor,
+        idx: TorchIndex,
+        idx_to_intermediate: int,
+    ) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        Replaces quadrant idx of every input with a base image whose label differs from
+        intermediate_vars[:, idx_to_intermediate], drawn directly from the other labels.
+        Returns the patched inputs, labels and intermediate vars.
+        """
+        source = self.store.sample_excluding_labels(intermediate_vars[:, idx_to_intermediate], self.rng)
+        quads = self.store.images[source]
+        if quads.shape[1] == 1:
+            quads = quads.expand(-1, 3, -1, -1)
+        new_inputs = inputs.clone().detach()
+        new_inputs[(slice(None), *idx.as_index)] = quads.to(inputs.device).float().div(255)
+        new_intermediate_vars = intermediate_vars.clone().detach()
+        new_intermediate_vars[:, idx_to_intermediate] = self.store.labels[source].to(intermediate_vars.device)
+        return new_inputs, self.get_labels_from_intermediate(new_intermediate_vars), new_intermediate_vars
+
+    def patch_batch_tensors_at_hl(
+        self, inputs: Tensor, intermediate_vars: Tensor, hl_node: HLNode
+    ) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        Patches a batch of inputs (B, 3, H, W) with (B, 4) intermediate vars at hl_node.
+        Returns the patched inputs, labels and intermediate vars.
+        """
+        idx, idx_to_intermediate = self.get_idx_and_intermediate(hl_node)
+        return self.patch_quadrant(inputs, intermediate_vars, idx, idx_to_intermediate)
 
     def patch_batch_at_hl(
         self, batch: list, intermediate_vars: list, hl_node: HLNode
@@ -166,18 +274,10 @@ class ImagePVRDataset(Dataset):
         """
         Patches the input and label to be compatible with the PVR model.
         """
-        idx, idx_to_intermediate = self.get_idx_and_intermediate(hl_node)
-        new_batch = []
-        new_intermediate_vars = []
-        new_labels = []
-        for i in range(len(batch)):
-            new_in, new_vars, new_label = self.patch_at_hl_idx(
-                batch[i], intermediate_vars[i], idx, idx_to_intermediate
-            )
-            new_batch.append(new_in)
-            new_intermediate_vars.append(new_vars)
-            new_labels.append(new_label)
-        return new_batch, new_labels, new_intermediate_vars
+        new_batch, new_labels, new_intermediate_vars = self.patch_batch_tensors_at_hl(
+            t.stack(batch), t.stack(intermediate_vars), hl_node
+        )
+        return list(new_batch), list(new_labels), list(new_intermediate_vars)
 
     def get_idx_and_intermediate(self, hl_node: HLNode) -> tuple[TorchIndex, int]:
         input_shape = self.get_input_shape()
@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Optional
 import torch as t
 from torch import Tensor
 from transformer_lens.hook_points import HookedRootModule, HookPoint
@@ -46,8 +46,35 @@ class MNIST_PVR_HL(HookedRootModule, HLModel):
         else:
             raise NotImplementedError(name)
 
+    def supports_dual_batch_intervention(self) -> bool:
+        return True
+
     def forward(self, args: tuple[t.Any, t.Any, Tensor]) -> Tensor:
         _, _, intermediate_data = args
+        return self._run_from_intermediate(intermediate_data)
+
+    def run_dual_batch_intervention(
+        self,
+        base_input: tuple[t.Any, t.Any, Tensor],
+        ablation_input: tuple[t.Any, t.Any, Tensor],
+        hl_node: HLNode,
+    ) -> Tensor:
+        _, _, base_intermediate_data = base_input
+        _, _, ablation_intermediate_data = ablation_input
+        intermediate_data = t.cat([base_intermediate_data, ablation_intermediate_data], dim=0)
+        return self._run_from_intermediate(
+            intermediate_data, intervention=(hl_node, base_intermediate_data.shape[0])
+        )
+
+    def _run_from_intermediate(
+        self,
+        intermediate_data: Tensor,
+        intervention: Optional[tuple[HLNode, int]] = None,
+    ) -> Tensor:
+        """
+        If intervention=(hl_node, batch) is given, intermediate_data holds the base batch
+        followed by the ablation batch, and hl_node is patched from the ablation rows into the base rows.
+        """
         # print([a.shape for a in args])
         tl, tr, bl, br = [intermediate_data[:, i] for i in range(4)]
         # print(f"intermediate_data is a {type(intermediate_data)}; tl is a {type(tl)}")
@@ -55,6 +82,15 @@ class MNIST_PVR_HL(HookedRootModule, HLModel):
         tr = self.hook_tr(tr)
         bl = self.hook_bl(bl)
         br = self.hook_br(br)
+        if intervention is not None:
+            hl_node, batch = intervention
+            quadrants = {"hook_tl": tl, "hook_tr": tr, "hook_bl": bl, "hook_br": br}
+            for name, value in quadrants.items():
+                patched = value[:batch]
+                if hl_node.name == name:
+                    patched[hl_node.index.as_index] = value[batch:][hl_node.index.as_index]
+                quadrants[name] = patched
+            tl, tr, bl, br = quadrants.values()
         pointer = self.class_map[(tl,)] - 1
         # TODO fix to support batching
         tr_bl_br = t.stack([tr, bl, br], dim=0)
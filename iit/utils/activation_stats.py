@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+from functools import partial
+from typing import Any, Iterable, Optional
+
+import torch as t
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset, default_collate
+from tqdm import tqdm
+
+from transformer_lens.hook_points import HookPoint # type: ignore
+
+from iit.model_pairs.ll_model import LLModel
+from iit.utils.config import DEVICE
+from iit.utils.iit_dataset import IITDataset, move_to_device
+
+
+class ActivationMoments:
+    """
+    Exact running mean and variance of activations over samples, updated one batch at a time
+    (Chan et al.'s parallel update), so that batches of any size are weighted by their sample count.
+    Accumulates in dtype, e.g. float64 for long runs over large datasets.
+    """
+
+    def __init__(self, dtype: t.dtype = t.float32):
+        self.dtype = dtype
+        # dtype of the activations, that the mean is cast back to
+        self.activation_dtype = dtype
+        self.count = 0
+        self.mean: Optional[Tensor] = None
+        self.m2: Optional[Tensor] = None
+
+    def update(self, batch: Tensor) -> None:
+        """Adds a batch of activations, with samples along the first dimension."""
+        if self.mean is None:
+            self.activation_dtype = batch.dtype
+        batch = batch.detach().to(self.dtype)
+        batch_count = batch.shape[0]
+        if batch_count == 0:
+            return
+        batch_mean = batch.mean(dim=0)
+        batch_m2 = ((batch - batch_mean) ** 2).sum(dim=0)
+        if self.mean is None or self.m2 is None:
+            self.count, self.mean, self.m2 = batch_count, batch_mean, batch_m2
+            return
+        if batch_mean.shape != self.mean.shape:
+            raise ValueError(
+                f"Activation shape {tuple(batch_mean.shape)} does not match {tuple(self.mean.shape)}, "
+                "means over inputs of different lengths are not supported"
+            )
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (batch_count / count)
+        self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * batch_count / count)
+        self.count = count
+
+    @property
+    def variance(self) -> Tensor:
+        """Population variance."""
+        assert self.m2 is not None, ValueError("No activations were added")
+        return self.m2 / self.count
+
+    def state_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "activation_dtype": str(self.activation_dtype).removeprefix("torch."),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "ActivationMoments":
+        moments = cls(state["mean"].dtype)
+        moments.count, moments.mean, moments.m2 = state["count"], state["mean"], state["m2"]
+        moments.activation_dtype = getattr(t, state["activation_dtype"])
+        return moments
+
+
+def get_weights_fingerprint(model: t.nn.Module | LLModel) -> str:
+    """Hash of the names, shapes, dtypes and values of model's state dict."""
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(json.dumps([name, list(tensor.shape), str(tensor.dtype)]).encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(t.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def get_base_inputs(batch: tuple | list) -> Tensor:
+    """The model input of a batch of an IITDataset (base_input[0]), or of (x, ...) samples."""
+    base_input = batch[0]
+    if isinstance(base_input, (tuple, list)):
+        return base_input[0]
+    return base_input
+
+
+def collate_to_device(batch: list, device: t.device = DEVICE) -> Any:
+    return move_to_device(default_collate(batch), device)
+
+
+def make_ordered_loader(dataset: Dataset, batch_size: int) -> DataLoader:
+    """
+    Unshuffled loader, collating IITDatasets with their own collate function and
+    other datasets with the default one, onto DEVICE.
+    """
+    if isinstance(dataset, IITDataset):
+        collate_fn = dataset.get_loader_collate_fn()
+    else:
+        collate_fn = partial(collate_to_device, device=DEVICE)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+
+
+def get_dataset_fingerprint(dataset: Dataset, batch_size: int = 256) -> str:
+    """
+    Hash of the base inputs of dataset, in order. Uses dataset.get_fingerprint() instead if the
+    dataset has one, since hashing needs a pass over the data.
+    """
+    if hasattr(dataset, "get_fingerprint"):
+        return dataset.get_fingerprint()
+    digest = hashlib.sha256()
+    for batch in make_ordered_loader(dataset, batch_size):
+        x = get_base_inputs(batch)
+        digest.update(json.dumps([list(x.shape), str(x.dtype)]).encode())
+        digest.update(x.cpu().contiguous().view(-1).view(t.uint8).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def get_activation_moments(
+    model: t.nn.Module | LLModel,
+    dataset: Dataset,
+    hook_names: Optional[Iterable[str]] = None,
+    batch_size: int = 256,
+    dtype: t.dtype = t.float32,
+    cache_dir: Optional[str] = None,
+) -> dict[str, ActivationMoments]:
+    """
+    Streams the base inputs of dataset through the hooked model and accumulates the moments
+    of the activations at hook_names (default: every hook point), without caching them.
+    With cache_dir, the moments are saved there under a key of the model weights, the dataset,
+    the hook names and dtype, and loaded instead of recomputed by later calls with the same key.
+    """
+    hook_names = None if hook_names is None else sorted(set(hook_names))
+    path = None
+    if cache_dir is not None:
+        key = {
+            "weights": get_weights_fingerprint(model),
+            "dataset": get_dataset_fingerprint(dataset, batch_size),
+            "hook_names": hook_names,
+            "dtype": str(dtype),
+        }
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, f"activation_moments_{digest}.pt")
+        if os.path.exists(path):
+            saved = t.load(path)
+            return {name: ActivationMoments.from_state_dict(state) for name, state in saved.items()}
+
+    moments: dict[str, ActivationMoments] = {}
+
+    def moments_hook(hook_point_out: Tensor, hook: HookPoint) -> None:
+        if hook.name not in moments:
+            moments[hook.name] = ActivationMoments(dtype)
+        moments[hook.name].update(hook_point_out)
+
+    names = set(hook_names) if hook_names is not None else None
+    with t.no_grad():
+        for batch in tqdm(make_ordered_loader(dataset, batch_size)):
+            model.run_with_hooks(
+                get_base_inputs(batch),
+                fwd_hooks=[(lambda name: names is None or name in names, moments_hook)],
+            )
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        t.save({name: m.state_dict() for name, m in moments.items()}, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return moments
@@ -0,0 +1,263 @@
+import json
+import os
+import shutil
+from typing import Iterable, Iterator, Optional, Sequence, cast, Sized
+
+import numpy as np
+import torch as t
+from torch import Tensor
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from transformer_lens.hook_points import HookPoint # type: ignore
+
+from iit.model_pairs.ll_model import LLModel
+from iit.utils.activation_stats import (
+    ActivationMoments,
+    get_base_inputs,
+    get_dataset_fingerprint,
+    get_weights_fingerprint,
+    make_ordered_loader,
+)
+
+ACTIVATION_STORE_VERSION = 1
+
+
+class IndexedDataset(Dataset):
+    """Returns (index, *sample) for the samples of dataset, to look up stored activations by index."""
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index: int) -> tuple:
+        return (index, *self.dataset[index])
+
+    def __getitems__(self, indices: list[int]) -> list[tuple]:
+        if hasattr(self.dataset, "__getitems__"):
+            samples = self.dataset.__getitems__(indices)
+        else:
+            samples = [self.dataset[index] for index in indices]
+        return [(index, *sample) for index, sample in zip(indices, samples)]
+
+    def __len__(self) -> int:
+        return len(cast(Sized, self.dataset))
+
+
+class ActivationStore:
+    """
+    Activations of a model at a set of hook points over a dataset, in dataset order.
+    Each hook's activations are split into .npy chunks of chunk_size samples under
+    path/<hook_name>/, and path/manifest.json records their shapes and dtypes along with
+    fingerprints of the model weights and the dataset, so a store is only reused for the
+    model and dataset it was built from.
+    Chunks are memory-mapped copy-on-write, and returned as tensors sharing memory with the file.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != ACTIVATION_STORE_VERSION:
+            raise ValueError(f"Unsupported activation store version {self.manifest['version']} in {path}")
+        self.path = path
+        self._chunks: dict[tuple[str, int], Tensor] = {}
+
+    def __len__(self) -> int:
+        return self.manifest["length"]
+
+    @property
+    def chunk_size(self) -> int:
+        return self.manifest["chunk_size"]
+
+    @property
+    def hook_names(self) -> list[str]:
+        return list(self.manifest["hooks"].keys())
+
+    @property
+    def n_chunks(self) -> int:
+        return -(-len(self) // self.chunk_size)
+
+    def get_dtype(self, hook_name: str) -> t.dtype:
+        return getattr(t, self.manifest["hooks"][hook_name]["dtype"])
+
+    def get_chunk(self, hook_name: str, chunk: int) -> Tensor:
+        """Activations of samples [chunk * chunk_size, (chunk + 1) * chunk_size), without copying."""
+        key = (hook_name, chunk)
+        if key not in self._chunks:
+            array = np.load(os.path.join(self.path, hook_name, f"chunk_{chunk:05d}.npy"), mmap_mode="c")
+            tensor = t.from_numpy(array)
+            if self.get_dtype(hook_name) == t.bfloat16:
+                tensor = tensor.view(t.bfloat16)
+            self._chunks[key] = tensor
+        return self._chunks[key]
+
+    def iter_chunks(self, hook_name: str) -> Iterator[Tensor]:
+        for chunk in range(self.n_chunks):
+            yield self.get_chunk(hook_name, chunk)
+
+    def get(self, hook_name: str, indices: Tensor | Sequence[int] | slice) -> Tensor:
+        """
+        Activations of the samples at indices. A contiguous slice within one chunk is a view
+        of the file; anything else is gathered into a new tensor.
+        """
+        if isinstance(indices, slice):
+            start, stop, step = indices.indices(len(self))
+            if step == 1 and stop > start and start // self.chunk_size == (stop - 1) // self.chunk_size:
+                chunk = start // self.chunk_size
+                offset = chunk * self.chunk_size
+                return self.get_chunk(hook_name, chunk)[start - offset : stop - offset]
+            indices = range(start, stop, step)
+        index_tensor = t.as_tensor(indices, dtype=t.long).cpu()
+        chunk_ids = index_tensor // self.chunk_size
+        first = self.get_chunk(hook_name, 0)
+        out = t.empty((len(index_tensor), *first.shape[1:]), dtype=first.dtype)
+        for chunk in chunk_ids.unique().tolist():
+            in_chunk = chunk_ids == chunk
+            out[in_chunk] = self.get_chunk(hook_name, chunk)[index_tensor[in_chunk] - chunk * self.chunk_size]
+        return out
+
+    def get_moments(self, hook_name: str, dtype: t.dtype = t.float32) -> ActivationMoments:
+        moments = ActivationMoments(dtype)
+        for chunk in self.iter_chunks(hook_name):
+            moments.update(chunk)
+        return moments
+
+    def matches(
+        self,
+        weights_fingerprint: str,
+        dataset_fingerprint: str,
+        hook_names: Iterable[str],
+        dtype: Optional[t.dtype] = None,
+    ) -> bool:
+        if self.manifest["weights"] != weights_fingerprint or self.manifest["dataset"] != dataset_fingerprint:
+            return False
+        hook_names = list(hook_names)
+        if not set(hook_names) <= set(self.hook_names):
+            return False
+        return dtype is None or all(self.get_dtype(name) == dtype for name in hook_names)
+
+    @classmethod
+    def build(
+        cls,
+        model: t.nn.Module | LLModel,
+        dataset: Dataset,
+        path: str,
+        hook_names: Iterable[str],
+        batch_size: int = 256,
+        chunk_size: int = 4096,
+        dtype: Optional[t.dtype] = None,
+        weights_fingerprint: Optional[str] = None,
+        dataset_fingerprint: Optional[str] = None,
+    ) -> "ActivationStore":
+        """
+        Runs model once over the base inputs of dataset (see get_activation_moments) and writes
+        the activations at hook_names to path, cast to dtype if given (e.g. t.float16 to halve the size).
+        """
+        assert chunk_size > 0, ValueError(f"Expected a positive chunk size, got {chunk_size}")
+        hook_names = sorted(set(hook_names))
+        length = len(cast(Sized, dataset))
+        os.makedirs(path, exist_ok=True)
+        # a partially rewritten store must not be opened
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            os.remove(os.path.join(path, "manifest.json"))
+        for name in hook_names:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            os.makedirs(os.path.join(path, name))
+
+        hooks: dict[str, dict] = {}
+        chunks: dict[str, np.memmap] = {}
+        written = {name: 0 for name in hook_names}
+
+        def write(name: str, activations: Tensor) -> None:
+            activations = activations.detach().to("cpu", dtype or activations.dtype)
+            if name not in hooks:
+                hooks[name] = {
+                    "shape": list(activations.shape[1:]),
+                    "dtype": str(activations.dtype).removeprefix("torch."),
+                }
+            elif list(activations.shape[1:]) != hooks[name]["shape"]:
+                raise ValueError(
+                    f"Activation shape {list(activations.shape[1:])} at {name} does not match "
+                    f"{hooks[name]['shape']}, inputs of different lengths are not supported"
+                )
+            if activations.dtype == t.bfloat16:
+                # numpy has no bfloat16, its bits are stored as int16
+                activations = activations.view(t.int16)
+            array = activations.numpy()
+            position = 0
+            while position < len(array):
+                chunk, offset = divmod(written[name], chunk_size)
+                if offset == 0:
+                    chunks[name] = np.lib.format.open_memmap(  # type: ignore[no-untyped-call]
+                        os.path.join(path, name, f"chunk_{chunk:05d}.npy"),
+                        mode="w+",
+                        dtype=array.dtype,
+                        shape=(min(chunk_size, length - written[name]), *array.shape[1:]),
+                    )
+                n = min(len(array) - position, chunk_size - offset)
+                chunks[name][offset : offset + n] = array[position : position + n]
+                written[name] += n
+                position += n
+
+        def store_hook(hook_point_out: Tensor, hook: HookPoint) -> None:
+            write(hook.name, hook_point_out)
+
+        names = set(hook_names)
+        with t.no_grad():
+            for batch in tqdm(make_ordered_loader(dataset, batch_size), desc="Storing activations"):
+                model.run_with_hooks(
+                    get_base_inputs(batch),
+                    fwd_hooks=[(lambda name: name in names, store_hook)],
+                )
+        for name in hook_names:
+            if written[name] != length:
+                raise ValueError(f"Stored {written[name]} activations at {name}, expected {length}")
+        for array in chunks.values():
+            array.flush()
+        chunks.clear()
+
+        manifest = {
+            "version": ACTIVATION_STORE_VERSION,
+            "weights": weights_fingerprint or get_weights_fingerprint(model),
+            "dataset": dataset_fingerprint or get_dataset_fingerprint(dataset, batch_size),
+            "length": length,
+            "chunk_size": chunk_size,
+            "hooks": {name: hooks[name] for name in hook_names},
+        }
+        # the manifest is written last, so an interrupted build is redone
+        with open(os.path.join(path, "manifest.json.tmp"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(os.path.join(path, "manifest.json.tmp"), os.path.join(path, "manifest.json"))
+        return cls(path)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        model: t.nn.Module | LLModel,
+        dataset: Dataset,
+        path: str,
+        hook_names: Iterable[str],
+        batch_size: int = 256,
+        chunk_size: int = 4096,
+        dtype: Optional[t.dtype] = None,
+    ) -> "ActivationStore":
+        """Opens the store at path if it was built from model and dataset with hook_names, else builds it."""
+        hook_names = list(hook_names)
+        weights_fingerprint = get_weights_fingerprint(model)
+        dataset_fingerprint = get_dataset_fingerprint(dataset, batch_size)
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            try:
+                store = cls(path)
+            except ValueError:
+                store = None
+            if store is not None and store.matches(weights_fingerprint, dataset_fingerprint, hook_names, dtype):
+                return store
+        return cls.build(
+            model,
+            dataset,
+            path,
+            hook_names,
+            batch_size=batch_size,
+            chunk_size=chunk_size,
+            dtype=dtype,
+            weights_fingerprint=weights_fingerprint,
+            dataset_fingerprint=dataset_fingerprint,
+        )
@@ -12,6 +12,7 @@ class IOIArgParseNamespace:
     device: str = "cuda" if t.cuda.is_available() else "cpu"
     batch_size: int = 512
     next_token: bool = False
+    compact_vocab: bool = False
 
     # eval 
     weights: str = "100_100_40"
@@ -1,5 +1,6 @@
-from typing import Callable, Optional
+from typing import Callable, Iterable, Optional
 import os
+from dataclasses import dataclass
 from enum import Enum
 from typing import Dict, List, Literal
 
@@ -8,15 +9,20 @@ import pandas as pd
 import torch as t
 from torch import Tensor
 from tqdm import tqdm
-from transformer_lens import HookedTransformer
+from transformer_lens import ActivationCache, HookedTransformer
 from transformer_lens.HookedTransformer import HookPoint
 
 import iit.utils.index as index
 from iit.model_pairs.base_model_pair import BaseModelPair
+from iit.model_pairs.ll_model import LLModel
+from iit.utils.activation_stats import get_activation_moments
+from iit.utils.activation_store import ActivationStore
 from iit.utils.eval_datasets import IITUniqueDataset
 from iit.utils.nodes import LLNode
-from iit.utils.eval_metrics import kl_div
+from iit.utils.eval_metrics import get_label_ids, kl_div
 from iit.utils.iit_dataset import IITDataset
+from iit.utils.node_sweep import NodeSweep
+from iit.utils.subspace import patch_subspace, project_onto_subspace
 from iit.utils.node_picker import (
     get_all_individual_nodes_in_circuit,
     get_all_nodes,
@@ -48,7 +54,7 @@ def do_intervention(
         node: LLNode
         hook_fn: callable
     """
-    _, cache = model_pair.ll_model.run_with_cache(ablation_input)
+    _, cache = model_pair.ll_model.run_with_cache(ablation_input, names_filter=[node.name])
     model_pair.ll_cache = cache  # TODO: make this better when converting to script
     out = model_pair.ll_model.run_with_hooks(
         base_input, fwd_hooks=[(node.name, hook_fn)]
@@ -56,6 +62,45 @@ def do_intervention(
     return out
 
 
+@dataclass
+class AblationBatch:
+    """Node independent results of a batch, shared by every node ablated on it."""
+    base_in: tuple[Tensor, Tensor, Tensor]
+    ablation_in: tuple[Tensor, Tensor, Tensor]
+    ablation_cache: ActivationCache
+    base_ll_out: Tensor
+    base_hl_out: Tensor
+    corrupted_ll_out: Optional[Tensor] = None
+
+
+def make_ablation_batch(
+    model_pair: BaseModelPair,
+    base_in: tuple[Tensor, Tensor, Tensor],
+    ablation_in: tuple[Tensor, Tensor, Tensor],
+    hook_names: Iterable[str],
+    categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
+) -> AblationBatch:
+    """
+    Runs the forward passes resample_ablate_node needs besides the patched one: the ablation
+    cache of hook_names, the clean ll and hl outputs and, for the KL metrics, the corrupted ll output.
+    """
+    _, cache = model_pair.ll_model.run_with_cache(ablation_in[0], names_filter=list(set(hook_names)))
+    corrupted_ll_out = None
+    if model_pair.hl_model.is_categorical() and categorical_metric in [
+        Categorical_Metric.KL,
+        Categorical_Metric.KL_SELF,
+    ]:
+        corrupted_ll_out = model_pair.ll_model(ablation_in[0]).squeeze()
+    return AblationBatch(
+        base_in=base_in,
+        ablation_in=ablation_in,
+        ablation_cache=cache,
+        base_ll_out=model_pair.ll_model(base_in[0]).squeeze(),
+        base_hl_out=model_pair.hl_model(base_in).squeeze(),
+        corrupted_ll_out=corrupted_ll_out,
+    )
+
+
 # TODO: change name to reflect that it's not just for resampling
 def resample_ablate_node(
     model_pair: BaseModelPair,
@@ -66,114 +111,135 @@ def resample_ablate_node(
     atol: float = 5e-2,
     verbose: bool = False,
     categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
+    ablation_batch: Optional[AblationBatch] = None,
 ) -> float:  
-    base_x, base_y = base_in[0:2]
-    ablation_x, ablation_y = ablation_in[0:2]
-    ll_out = do_intervention(model_pair, base_x, ablation_x, node, hook_fn)
-    base_ll_out = model_pair.ll_model(base_x).squeeze()  # not used for result
-    base_hl_out = model_pair.hl_model(base_in).squeeze()
+    """
+    Pass an ablation_batch from make_ablation_batch (with node.name among its hook names)
+    to reuse it across nodes; otherwise it is computed for this node alone.
+    """
+    if ablation_batch is None:
+        ablation_batch = make_ablation_batch(
+            model_pair, base_in, ablation_in, [node.name], categorical_metric
+        )
+    model_pair.ll_cache = ablation_batch.ablation_cache
+    ll_out = model_pair.ll_model.run_with_hooks(
+        base_in[0], fwd_hooks=[(node.name, hook_fn)]
+    )
     if verbose:
         print(node)
+    return get_resample_ablation_effect(
+        model_pair, ll_out, ablation_batch, atol, verbose, categorical_metric
+    )
+
+
+def get_resample_ablation_effects(
+    model_pair: BaseModelPair,
+    ll_outs: Tensor,
+    ablation_batch: AblationBatch,
+    atol: float = 5e-2,
+    categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
+) -> Tensor:
+    """
+    For each node's patched output ll_outs[k] on the batch, the fraction of the samples whose
+    label changes under the ablation where the ll output changes too (or the normalized KL
+    divergence over those samples, for the KL metrics). Returns a tensor of shape (len(ll_outs),).
+    """
+    n_nodes = ll_outs.shape[0]
+    base_y = ablation_batch.base_in[1]
+    ablation_y = ablation_batch.ablation_in[1]
+    base_ll_out = ablation_batch.base_ll_out
+    base_hl_out = ablation_batch.base_hl_out
 
     if model_pair.hl_model.is_categorical():
         label_idx = model_pair.get_label_idxs()
-        base_label = t.argmax(base_y, dim=-1)[label_idx.as_index]
-        ablation_label = t.argmax(ablation_y, dim=-1)[label_idx.as_index]
-        label_unchanged = base_label == ablation_label
-
-        if categorical_metric == Categorical_Metric.KL:
-            kl = kl_div(ll_out, base_hl_out, label_idx)
-            corrupted_output = model_pair.ll_model(ablation_in[0]).squeeze()
-            kl_div_clean = kl_div(base_ll_out, base_hl_out, label_idx)
-            kl_div_corrupted = kl_div(corrupted_output, base_hl_out, label_idx)
-            # normalize by the kl divergence of the corrupted output
-            kl = (kl - kl_div_clean) / (kl_div_corrupted - kl_div_clean + 1e-12)
-            result = (kl * (~label_unchanged).float()).sum().item() / (
-                (~label_unchanged).float().sum().item() + 1e-12
-            )
-
-            if verbose:
-                kl_old_vs_new = kl_div(ll_out, base_ll_out, label_idx)
-                print("kl base_hl vs ll_out: ", kl.mean().item())
-                print("kl base_ll vs ll_out: ", kl_old_vs_new.mean().item())
-                # check if ll_out and base_ll_out are the same
-                print(
-                    "ll_out == base_ll_out:",
-                    t.isclose(ll_out, base_ll_out, atol=atol).float().mean(),
-                )
-                print(
-                    "fraction of labels changed:",
-                    (~label_unchanged).float().mean(),
-                )
-                print()
-
-        elif categorical_metric == Categorical_Metric.KL_SELF:
-            kl = kl_div(ll_out, base_ll_out, label_idx)
-            corrupted_output = model_pair.ll_model(ablation_x).squeeze()
-            kl_div_corrupted = kl_div(corrupted_output, base_ll_out, label_idx)
-            kl = kl / (
-                kl_div_corrupted + 1e-12
-            )  # normalize by the kl divergence of the corrupted output
-            result = (kl * (~label_unchanged).float()).sum().item() / (
-                (~label_unchanged).float().sum().item() + 1e-12
-            )
+        base_label = get_label_ids(base_y)[label_idx.as_index]
+        ablation_label = get_label_ids(ablation_y)[label_idx.as_index]
+        label_changed = (base_label != ablation_label).float()
+
+        if categorical_metric in [Categorical_Metric.KL, Categorical_Metric.KL_SELF]:
+            corrupted_output = ablation_batch.corrupted_ll_out
+            assert corrupted_output is not None
+            target = base_hl_out if categorical_metric == Categorical_Metric.KL else base_ll_out
+            tiled_target = target.repeat(n_nodes, *([1] * (target.dim() - 1)))
+            kl = kl_div(ll_outs.flatten(0, 1), tiled_target, label_idx)
+            kl = kl.reshape(n_nodes, -1, *kl.shape[1:])
+            if categorical_metric == Categorical_Metric.KL:
+                kl_div_clean = kl_div(base_ll_out, base_hl_out, label_idx)
+                kl_div_corrupted = kl_div(corrupted_output, base_hl_out, label_idx)
+                # normalize by the kl divergence of the corrupted output
+                effects = (kl - kl_div_clean) / (kl_div_corrupted - kl_div_clean + 1e-12)
+            else:
+                kl_div_corrupted = kl_div(corrupted_output, base_ll_out, label_idx)
+                effects = kl / (kl_div_corrupted + 1e-12)
         elif categorical_metric == Categorical_Metric.ACCURACY:
-            # TODO: Move to a function
-            # take argmax of everything
-            ll_out = t.argmax(ll_out, dim=-1)[label_idx.as_index]
-            base_hl_out = t.argmax(base_hl_out, dim=-1)[label_idx.as_index]
-            base_ll_out = t.argmax(base_ll_out, dim=-1)[label_idx.as_index]
-
-            # calculate metrics
-            ll_unchanged = ll_out == base_label
-            ll_out_unchanged = ll_out == base_ll_out  # not used for result
-            accuracy = base_ll_out == base_hl_out  # not used for result
-            changed_result = (~label_unchanged).cpu().float() * (
-                ~ll_unchanged
-            ).cpu().float()
-            result = changed_result.sum().item() / (
-                (~label_unchanged).float().sum().item() + 1e-12
-            )
-
-            if verbose:
-                print(
-                    "label: ",
-                    (~label_unchanged).sum().item() / len(label_unchanged),
-                )
-                print("ll_vs_hl", (~ll_unchanged).sum().item() / len(ll_unchanged))
-                print(
-                    "ll_vs_ll",
-                    (~ll_out_unchanged).sum().item() / len(ll_out_unchanged),
-                )
-                print("accuracy", accuracy.sum().item() / len(accuracy))
+            ll_labels = t.argmax(ll_outs, dim=-1)[(slice(None), *label_idx.as_index)]
+            effects = (ll_labels != base_label).float()
+        else:
+            raise ValueError(f"Unexpected categorical metric: {categorical_metric}")
     else:
-        label_unchanged = base_y == ablation_y
         ll_unchanged = t.isclose(
-            ll_out.float().squeeze(),
-            base_hl_out.float().to(ll_out.device).squeeze(),
+            ll_outs.float().reshape(n_nodes, -1),
+            base_hl_out.float().to(ll_outs.device).reshape(1, -1),
             atol=atol,
         )
-        label_unchanged = label_unchanged.reshape(ll_unchanged.shape)
-        changed_result = (~label_unchanged).cpu().float() * (
-            ~ll_unchanged
-        ).cpu().float()
-        result = changed_result.sum().item() / (
-            (~label_unchanged).float().sum().item() + 1e-12
-        )
+        label_changed = (base_y != ablation_y).reshape(-1).float()
+        effects = (~ll_unchanged).float()
+
+    label_changed = label_changed.to(effects.device)
+    changed_result = (effects * label_changed).reshape(n_nodes, -1).sum(dim=-1)
+    return (changed_result / (label_changed.sum() + 1e-12)).cpu()
 
-        if verbose:
+
+def get_resample_ablation_effect(
+    model_pair: BaseModelPair,
+    ll_out: Tensor,
+    ablation_batch: AblationBatch,
+    atol: float = 5e-2,
+    verbose: bool = False,
+    categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
+) -> float:
+    """get_resample_ablation_effects for the patched output of a single node."""
+    result = get_resample_ablation_effects(
+        model_pair, ll_out.unsqueeze(0), ablation_batch, atol, categorical_metric
+    )[0].item()
+    if not verbose:
+        return result
+
+    base_y = ablation_batch.base_in[1]
+    ablation_y = ablation_batch.ablation_in[1]
+    base_ll_out = ablation_batch.base_ll_out
+    base_hl_out = ablation_batch.base_hl_out
+    if model_pair.hl_model.is_categorical():
+        label_idx = model_pair.get_label_idxs()
+        label_unchanged = (
+            get_label_ids(base_y)[label_idx.as_index] == get_label_ids(ablation_y)[label_idx.as_index]
+        )
+        if categorical_metric == Categorical_Metric.ACCURACY:
+            ll_labels = t.argmax(ll_out, dim=-1)[label_idx.as_index]
+            base_ll_labels = t.argmax(base_ll_out, dim=-1)[label_idx.as_index]
+            base_hl_labels = get_label_ids(base_hl_out)[label_idx.as_index]
+            print("label: ", (~label_unchanged).float().mean().item())
+            print("ll_vs_hl", (ll_labels != get_label_ids(base_y)[label_idx.as_index]).float().mean().item())
+            print("ll_vs_ll", (ll_labels != base_ll_labels).float().mean().item())
+            print("accuracy", (base_ll_labels == base_hl_labels).float().mean().item())
+        else:
+            print("kl base_hl vs ll_out: ", kl_div(ll_out, base_hl_out, label_idx).mean().item())
+            print("kl base_ll vs ll_out: ", kl_div(ll_out, base_ll_out, label_idx).mean().item())
             print(
-                "\nlabel changed:",
-                (~label_unchanged).float().mean(),
-                "\nouts_changed:",
-                (~ll_unchanged).float().mean(),
-                "\ndot product:",
-                changed_result.mean(),
-                "\ndifference:",
-                (ll_out.float().squeeze() - base_y.float().to(ll_out.device)).mean(),
-                "\nfinal:",
-                result,
+                "ll_out == base_ll_out:",
+                t.isclose(ll_out, base_ll_out, atol=atol).float().mean(),
             )
+            print("fraction of labels changed:", (~label_unchanged).float().mean())
+            print()
+    else:
+        print(
+            "\nlabel changed:",
+            (base_y != ablation_y).float().mean(),
+            "\ndifference:",
+            (ll_out.float().squeeze() - base_y.float().to(ll_out.device)).mean(),
+            "\nfinal:",
+            result,
+        )
     return result
 
 
@@ -185,24 +251,85 @@ def check_causal_effect(
     categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
     hook_maker: Optional[Callable] = None,
     verbose: bool = False,
+    node_chunk_size: Optional[int] = None,
+    memory_budget: int = 2**30,
+    nodes: Optional[Iterable[LLNode]] = None,
 ) -> dict[LLNode, float]:
+    """
+    Without a hook_maker, nodes are swept in chunks (see NodeSweep) of node_chunk_size nodes,
+    by default as many as fit in memory_budget bytes of activations.
+    nodes, if given, are checked instead of those of node_type, e.g. the top candidates of
+    check_causal_effect_attribution.
+    """
+    hook_fns = {}
+    results = {}
+    all_nodes = get_resample_ablation_nodes(model_pair, node_type) if nodes is None else list(nodes)
+
+    for node in all_nodes:
+        if hook_maker is not None:
+            hook_fns[node] = hook_maker(node)
+        else:
+            hook_fns[node] = model_pair.make_ll_ablation_hook(node)
+        results[node] = 0.
+
+    hook_names = {node.name for node in hook_fns}
+    sweep = None
+    if hook_maker is None and not verbose:
+        sweep = NodeSweep(list(hook_fns.keys()), node_chunk_size, memory_budget)
+    loader = dataset.make_loader(batch_size=batch_size, num_workers=0)
+    with t.no_grad():
+        for batch in tqdm(loader):
+            base_in, ablation_in = batch[0:2]
+            ablation_batch = make_ablation_batch(
+                model_pair, base_in, ablation_in, hook_names, categorical_metric
+            )
+            if sweep is not None:
+                for chunk, ll_outs in sweep.run(
+                    model_pair.ll_model, base_in[0], lambda name: ablation_batch.ablation_cache[name]
+                ):
+                    effects = get_resample_ablation_effects(
+                        model_pair, ll_outs, ablation_batch, categorical_metric=categorical_metric
+                    )
+                    for node, effect in zip(chunk, effects.tolist()):
+                        results[node] += effect / len(loader)
+                continue
+            for node, hooker in hook_fns.items():
+                result = resample_ablate_node(
+                    model_pair,
+                    base_in,
+                    ablation_in,
+                    node,
+                    hooker,
+                    categorical_metric=categorical_metric,
+                    verbose=verbose,
+                    ablation_batch=ablation_batch,
+                )
+                results[node] += result / len(loader)
+    return results
+
+
+def get_resample_ablation_nodes(model_pair: BaseModelPair, node_type: str) -> list[LLNode]:
+    """Nodes ablated by check_causal_effect for node_type, at the node granularity of model_pair."""
     assert node_type in [
         "a",
         "c",
         "n",
         "individual_c",
     ], "type must be one of 'a', 'c', 'n', or 'individual_c'"
-    hook_fns = {}
-    results = {}
-    all_nodes = (
-        get_nodes_not_in_circuit(model_pair.ll_model, model_pair.corr)
+    granularity = model_pair.get_node_granularity()
+    return (
+        get_nodes_not_in_circuit(model_pair.ll_model, model_pair.corr, **granularity)
         if node_type == "n"
         else (
-            get_all_nodes(model_pair.ll_model)
+            get_all_nodes(
+                model_pair.ll_model,
+                head_dims_per_node=granularity["head_dims_per_node"],
+                mlp_neurons_per_node=granularity["mlp_neurons_per_node"],
+            )
             if node_type == "a"
             else (
                 get_all_individual_nodes_in_circuit(
-                    model_pair.ll_model, model_pair.corr
+                    model_pair.ll_model, model_pair.corr, **granularity
                 )
                 if node_type == "individual_c"
                 else get_nodes_in_circuit(model_pair.corr)
@@ -210,63 +337,174 @@ def check_causal_effect(
         )
     )
 
-    for node in all_nodes:
-        if hook_maker is not None:
-            hook_fns[node] = hook_maker(node)
-        else:
-            hook_fns[node] = model_pair.make_ll_ablation_hook(node)
-        results[node] = 0.
+
+def get_attribution_patching_effects(
+    nodes: list[LLNode],
+    clean_cache: ActivationCache,
+    ablation_cache: ActivationCache,
+    n_changed: Tensor | float,
+) -> Tensor:
+    """
+    First-order estimate, for each node, of the drop in the metric clean_cache's gradients were
+    taken of (see LLModel.run_with_cache) when the node is patched from ablation_cache:
+    -(a_ablation - a_clean) . grad, summed over the node's index and divided by n_changed,
+    the number of samples whose label changes. Returns a tensor of shape (len(nodes),).
+    """
+    effects = []
+    for node in nodes:
+        if node.name not in clean_cache.cache_dict:
+            # the hook point never runs (e.g. attn.hook_result without use_attn_result), so patching it does nothing
+            effects.append(t.zeros(()))
+            continue
+        node_index = node.index if node.index is not None else index.Ix[[None]]
+        delta = (ablation_cache[node.name] - clean_cache[node.name])[node_index.as_index]
+        if node.subspace is not None:
+            delta = project_onto_subspace(delta, node.subspace)
+        grad = clean_cache[node.name + "_grad"][node_index.as_index]
+        effects.append(-(delta * grad).sum().cpu())
+    return t.stack(effects) / (n_changed + 1e-12)
+
+
+def check_causal_effect_attribution(
+    model_pair: BaseModelPair,
+    dataset: IITDataset,
+    batch_size: int = 256,
+    node_type: Literal["a", "c", "n", "individual_c"] = "a",
+    nodes: Optional[Iterable[LLNode]] = None,
+) -> dict[LLNode, float]:
+    """
+    Attribution patching estimate of check_causal_effect, from one corrupted forward and one
+    clean forward and backward per batch instead of a patched forward per node.
+    Per node, it is the first-order drop in the log-probability the ll model gives to the base
+    label, averaged over the samples whose label changes under the ablation. This is in nats,
+    not the fraction of changed outputs check_causal_effect reports, so it is meant for ranking
+    nodes, e.g. to pass only the top candidates to check_causal_effect(nodes=...).
+    The gradients of the ll model's parameters are left as they were.
+    """
+    if not model_pair.hl_model.is_categorical():
+        raise NotImplementedError("Attribution patching is only implemented for categorical hl models")
+    all_nodes = get_resample_ablation_nodes(model_pair, node_type) if nodes is None else list(nodes)
+    hook_names = list({node.name for node in all_nodes})
+    results = {node: 0. for node in all_nodes}
+    ll_model = model_pair.ll_model
+    label_idx = model_pair.get_label_idxs()
+    params = list(ll_model.parameters())
+    # backward accumulates into .grad in place, so the existing gradients are set aside
+    param_grads = [param.grad for param in params]
+    for param in params:
+        param.grad = None
 
     loader = dataset.make_loader(batch_size=batch_size, num_workers=0)
-    for base_in, ablation_in in tqdm(loader):
-        for node, hooker in hook_fns.items():
-            result = resample_ablate_node(
-                model_pair,
-                base_in,
-                ablation_in,
-                node,
-                hooker,
-                categorical_metric=categorical_metric,
-                verbose=verbose,
+    try:
+        for batch in tqdm(loader):
+            base_in, ablation_in = batch[0:2]
+            base_label = get_label_ids(base_in[1])[label_idx.as_index]
+            ablation_label = get_label_ids(ablation_in[1])[label_idx.as_index]
+            label_changed = (base_label != ablation_label).float()
+
+            def metric(ll_out: Tensor) -> Tensor:
+                log_probs = t.log_softmax(ll_out[label_idx.as_index], dim=-1)
+                label = base_label.to(log_probs.device).unsqueeze(-1)
+                base_log_probs = log_probs.gather(-1, label).squeeze(-1)
+                return (base_log_probs * label_changed.to(log_probs.device)).sum()
+
+            with t.no_grad():
+                _, ablation_cache = ll_model.run_with_cache(ablation_in[0], names_filter=hook_names)
+            with t.set_grad_enabled(True):
+                _, clean_cache = ll_model.run_with_cache(
+                    base_in[0], names_filter=hook_names, incl_bwd=True, bwd_metric=metric
+                )
+            effects = get_attribution_patching_effects(
+                all_nodes, clean_cache, ablation_cache, label_changed.sum().item()
             )
-            results[node] += result / len(loader)
+            for node, effect in zip(all_nodes, effects.tolist()):
+                results[node] += effect / len(loader)
+    finally:
+        for param, grad in zip(params, param_grads):
+            param.grad = grad
     return results
 
 
 def get_mean_cache(
         model: BaseModelPair | HookedTransformer, 
         dataset: IITDataset, 
-        batch_size: int = 8
+        batch_size: int = 8,
+        hook_names: Optional[Iterable[str]] = None,
+        dtype: t.dtype = t.float32,
+        cache_dir: Optional[str] = None,
+        activation_store: Optional[ActivationStore] = None,
         ) -> dict[str, Tensor]:
-    loader = dataset.make_loader(batch_size=batch_size, num_workers=0)
-    mean_cache = {}
-    for batch in tqdm(loader):
-        base_x = batch[0]
-        if isinstance(model, BaseModelPair):
-            _, cache = model.ll_model.run_with_cache(base_x)
-        elif isinstance(model, HookedTransformer):
-            _, cache = model.run_with_cache(base_x)
-        else:
-            raise ValueError(
-                f"model must be of type BaseModelPair or HookedTransformer, got {type(model)}"
+    """
+    Returns the exact mean activation, of shape (1, ...), at each of hook_names (default: every hook)
+    over the base inputs of dataset, accumulated in dtype. See get_activation_moments for cache_dir.
+    With an activation_store of model over dataset, the means are computed from it without running the model.
+    """
+    if activation_store is not None:
+        names = activation_store.hook_names if hook_names is None else sorted(set(hook_names))
+        return {
+            name: activation_store.get_moments(name, dtype).mean.unsqueeze(0).to(  # type: ignore[union-attr]
+                activation_store.get_dtype(name)
             )
-        for node, tensor in cache.items():
-            if node not in mean_cache:
-                mean_cache[node] = t.zeros_like(tensor[0].unsqueeze(0))
-            mean_cache[node] += tensor.mean(dim=0).unsqueeze(0) / len(loader)
+            for name in names
+        }
+    if isinstance(model, BaseModelPair):
+        ll_model: LLModel | HookedTransformer = model.ll_model
+    elif isinstance(model, HookedTransformer):
+        ll_model = model
+    else:
+        raise ValueError(
+            f"model must be of type BaseModelPair or HookedTransformer, got {type(model)}"
+        )
+    moments = get_activation_moments(ll_model, dataset, hook_names, batch_size, dtype, cache_dir)
+    mean_cache = {}
+    for name, moment in moments.items():
+        assert moment.mean is not None
+        mean_cache[name] = moment.mean.unsqueeze(0).to(moment.activation_dtype)
     return mean_cache
 
 
+def get_ablation_nodes(model_pair: BaseModelPair, node_type: str) -> list[LLNode]:
+    """Nodes ablated by check_causal_effect_on_ablation for node_type, at the node granularity of model_pair."""
+    assert node_type in [
+        "a",
+        "c",
+        "n",
+        "individual_c",
+    ], "type must be one of 'a', 'c', 'n', or 'individual_c'"
+    granularity = model_pair.get_node_granularity()
+    return (
+        get_nodes_not_in_circuit(model_pair.ll_model, model_pair.corr, **granularity)
+        if node_type == "n"
+        else (
+            get_all_nodes(model_pair.ll_model, model_pair.corr.get_suffixes(), **granularity)
+            if node_type == "a"
+            else (
+                get_all_individual_nodes_in_circuit(
+                    model_pair.ll_model, model_pair.corr, **granularity
+                )
+                if node_type == "individual_c"
+                else get_nodes_in_circuit(model_pair.corr)
+            )
+        )
+    )
+
+
 def make_ablation_hook(
     node: LLNode,
     mean_cache: Optional[dict[str, Tensor]] = None,
     use_mean_cache: bool = True,
 ) -> Callable[[Tensor, HookPoint], Tensor]:
-    if node.subspace is not None:
-        raise NotImplementedError("Subspace not supported yet.")
+    def ablate(hook_point_out: Tensor, source: Tensor | float) -> None:
+        if node.subspace is None:
+            hook_point_out[node.index.as_index] = source
+            return
+        base = hook_point_out[node.index.as_index]
+        hook_point_out[node.index.as_index] = patch_subspace(
+            base, t.as_tensor(source, dtype=base.dtype, device=base.device), node.subspace
+        )
 
     def zero_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
-        hook_point_out[node.index.as_index] = 0
+        ablate(hook_point_out, 0.)
         return hook_point_out
 
     def mean_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
@@ -274,7 +512,7 @@ def make_ablation_hook(
             cached_tensor = mean_cache[node.name]
         else:
             raise ValueError("mean_cache must be a dict when use_mean_cache is True")
-        hook_point_out[node.index.as_index] = cached_tensor[node.index.as_index]
+        ablate(hook_point_out, cached_tensor[node.index.as_index])
         return hook_point_out
 
     if use_mean_cache:
@@ -282,12 +520,26 @@ def make_ablation_hook(
     return zero_hook
 
 
+def get_clean_outputs(
+    model_pair: BaseModelPair,
+    base_input: tuple[Tensor, Tensor, Tensor],
+) -> tuple[Tensor, Tensor]:
+    """Returns the (ll, hl) outputs on base_input without ablations, as used by ablate_nodes."""
+    base_x = base_input[0]
+    if model_pair.hl_model.is_categorical():
+        base_hl_out = model_pair.hl_model(base_x).squeeze()
+    else:
+        base_hl_out = model_pair.hl_model(base_input).squeeze()
+    return model_pair.ll_model(base_x).squeeze(), base_hl_out
+
+
 def ablate_nodes(
     model_pair: BaseModelPair,
     base_input: tuple[Tensor, Tensor, Tensor],
     fwd_hooks: List[tuple[str, Callable]],
     atol: float = 5e-2,
-    relative_change: bool = True
+    relative_change: bool = True,
+    clean_outputs: Optional[tuple[Tensor, Tensor]] = None,
 ) -> Tensor:
     """
     Returns 1 - accuracy of the model after ablating the nodes in fwd_hooks.
@@ -301,43 +553,57 @@ def ablate_nodes(
         relative_change: bool (default: True)
         If relative_change is True, the accuracy is normalized wrt to the accuracy of the model before ablation.
         i.e., we return 1 - accuracy(after ablation | accuracy(before ablation) = 1)
+        clean_outputs: tuple[Tensor, Tensor] (default: None)
+        get_clean_outputs(model_pair, base_input), to share it between calls on the same batch
     """
     base_x = base_input[0]
     ll_out = model_pair.ll_model.run_with_hooks(base_x, fwd_hooks=fwd_hooks)
+    if clean_outputs is None:
+        clean_outputs = get_clean_outputs(model_pair, base_input)
+    return get_ablation_effects(
+        model_pair, ll_out.unsqueeze(0), clean_outputs, atol, relative_change
+    )[0]
+
+
+def get_ablation_effects(
+    model_pair: BaseModelPair,
+    ll_outs: Tensor,
+    clean_outputs: tuple[Tensor, Tensor],
+    atol: float = 5e-2,
+    relative_change: bool = True,
+) -> Tensor:
+    """
+    ablate_nodes for several ablations of the same batch at once, given their outputs
+    ll_outs[k]. Returns a tensor of shape (len(ll_outs),).
+    """
+    n_ablations = ll_outs.shape[0]
+    base_ll_out, base_hl_out = clean_outputs
 
     if model_pair.hl_model.is_categorical():
         # TODO: add other metrics here
-        base_hl_out = model_pair.hl_model(base_x).squeeze()
-        base_ll_out = model_pair.ll_model(base_x).squeeze()
         label_idx = model_pair.get_label_idxs()
-        ll_out = t.argmax(ll_out, dim=-1)[label_idx.as_index]
-        base_hl_out = t.argmax(base_hl_out, dim=-1)[label_idx.as_index]
-        base_ll_out = t.argmax(base_ll_out, dim=-1)[label_idx.as_index]
-        ll_unchanged = (
-            ll_out == base_hl_out
-        )  # output of ll model is same as hl model after ablation
-        accuracy = (
-            base_ll_out == base_hl_out
-        )  # output of ll model is same as hl model before ablation
-        # calculate output output of ll model is different after ablation,
-        # given that it was the same before ablation
-        changed_result = (~ll_unchanged).cpu().float() * accuracy.cpu().float()
+        ll_labels = t.argmax(ll_outs, dim=-1)[(slice(None), *label_idx.as_index)]
+        base_hl_labels = get_label_ids(base_hl_out)[label_idx.as_index]
+        base_ll_labels = t.argmax(base_ll_out, dim=-1)[label_idx.as_index]
+        # output of ll model is same as hl model after ablation
+        ll_unchanged = ll_labels == base_hl_labels
+        # output of ll model is same as hl model before ablation
+        accuracy = (base_ll_labels == base_hl_labels).float()
     else:
-        base_hl_out = model_pair.hl_model(base_input).squeeze()
-        base_ll_out = model_pair.ll_model(base_x).squeeze()
         ll_unchanged = t.isclose(
-            ll_out.float().squeeze(),
-            base_hl_out.float().to(ll_out.device),
+            ll_outs.float().reshape(n_ablations, -1),
+            base_hl_out.float().to(ll_outs.device).reshape(1, -1),
             atol=atol,
         )
-        accuracy = (
-            t.isclose(base_ll_out.float(), base_hl_out.float(), atol=atol).cpu().float()
-        )
-        changed_result = (~ll_unchanged).cpu().float() * accuracy
+        accuracy = t.isclose(base_ll_out.float(), base_hl_out.float(), atol=atol).float()
+    ll_changed = (~ll_unchanged).float().reshape(n_ablations, -1)
     if relative_change:
-        return changed_result.sum() / (accuracy.float().sum() + 1e-6)
+        # calculate output output of ll model is different after ablation,
+        # given that it was the same before ablation
+        changed_result = ll_changed * accuracy.reshape(1, -1).to(ll_changed.device)
+        return (changed_result.sum(dim=-1) / (accuracy.sum() + 1e-6)).cpu()
 
-    return (~ll_unchanged).cpu().float().mean()
+    return ll_changed.mean(dim=-1).cpu()
 
 
 def get_causal_effects_for_all_nodes(
@@ -347,20 +613,37 @@ def get_causal_effects_for_all_nodes(
     use_mean_cache: bool = True,
     categorical_metric: Categorical_Metric = Categorical_Metric.ACCURACY,
     individual_nodes: bool = True,
+    mean_cache_dtype: t.dtype = t.float32,
+    mean_cache_dir: Optional[str] = None,
 ) -> tuple[dict[LLNode, float], dict[LLNode, float]]:
+    """
+    The mean cache only covers the hooks of the ablated nodes. It is computed in mean_cache_dtype
+    and, with mean_cache_dir, saved and reused across runs (see get_activation_moments).
+    """
+    node_types = ["n", "c" if not individual_nodes else "individual_c"]
     mean_cache = None
     if use_mean_cache:
-        mean_cache = get_mean_cache(model_pair, uni_test_set, batch_size=batch_size)
+        hook_names = {
+            node.name for node_type in node_types for node in get_ablation_nodes(model_pair, node_type)
+        }
+        mean_cache = get_mean_cache(
+            model_pair,
+            uni_test_set,
+            batch_size=batch_size,
+            hook_names=hook_names,
+            dtype=mean_cache_dtype,
+            cache_dir=mean_cache_dir,
+        )
     za_result_not_in_circuit = check_causal_effect_on_ablation(
         model_pair,
         uni_test_set,
-        node_type="n",
+        node_type=node_types[0],
         mean_cache=mean_cache,
     )
     za_result_in_circuit = check_causal_effect_on_ablation(
         model_pair,
         uni_test_set,
-        node_type="c" if not individual_nodes else "individual_c",
+        node_type=node_types[1],
         mean_cache=mean_cache,
     )
     return za_result_not_in_circuit, za_result_in_circuit
@@ -372,40 +655,29 @@ def check_causal_effect_on_ablation(
     batch_size: int = 256,
     node_type: str = "a",
     mean_cache: Optional[dict[str, Tensor]] = None,
+    node_chunk_size: Optional[int] = None,
+    memory_budget: int = 2**30,
 ) -> dict[LLNode, float]:
-    use_mean_cache = True if mean_cache else False
-    assert node_type in [
-        "a",
-        "c",
-        "n",
-        "individual_c",
-    ], "type must be one of 'a', 'c', 'n', or 'individual_c'"
-    hookers = {}
+    """
+    Zero (or, given a mean_cache, mean) ablates each node separately, sweeping the nodes in
+    chunks (see NodeSweep) of node_chunk_size nodes, by default as many as fit in memory_budget bytes.
+    """
     results = {}
-    all_nodes = (
-        get_nodes_not_in_circuit(model_pair.ll_model, model_pair.corr)
-        if node_type == "n"
-        else (
-            get_all_nodes(model_pair.ll_model, model_pair.corr.get_suffixes())
-            if node_type == "a"
-            else (
-                get_all_individual_nodes_in_circuit(
-                    model_pair.ll_model, model_pair.corr
-                )
-                if node_type == "individual_c"
-                else get_nodes_in_circuit(model_pair.corr)
-            )
-        )
-    )
-
-    for node in all_nodes:
-        hookers[node] = make_ablation_hook(node, mean_cache, use_mean_cache)
+    for node in get_ablation_nodes(model_pair, node_type):
         results[node] = 0.
 
+    def get_source(hook_name: str) -> Tensor | float:
+        return mean_cache[hook_name] if mean_cache else 0.
+
+    sweep = NodeSweep(list(results.keys()), node_chunk_size, memory_budget)
     loader = dataset.make_loader(batch_size=batch_size, num_workers=0)
-    for batch in tqdm(loader):
-        for node, hooker in hookers.items():
-            results[node] += ablate_nodes(model_pair, batch, [(node.name, hooker)]).item()
+    with t.no_grad():
+        for batch in tqdm(loader):
+            clean_outputs = get_clean_outputs(model_pair, batch)
+            for chunk, ll_outs in sweep.run(model_pair.ll_model, batch[0], get_source):
+                effects = get_ablation_effects(model_pair, ll_outs, clean_outputs)
+                for node, effect in zip(chunk, effects.tolist()):
+                    results[node] += effect
 
     for node, result in results.items():
         results[node] = result / len(loader)
@@ -466,14 +738,24 @@ def get_circuit_score(
     batch_size: int = 256,
     use_mean_cache: bool = False,
     relative_change: bool = True,
+    mean_cache_dtype: t.dtype = t.float32,
+    mean_cache_dir: Optional[str] = None,
 ) -> float:
     """
     Returns the accuracy of the model after ablating the nodes in nodes_to_ablate.
     Defaults to zero ablation.
     see ablate_nodes for more details
+    A mean cache computed here only covers the hooks of nodes_to_ablate, see get_mean_cache.
     """
     if use_mean_cache and mean_cache is None:
-        mean_cache = get_mean_cache(model_pair, dataset, batch_size=batch_size)
+        mean_cache = get_mean_cache(
+            model_pair,
+            dataset,
+            batch_size=batch_size,
+            hook_names={node.name for node in nodes_to_ablate},
+            dtype=mean_cache_dtype,
+            cache_dir=mean_cache_dir,
+        )
     fwd_hooks = []
 
     for node in nodes_to_ablate:
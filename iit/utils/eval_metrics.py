@@ -4,6 +4,15 @@ import torch as t
 from torch import Tensor
 import iit.utils.index as index
 
+def get_label_ids(labels: Tensor) -> Tensor:
+    """
+    Returns class ids for categorical labels. Sparse (integer) labels are already ids,
+    dense one-hot labels, probabilities or logits are reduced with argmax over the last dim.
+    """
+    if labels.is_floating_point():
+        return t.argmax(labels, dim=-1)
+    return labels
+
 def kl_div(
         a: Tensor,
         b: Tensor,
@@ -36,8 +45,8 @@ def accuracy_affected(
              label_unchanged: Tensor,
              label_idx: index.TorchIndex
              ) -> Tensor:
-    a_lab = t.argmax(a[label_idx.as_index], dim=-1)
-    b_lab = t.argmax(b[label_idx.as_index], dim=-1)
+    a_lab = get_label_ids(a[label_idx.as_index])
+    b_lab = get_label_ids(b[label_idx.as_index])
 
     out_unchanged = t.eq(a_lab, b_lab)
     changed_result = (~out_unchanged).cpu().float() * (~label_unchanged).cpu().float()
@@ -5,10 +5,13 @@ import argparse
 import torch as t
 import numpy as np
 from transformer_lens import HookedTransformer
+from transformers import AutoTokenizer
 
 from iit.model_pairs.ioi_model_pair import IOI_ModelPair
 from iit.tasks.ioi import (
     make_ioi_dataset_and_hl,
+    make_ioi_vocab_from_config,
+    get_gpt2_cfg,
     ioi_cfg,
     make_corr_dict,
     suffixes,
@@ -37,8 +40,13 @@ def eval_ioi(args: IOIArgParseNamespace) -> None:
     batch_size = args.batch_size
     num_samples = args.num_samples
     # load model
-    ll_cfg = HookedTransformer.from_pretrained("gpt2").cfg.to_dict()
+    ll_cfg = get_gpt2_cfg()
     ll_cfg.update(ioi_cfg)
+    vocab = None
+    if args.compact_vocab:
+        # the mapping only depends on the dataset config, so it matches the one used in training
+        vocab = make_ioi_vocab_from_config(AutoTokenizer.from_pretrained(ll_cfg["tokenizer_name"]))
+        ll_cfg["d_vocab"] = ll_cfg["d_vocab_out"] = len(vocab)
 
     ll_model = HookedTransformer(ll_cfg).to(device)
     if args.load_from_wandb:
@@ -71,7 +79,7 @@ def eval_ioi(args: IOIArgParseNamespace) -> None:
     np.random.seed(0)
     t.manual_seed(0)
     ioi_dataset, hl_model = make_ioi_dataset_and_hl(
-        num_samples, ll_model, verbose=True
+        num_samples, ll_model, verbose=True, vocab=vocab
     )
 
     model_pair = IOI_ModelPair(ll_model=ll_model, hl_model=hl_model, corr=corr)
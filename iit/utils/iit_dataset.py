@@ -1,14 +1,57 @@
 # import everything relevant
-from typing import Optional, cast, Sized, Callable
+import os
+from functools import partial
+from typing import Any, Iterator, Optional, cast, Sized, Callable
 import numpy as np
 from torch.utils.data import Dataset
 from iit.utils.config import DEVICE
-from torch.utils.data import DataLoader
+from iit.utils.pair_schedule import LengthBucketBatchSampler, PairBatchSampler, PairSchedule
+from torch.utils.data import DataLoader, Subset
 import torch as t
 from torch import Tensor
 
 dataset_len: Callable[[Dataset], int] = lambda dataset: len(cast(Sized, dataset))
 
+
+def identity_collate(batch: Any) -> Any:
+    return batch
+
+
+def move_to_device(batch: Any, device: t.device, non_blocking: bool = False) -> Any:
+    """Moves every tensor in a (nested) tuple, list or dict batch to device."""
+    if isinstance(batch, Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(move_to_device(item, device, non_blocking) for item in batch)
+    if isinstance(batch, dict):
+        return {k: move_to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+class DeviceDataLoader(DataLoader):
+    """
+    DataLoader whose batches are collated on the CPU, e.g. in worker processes, and moved to
+    device in the main process. The copy is non-blocking when pin_memory is set.
+    """
+
+    def __init__(self, *args: Any, device: t.device, **kwargs: Any):
+        self.device = device
+        super().__init__(*args, **kwargs)
+
+    def __iter__(self) -> Iterator:  # type: ignore[override]
+        for batch in super().__iter__():
+            yield move_to_device(batch, self.device, non_blocking=self.pin_memory)
+
+
+def get_sample_lengths(data: Dataset) -> np.ndarray:
+    """Sequence length of each sample's input, from data.get_lengths() if the dataset has it."""
+    if hasattr(data, "get_lengths"):
+        return np.asarray(data.get_lengths())
+    if isinstance(data, Subset):
+        return get_sample_lengths(data.dataset)[np.asarray(data.indices, dtype=np.int64)]
+    return np.array([len(data[i][0]) for i in range(dataset_len(data))])
+
+
 class IITDataset(Dataset):
     """
     Each thing is randomly sampled from a pair of datasets.
@@ -20,38 +63,217 @@ class IITDataset(Dataset):
         ablation_data: Dataset, 
         seed: int = 0, 
         every_combination: bool = False, 
-        device: t.device = DEVICE
+        device: t.device = DEVICE,
+        pair_schedule: Optional[str] = None,
+        num_pairs: Optional[int] = None,
+        resample_pairs_every_epoch: bool = True,
+        materialize: bool = False,
+        bucket_by_length: bool = False,
     ):
+        """
+        By default, pair i is drawn from a generator seeded with (seed, i), or is the i-th
+        combination if every_combination is set. If pair_schedule is one of
+        iit.utils.pair_schedule.PAIR_SCHEDULE_MODES, the pairs of each epoch are instead drawn
+        at once by a PairSchedule and make_loader yields batches of (base, ablation) index rows.
+        If materialize is set, base and ablation data are stacked once into tensors on device
+        and every batch is gathered with one index_select per field (see materialize_data).
+        If bucket_by_length is set, make_loader pairs and batches samples of equal input length
+        only (see LengthBucketBatchSampler), so the data need not be padded to a common length.
+        """
         # For vanilla IIT, base_data and ablation_data are the same
         self.base_data = base_data
         self.ablation_data = ablation_data
         self.seed = seed
         self.every_combination = every_combination
         self.device = device
+        self.hl_targets: Optional[dict[str, Tensor]] = None
+        self.pair_schedule: Optional[PairSchedule] = None
+        if pair_schedule is not None:
+            if every_combination:
+                raise ValueError(
+                    "every_combination and pair_schedule are exclusive, use pair_schedule='product' instead"
+                )
+            self.pair_schedule = PairSchedule(
+                dataset_len(base_data),
+                dataset_len(ablation_data),
+                mode=pair_schedule,
+                num_pairs=num_pairs,
+                seed=seed,
+                resample_every_epoch=resample_pairs_every_epoch,
+            )
+        if bucket_by_length:
+            if every_combination or pair_schedule is not None or materialize:
+                raise ValueError(
+                    "bucket_by_length is exclusive with every_combination, pair_schedule and materialize"
+                )
+            self.base_lengths = get_sample_lengths(base_data)
+            self.ablation_lengths = (
+                self.base_lengths if ablation_data is base_data else get_sample_lengths(ablation_data)
+            )
+        self.bucket_by_length = bucket_by_length
+        self.materialize = materialize
+        self.base_fields: Optional[tuple[Optional[Tensor], ...]] = None
+        self.ablation_fields: Optional[tuple[Optional[Tensor], ...]] = None
+        self._pair_index_table: Optional[tuple[Tensor, Tensor]] = None
+        if materialize:
+            self.materialize_data()
 
     def __getitem__(self, index: int) -> tuple:
+        base_input, ablation_input = self.get_pair(index)
+        if self.hl_targets is not None:
+            targets = {name: table[index] for name, table in self.hl_targets.items()}
+            return base_input, ablation_input, targets
+        return base_input, ablation_input
+
+    def __getitems__(self, indices: list[int] | np.ndarray) -> list[tuple] | tuple:
+        if self.materialize:
+            # already a collated batch, see make_loader
+            return self.gather_batch(indices)
+        if isinstance(indices, np.ndarray) and indices.ndim == 2:
+            # (base_index, ablation_index) rows from a PairBatchSampler
+            return [
+                (self.base_data[base_index], self.ablation_data[ablation_index])
+                for base_index, ablation_index in indices.tolist()
+            ]
+        return [self[index] for index in indices]
+
+    def get_pair(self, index: int) -> tuple:
+        base_index, ablation_index = self.get_pair_indices(index)
+        return self.base_data[base_index], self.ablation_data[ablation_index]
+
+    def get_pair_indices(self, index: int) -> tuple[int, int]:
         if self.every_combination:
             base_index = index // dataset_len(self.ablation_data)
             ablation_index = index % dataset_len(self.ablation_data)
-            base_input = self.base_data[base_index]
-            ablation_input = self.ablation_data[ablation_index]
-            return base_input, ablation_input
+            return base_index, ablation_index
 
         # sample based on seed
         rng = np.random.default_rng(self.seed * 1000000 + index)
         base_index = rng.choice(dataset_len(self.base_data))
         ablation_index = rng.choice(dataset_len(self.ablation_data))
+        return base_index, ablation_index
 
-        base_input = self.base_data[base_index]
-        ablation_input = self.ablation_data[ablation_index]
+    def materialize_data(self) -> None:
+        """
+        Stacks every field (x, y, intermediate vars) of base_data and ablation_data
+        into one contiguous tensor on self.device. This is done once; afterwards batches
+        are gathered with index_select and there is no per-sample Python work.
+        """
+        self.base_fields = self.stack_data(self.base_data, self.device)
+        if self.ablation_data is self.base_data:
+            self.ablation_fields = self.base_fields
+        else:
+            self.ablation_fields = self.stack_data(self.ablation_data, self.device)
+        self.materialize = True
 
-        return base_input, ablation_input
+    @staticmethod
+    def stack_data(data: Dataset, device: t.device) -> tuple[Optional[Tensor], ...]:
+        items = [data[i] for i in range(dataset_len(data))]
+        fields: list[Optional[Tensor]] = []
+        for field in zip(*items):
+            if all(value is None for value in field):
+                fields.append(None)
+            else:
+                fields.append(t.stack([t.as_tensor(value) for value in field]).to(device))
+        return tuple(fields)
+
+    def get_batch_pair_indices(self, indices: list[int] | np.ndarray) -> tuple[Tensor, Tensor]:
+        """Returns base and ablation index tensors for a batch of dataset indices or index rows."""
+        if isinstance(indices, np.ndarray) and indices.ndim == 2:
+            rows = t.from_numpy(indices).to(self.device)
+            return rows[:, 0], rows[:, 1]
+        index = t.as_tensor(indices, dtype=t.long, device=self.device)
+        if self.every_combination:
+            n_ablation = dataset_len(self.ablation_data)
+            return index // n_ablation, index % n_ablation
+        if self._pair_index_table is None:
+            # the legacy per-index generators, resolved once for the whole dataset
+            pairs = t.tensor([self.get_pair_indices(i) for i in range(len(self))], dtype=t.long)
+            self._pair_index_table = (pairs[:, 0].to(self.device), pairs[:, 1].to(self.device))
+        base_table, ablation_table = self._pair_index_table
+        return base_table[index], ablation_table[index]
+
+    def gather_batch(self, indices: list[int] | np.ndarray) -> tuple:
+        """Returns a collated batch for indices from the materialized fields."""
+        assert self.base_fields is not None and self.ablation_fields is not None
+        base_index, ablation_index = self.get_batch_pair_indices(indices)
+        batch: tuple = (
+            tuple(None if f is None else f.index_select(0, base_index) for f in self.base_fields),
+            tuple(None if f is None else f.index_select(0, ablation_index) for f in self.ablation_fields),
+        )
+        if self.hl_targets is not None:
+            index = t.as_tensor(indices, dtype=t.long)
+            hl_targets = {
+                name: table.index_select(0, index).to(self.device)
+                for name, table in self.hl_targets.items()
+            }
+            batch = (*batch, hl_targets)
+        return batch
 
     def __len__(self) -> int:
+        if self.pair_schedule is not None:
+            return len(self.pair_schedule)
         if self.every_combination:
             return dataset_len(self.base_data) * dataset_len(self.ablation_data)
         return dataset_len(self.base_data)
 
+    def get_hl_targets_metadata(self, hl_node_names: list[str], fingerprints: Optional[dict] = None) -> dict:
+        """
+        What a table of precomputed hl targets depends on. fingerprints should identify the
+        base and ablation data and the hl model, see BaseModelPair.precompute_hl_targets.
+        """
+        return {
+            "len": len(self),
+            "seed": self.seed,
+            "every_combination": self.every_combination,
+            "hl_nodes": sorted(hl_node_names),
+            **(fingerprints or {}),
+        }
+
+    def precompute_hl_targets(
+        self,
+        get_targets: Callable[[tuple, tuple], dict[str, Tensor]],
+        hl_node_names: list[str],
+        batch_size: int = 256,
+        path: Optional[str] = None,
+        fingerprints: Optional[dict] = None,
+    ) -> None:
+        """
+        Materializes the HL counterfactual targets of every pair into one table per HL node,
+        so that __getitem__ returns them (by index) along with the pair.
+        Pairs are a deterministic function of (seed, index), so the table stays valid across epochs.
+        If path is given, the table is saved there and memory-mapped back.
+        A table already saved at path with the same metadata (see get_hl_targets_metadata) is reused.
+        """
+        if self.pair_schedule is not None or self.bucket_by_length:
+            raise ValueError(
+                "Precomputed hl targets need pairs fixed per index, i.e. pair_schedule=None and bucket_by_length=False"
+            )
+        metadata = self.get_hl_targets_metadata(hl_node_names, fingerprints)
+        if path is not None and os.path.exists(path):
+            saved = t.load(path, mmap=True)
+            if saved["metadata"] == metadata:
+                self.hl_targets = saved["targets"]
+                return
+
+        self.hl_targets = None
+        loader = DataLoader(
+            self,
+            batch_size=batch_size,
+            shuffle=False,
+            collate_fn=self.get_loader_collate_fn(),
+        )
+        chunks: dict[str, list[Tensor]] = {name: [] for name in hl_node_names}
+        for base_input, ablation_input in loader:
+            for name, target in get_targets(base_input, ablation_input).items():
+                chunks[name].append(target.cpu())
+        targets = {name: t.cat(chunk) for name, chunk in chunks.items()}
+
+        if path is not None:
+            t.save({"metadata": metadata, "targets": targets}, path)
+            targets = t.load(path, mmap=True)["targets"]
+        self.hl_targets = targets
+
     @staticmethod
     def get_encoded_input_from_torch_input(
         xy: tuple, 
@@ -73,29 +295,88 @@ class IITDataset(Dataset):
     def collate_fn(
         batch: list[Tensor] | Tensor, 
         device: t.device = DEVICE
-        ) -> tuple[tuple, tuple]:
+        ) -> tuple:
         if not isinstance(batch, list):
             # if batch is a single element, because batch_size was 1 or None, it is a tuple instead of a list
             batch_list = [batch]
         else:
             batch_list = batch
         
-        base_input_list, ablation_input_list = zip(*batch_list)
-        return IITDataset.get_encoded_input_from_torch_input(
-            base_input_list, device
-        ), IITDataset.get_encoded_input_from_torch_input(ablation_input_list, device)
+        base_input_list, ablation_input_list = zip(*[item[0:2] for item in batch_list])
+        encoded = (
+            IITDataset.get_encoded_input_from_torch_input(base_input_list, device),
+            IITDataset.get_encoded_input_from_torch_input(ablation_input_list, device),
+        )
+        if len(batch_list[0]) == 3:
+            # precomputed hl targets, see IITDataset.precompute_hl_targets
+            hl_targets = {
+                name: t.stack([item[2][name] for item in batch_list]).to(device)
+                for name in batch_list[0][2]
+            }
+            return *encoded, hl_targets
+        return encoded
+
+    def get_loader_collate_fn(self, device: Optional[t.device] = None) -> Callable:
+        """Picklable collate function, which collates onto device (default: self.device)."""
+        if self.materialize:
+            return identity_collate
+        return partial(self.collate_fn, device=self.device if device is None else device)
 
     def make_loader(
         self,
         batch_size: int,
         num_workers: int,
+        pin_memory: bool = True,
+        prefetch_factor: Optional[int] = None,
+        persistent_workers: bool = False,
+        fixed_pairs: bool = False,
     ) -> DataLoader:
-        return DataLoader(
+        """
+        With num_workers > 0, batches are collated on the CPU in the workers, pinned if
+        pin_memory is set and self.device is a GPU, and moved to self.device in the main process.
+        prefetch_factor and persistent_workers are passed on to the DataLoader in that case.
+        With fixed_pairs, a length-bucketed loader yields the same pairs every epoch (for evaluation).
+        """
+        if self.materialize:
+            # batches are gathered on device by __getitems__, workers would only add overhead
+            num_workers = 0
+        device = t.device(self.device)
+        loader_kwargs: dict[str, Any] = {"num_workers": num_workers}
+        loader_cls: Callable[..., DataLoader] = DataLoader
+        if num_workers > 0:
+            loader_kwargs.update(
+                pin_memory=pin_memory and device.type == "cuda",
+                prefetch_factor=prefetch_factor,
+                persistent_workers=persistent_workers,
+            )
+            if device.type != "cpu":
+                loader_cls = partial(DeviceDataLoader, device=device)
+            device = t.device("cpu")
+        loader_kwargs["collate_fn"] = self.get_loader_collate_fn(device)
+
+        if self.bucket_by_length:
+            return loader_cls(
+                self,
+                batch_sampler=LengthBucketBatchSampler(
+                    self.base_lengths,
+                    self.ablation_lengths,
+                    batch_size,
+                    seed=self.seed,
+                    fixed_epoch=0 if fixed_pairs else None,
+                ),
+                **loader_kwargs,
+            )
+        if self.pair_schedule is not None:
+            return loader_cls(
+                self,
+                batch_sampler=PairBatchSampler(self.pair_schedule, batch_size),
+                **loader_kwargs,
+            )
+        return loader_cls(
             self,
             batch_size=batch_size,
             shuffle=True,
-            num_workers=num_workers,
-            collate_fn=lambda x: self.collate_fn(x, self.device),
+            **loader_kwargs,
         )
     
     def get_input_shape(self) -> t.Size:
@@ -0,0 +1,242 @@
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+import torch as t
+from torch import Tensor
+from transformer_lens.hook_points import HookPoint # type: ignore
+
+from iit.utils.index import Ix
+from iit.utils.nodes import LLNode
+from iit.utils.subspace import stack_subspace_factors
+
+
+class InterventionPlanner:
+    """
+    Groups LLNodes by hook name and precomputes, for each hook point, one boolean mask
+    covering the union of the nodes' indices. Each hook point is then patched with a
+    single torch.where instead of one clone and index write per node.
+    Nodes with a subspace are patched as base + P(source - base): their bases are
+    stacked per hook point, so all of them are applied with one batched matmul.
+    Masks are built lazily per activation shape and kept in a bounded LRU cache.
+    """
+
+    def __init__(self, max_cached_masks: int = 256):
+        self.max_cached_masks = max_cached_masks
+        self._masks: OrderedDict[tuple, Tensor] = OrderedDict()
+        self._subspace_plans: OrderedDict[tuple, tuple[Tensor, Tensor, Tensor]] = OrderedDict()
+
+    @staticmethod
+    def group_by_hook(ll_nodes: Iterable[LLNode]) -> dict[str, list[LLNode]]:
+        grouped: dict[str, list[LLNode]] = {}
+        for ll_node in ll_nodes:
+            grouped.setdefault(ll_node.name, []).append(ll_node)
+        return grouped
+
+    @staticmethod
+    def _is_batch_independent(ll_nodes: list[LLNode]) -> bool:
+        # nodes that select every element of the batch dimension share one mask row
+        for ll_node in ll_nodes:
+            index = ll_node.index if ll_node.index is not None else Ix[[None]]
+            first = index.as_index[0]
+            if not (isinstance(first, slice) and first == slice(None)):
+                return False
+        return True
+
+    def get_mask(
+        self,
+        hook_name: str,
+        ll_nodes: list[LLNode],
+        shape: t.Size,
+        device: t.device,
+    ) -> Tensor:
+        """
+        Returns a boolean mask that is True at every element selected by any of ll_nodes.
+        The mask has a batch dimension of 1 (and broadcasts) unless a node indexes the batch.
+        """
+        if self._is_batch_independent(ll_nodes):
+            shape = t.Size((1, *shape[1:]))
+        key = (hook_name, frozenset(ll_nodes), tuple(shape), str(device))
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        mask = t.zeros(shape, dtype=t.bool, device=device)
+        for ll_node in ll_nodes:
+            if ll_node.subspace is not None:
+                raise ValueError(f"Node {ll_node} has a subspace, use get_subspace_plan instead")
+            index = ll_node.index if ll_node.index is not None else Ix[[None]]
+            mask[index.as_index] = True
+
+        self._masks[key] = mask
+        if len(self._masks) > self.max_cached_masks:
+            self._masks.popitem(last=False)
+        return mask
+
+    def get_subspace_plan(
+        self,
+        hook_name: str,
+        ll_nodes: list[LLNode],
+        shape: t.Size,
+        device: t.device,
+        dtype: t.dtype,
+    ) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        Returns (mask, V, U) for nodes with a subspace over the last dimension of the activation.
+        mask has shape (*shape[:-1], n_nodes) and selects the positions each node patches;
+        V and U are the stacked (n_nodes, d, k) factors of the nodes' projections.
+        """
+        if self._is_batch_independent(ll_nodes):
+            shape = t.Size((1, *shape[1:]))
+        key = (hook_name, frozenset(ll_nodes), tuple(shape), str(device), dtype)
+        if key in self._subspace_plans:
+            self._subspace_plans.move_to_end(key)
+            return self._subspace_plans[key]
+
+        mask = t.zeros((*shape[:-1], len(ll_nodes)), dtype=dtype, device=device)
+        subspaces = []
+        for i, ll_node in enumerate(ll_nodes):
+            assert ll_node.subspace is not None
+            index = ll_node.index if ll_node.index is not None else Ix[[None]]
+            prefix = index.as_index[: len(shape) - 1]
+            if len(index.as_index) == len(shape) and index.as_index[-1] != slice(None):
+                raise ValueError(
+                    f"Subspace node {ll_node} must select the whole last dimension of {hook_name}"
+                )
+            mask[(*prefix, Ellipsis, i)] = 1
+            subspaces.append(ll_node.subspace)
+        V, U = stack_subspace_factors(subspaces)
+        plan = (mask, V.to(device, dtype), U.to(device, dtype))
+
+        self._subspace_plans[key] = plan
+        if len(self._subspace_plans) > self.max_cached_masks:
+            self._subspace_plans.popitem(last=False)
+        return plan
+
+    def make_patch_hooks(
+        self,
+        ll_nodes: Iterable[LLNode],
+        get_source: Callable[[str], Tensor],
+    ) -> list[tuple[str, Callable[[Tensor, HookPoint], Tensor]]]:
+        """
+        Returns one forward hook per hook point, replacing the elements selected by
+        ll_nodes with the corresponding elements of get_source(hook_name).
+        """
+        hooks = []
+        for hook_name, nodes in self.group_by_hook(ll_nodes).items():
+            hooks.append((hook_name, self._make_patch_hook(nodes, get_source)))
+        return hooks
+
+    def make_replica_patch_hooks(
+        self,
+        replica_nodes: list[list[LLNode]],
+        batch_size: int,
+        get_source: Callable[[str], Tensor | float],
+    ) -> list[tuple[str, Callable[[Tensor, HookPoint], Tensor]]]:
+        """
+        Hooks for len(replica_nodes) copies of a batch of batch_size stacked along the batch
+        dimension: copy k is patched at replica_nodes[k] from get_source(hook_name), which is
+        broadcast against a single copy. Each copy is patched as make_patch_hooks would patch it,
+        with one torch.where over a (copies, batch, ...) mask per hook point.
+        """
+        replicas: dict[str, list[tuple[int, LLNode]]] = {}
+        for replica, nodes in enumerate(replica_nodes):
+            for node in nodes:
+                replicas.setdefault(node.name, []).append((replica, node))
+        return [
+            (hook_name, self._make_replica_patch_hook(hook_replicas, len(replica_nodes), batch_size, get_source))
+            for hook_name, hook_replicas in replicas.items()
+        ]
+
+    def get_replica_mask(
+        self,
+        hook_name: str,
+        replicas: dict[int, list[LLNode]],
+        n_replicas: int,
+        shape: t.Size,
+        device: t.device,
+    ) -> Tensor:
+        """
+        Stacks the masks (see get_mask) of each replica's nodes into a (n_replicas, batch, ...)
+        mask for activations of one copy of shape, with a batch dimension of 1 if no node indexes the batch.
+        """
+        all_nodes = [node for nodes in replicas.values() for node in nodes]
+        row_shape = t.Size((1 if self._is_batch_independent(all_nodes) else shape[0], *shape[1:]))
+        key = (
+            hook_name,
+            frozenset((replica, frozenset(nodes)) for replica, nodes in replicas.items()),
+            n_replicas,
+            tuple(row_shape),
+            str(device),
+        )
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        mask = t.zeros((n_replicas, *row_shape), dtype=t.bool, device=device)
+        for replica, nodes in replicas.items():
+            mask[replica] = self.get_mask(hook_name, nodes, shape, device)
+
+        self._masks[key] = mask
+        if len(self._masks) > self.max_cached_masks:
+            self._masks.popitem(last=False)
+        return mask
+
+    def _make_replica_patch_hook(
+        self,
+        replicas: list[tuple[int, LLNode]],
+        n_replicas: int,
+        batch_size: int,
+        get_source: Callable[[str], Tensor | float],
+    ) -> Callable[[Tensor, HookPoint], Tensor]:
+        full_nodes: dict[int, list[LLNode]] = {}
+        subspace_nodes: dict[int, list[LLNode]] = {}
+        for replica, ll_node in replicas:
+            nodes = full_nodes if ll_node.subspace is None else subspace_nodes
+            nodes.setdefault(replica, []).append(ll_node)
+
+        def replica_patch_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
+            out = hook_point_out.reshape(n_replicas, batch_size, *hook_point_out.shape[1:])
+            source = t.as_tensor(get_source(hook.name), dtype=out.dtype, device=out.device)
+            if subspace_nodes:
+                delta = t.zeros_like(out)
+                for replica, nodes in subspace_nodes.items():
+                    mask, V, U = self.get_subspace_plan(
+                        hook.name, nodes, out.shape[1:], out.device, out.dtype
+                    )
+                    coeffs = t.einsum("...d,ndk->...nk", source - out[replica], V) * mask[..., None]
+                    delta[replica] = t.einsum("...nk,ndk->...d", coeffs, U)
+                out = out + delta
+            if full_nodes:
+                full_mask = self.get_replica_mask(
+                    hook.name, full_nodes, n_replicas, out.shape[1:], out.device
+                )
+                out = t.where(full_mask, source, out)
+            return out.reshape(hook_point_out.shape)
+
+        return replica_patch_hook
+
+    def _make_patch_hook(
+        self,
+        ll_nodes: list[LLNode],
+        get_source: Callable[[str], Tensor],
+    ) -> Callable[[Tensor, HookPoint], Tensor]:
+        full_nodes = [ll_node for ll_node in ll_nodes if ll_node.subspace is None]
+        subspace_nodes = [ll_node for ll_node in ll_nodes if ll_node.subspace is not None]
+
+        def patch_hook(hook_point_out: Tensor, hook: HookPoint) -> Tensor:
+            source = get_source(hook.name)
+            out = hook_point_out
+            if subspace_nodes:
+                mask, V, U = self.get_subspace_plan(
+                    hook.name, subspace_nodes, out.shape, out.device, out.dtype
+                )
+                coeffs = t.einsum("...d,ndk->...nk", source - out, V) * mask[..., None]
+                out = out + t.einsum("...nk,ndk->...d", coeffs, U)
+            if full_nodes:
+                # t.where allocates the patched output, so gradients reach both the
+                # unpatched elements of hook_point_out and the patched elements of the source
+                full_mask = self.get_mask(hook.name, full_nodes, out.shape, out.device)
+                out = t.where(full_mask, source, out)
+            return out
+
+        return patch_hook
@@ -50,6 +50,12 @@ class MetricStore:
 
 
 class PerTokenMetricStore(MetricStore):
+    """
+    Averages per-position values over updates. Updates from batches of different sequence
+    lengths are aligned at their last position, and each position is averaged over the
+    updates that have it.
+    """
+
     def __init__(self, name: str, precision: int = 3):
         super().__init__(name, metric_type=MetricType.LOG)
         np.set_printoptions(precision=precision)
@@ -57,12 +63,49 @@ class PerTokenMetricStore(MetricStore):
     def get_value(self) -> None | float:
         if len(self._store) == 0:
             return None
-        return np.mean(self._store, axis=0)
+        lengths = {np.size(value) for value in self._store}
+        if len(lengths) == 1:
+            return np.mean(self._store, axis=0)
+        values = [np.atleast_1d(np.asarray(value, dtype=float)) for value in self._store]
+        max_len = max(lengths)
+        aligned = np.full((len(values), max_len), np.nan)
+        for i, value in enumerate(values):
+            aligned[i, max_len - len(value):] = value
+        return np.nanmean(aligned, axis=0)
 
     def __str__(self) -> str:
         return f"{self._name}: {self.get_value()}"
 
 
+class PerNodeMetricStore(MetricStore):
+    """
+    Averages per-node values over updates, each update being aligned with nodes.
+    Prints only the mean and the worst node, since there can be thousands of nodes.
+    """
+
+    def __init__(self, name: str, nodes: list):
+        super().__init__(name, metric_type=MetricType.LOG)
+        self.nodes = nodes
+
+    def get_value(self) -> None | np.ndarray:
+        if len(self._store) == 0:
+            return None
+        return np.mean(self._store, axis=0)
+
+    def get_node_values(self) -> dict:
+        value = self.get_value()
+        if value is None:
+            return {}
+        return dict(zip(self.nodes, value.tolist()))
+
+    def __str__(self) -> str:
+        value = self.get_value()
+        if value is None or len(value) == 0:
+            return f"{self._name}: None"
+        worst = int(np.argmin(value))
+        return f"{self._name}: mean {value.mean():.3f}, min {value[worst]:.3f} at {self.nodes[worst]}"
+
+
 class MetricStoreCollection:
     def __init__(self, list_of_metric_stores: list[MetricStore]):
         self.metrics = list_of_metric_stores
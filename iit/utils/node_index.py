@@ -0,0 +1,171 @@
+import itertools
+from typing import Iterable, Sequence
+
+import torch as t
+from torch import Tensor
+
+from iit.utils.index import Ix, TorchIndex
+from iit.utils.nodes import LLNode
+
+_UNBOUNDED = 2**62
+
+
+def _get_dim_intervals(idx: int | slice | list[int]) -> list[tuple[int, int]]:
+    if isinstance(idx, slice):
+        if idx.step not in (None, 1):
+            raise NotImplementedError("Step is not supported")
+        start = 0 if idx.start is None else idx.start
+        stop = _UNBOUNDED if idx.stop is None else idx.stop
+        if start < 0 or stop < 0:
+            raise NotImplementedError(f"Negative indices are not supported: {idx}")
+        return [(start, stop)]
+    if isinstance(idx, int):
+        idx = [idx]
+    if any(i < 0 for i in idx):
+        raise NotImplementedError(f"Negative indices are not supported: {idx}")
+    return [(i, i + 1) for i in idx]
+
+
+def has_negative_bounds(index: TorchIndex | None) -> bool:
+    """Whether index counts from the end of some dimension, whose size NodeIndex does not know."""
+    if index is None:
+        return False
+    for idx in index.as_index:
+        if isinstance(idx, slice):
+            bounds = [idx.start, idx.stop]
+        elif isinstance(idx, int):
+            bounds = [idx]
+        else:
+            bounds = list(idx)
+        if any(bound is not None and bound < 0 for bound in bounds):
+            return True
+    return False
+
+
+def get_boxes(index: TorchIndex | None) -> list[list[tuple[int, int]]]:
+    """
+    Splits an index into boxes, i.e. one [start, stop) interval per dimension.
+    Ints and slices give one box; each list element gives its own box.
+    """
+    index = index if index is not None else Ix[[None]]
+    per_dim = [_get_dim_intervals(idx) for idx in index.as_index]
+    return [list(box) for box in itertools.product(*per_dim)]
+
+
+class _BoxTable:
+    """Boxes of the nodes on one hook point, as [start, stop) tensors of shape (n_boxes, n_dims)."""
+
+    def __init__(self, boxes: list[list[tuple[int, int]]], owners: list[int]):
+        n_dims = max(len(box) for box in boxes)
+        # missing trailing dims select everything, as when indexing a tensor
+        padded = [box + [(0, _UNBOUNDED)] * (n_dims - len(box)) for box in boxes]
+        bounds = t.tensor(padded, dtype=t.long)
+        self.starts = bounds[..., 0]
+        self.stops = bounds[..., 1]
+        self.owners = t.tensor(owners, dtype=t.long)
+
+    @property
+    def n_dims(self) -> int:
+        return self.starts.shape[1]
+
+    def padded(self, n_dims: int) -> tuple[Tensor, Tensor]:
+        extra = n_dims - self.n_dims
+        starts = t.nn.functional.pad(self.starts, (0, extra), value=0)
+        stops = t.nn.functional.pad(self.stops, (0, extra), value=_UNBOUNDED)
+        return starts, stops
+
+
+class NodeIndex:
+    """
+    An indexed set of LLNodes. Nodes are grouped by hook name and each node's index is
+    stored as [start, stop) intervals per dimension, so that intersection, complement
+    and membership queries for many nodes at once are answered with tensor comparisons
+    instead of pairwise TorchIndex.intersects calls.
+    Subspaces are ignored, as in node_picker.nodes_intersect.
+    Nodes with negative indices (e.g. Ix[:, -1]) cannot be placed without the dimension
+    sizes, so they are compared pairwise with TorchIndex.intersects instead.
+    """
+
+    def __init__(self, nodes: Iterable[LLNode], max_chunk_elements: int = 2**24):
+        self.nodes = list(dict.fromkeys(nodes))
+        self.max_chunk_elements = max_chunk_elements
+        self._tables = self._make_tables(self.nodes)
+        self._nodes_by_name: dict[str, list[LLNode]] = {}
+        self._negative_nodes_by_name: dict[str, list[LLNode]] = {}
+        for node in self.nodes:
+            self._nodes_by_name.setdefault(node.name, []).append(node)
+            if has_negative_bounds(node.index):
+                self._negative_nodes_by_name.setdefault(node.name, []).append(node)
+
+    @staticmethod
+    def _make_tables(nodes: Sequence[LLNode]) -> dict[str, _BoxTable]:
+        """Box tables of the nodes without negative indices, with owners indexing into nodes."""
+        boxes: dict[str, list[list[tuple[int, int]]]] = {}
+        owners: dict[str, list[int]] = {}
+        for i, node in enumerate(nodes):
+            if has_negative_bounds(node.index):
+                continue
+            node_boxes = get_boxes(node.index)
+            boxes.setdefault(node.name, []).extend(node_boxes)
+            owners.setdefault(node.name, []).extend([i] * len(node_boxes))
+        return {name: _BoxTable(boxes[name], owners[name]) for name in boxes}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, node: object) -> bool:
+        return isinstance(node, LLNode) and bool(self.contains([node]).item())
+
+    def contains(self, nodes: Sequence[LLNode]) -> Tensor:
+        """Returns a boolean tensor telling, for each of nodes, whether it is in the set."""
+        members = set(self.nodes)
+        return t.tensor([node in members for node in nodes], dtype=t.bool)
+
+    def intersects(self, nodes: Sequence[LLNode]) -> Tensor:
+        """
+        Returns a boolean tensor telling, for each of nodes, whether it
+        shares any activation element with a node in the set.
+        """
+        hits = t.zeros(len(nodes), dtype=t.bool)
+        queries = self._make_tables(nodes)
+        for name, query in queries.items():
+            if name not in self._tables:
+                continue
+            table = self._tables[name]
+            n_dims = max(table.n_dims, query.n_dims)
+            starts, stops = table.padded(n_dims)
+            q_starts, q_stops = query.padded(n_dims)
+
+            chunk_size = max(1, self.max_chunk_elements // (len(starts) * n_dims))
+            box_hits = []
+            for i in range(0, len(q_starts), chunk_size):
+                qs = q_starts[i : i + chunk_size, None]
+                qe = q_stops[i : i + chunk_size, None]
+                overlap = (qs < stops[None]) & (starts[None] < qe)
+                box_hits.append(overlap.all(dim=-1).any(dim=-1))
+            # a node hits if any of its boxes does
+            node_hits = t.zeros(len(nodes), dtype=t.long)
+            node_hits.index_add_(0, query.owners, t.cat(box_hits).long())
+            hits |= node_hits > 0
+
+        for i, node in enumerate(nodes):
+            if hits[i]:
+                continue
+            others = (
+                self._nodes_by_name.get(node.name, [])
+                if has_negative_bounds(node.index)
+                else self._negative_nodes_by_name.get(node.name, [])
+            )
+            index = node.index if node.index is not None else Ix[[None]]
+            hits[i] = any(index.intersects(other.index) for other in others)
+        return hits
+
+    def intersection(self, nodes: Sequence[LLNode]) -> list[LLNode]:
+        """Returns the nodes that intersect the set, in their original order."""
+        hits = self.intersects(nodes)
+        return [node for node, hit in zip(nodes, hits.tolist()) if hit]
+
+    def complement(self, nodes: Sequence[LLNode]) -> list[LLNode]:
+        """Returns the nodes that do not intersect the set, in their original order."""
+        hits = self.intersects(nodes)
+        return [node for node, hit in zip(nodes, hits.tolist()) if not hit]
@@ -1,7 +1,10 @@
+from typing import Iterable
+
 import torch as t
 from transformer_lens import HookedTransformer
 
 import iit.utils.index as index
+from iit.utils.node_index import NodeIndex
 from iit.utils.nodes import LLNode
 from iit.utils.correspondence import Correspondence
 
@@ -13,35 +16,82 @@ def get_all_nodes(
         "attn": "attn.hook_result",
         "mlp": "mlp.hook_post",
     },
+    head_dims_per_node: int | None = None,
+    mlp_neurons_per_node: int | None = None,
 ) -> list[LLNode]:
+    """
+    Returns one node per attention head and one per MLP layer.
+    If head_dims_per_node is set, each head is further split into nodes over
+    chunks of its last dimension; if mlp_neurons_per_node is set, each MLP
+    layer is split into nodes over chunks of its neurons.
+    """
     nodes = []
     n_heads = model.cfg.n_heads
     n_layers = model.cfg.n_layers
     for layer in range(n_layers):
         hook_point = f"blocks.{layer}.{suffixes['attn']}"
         for head in range(n_heads):
-            head_node = LLNode(hook_point, index.Ix[:, :, head, :])
-            nodes.append(head_node)
+            if head_dims_per_node is None:
+                nodes.append(LLNode(hook_point, index.Ix[:, :, head, :]))
+                continue
+            head_dims = _get_last_dim_size(model, suffixes["attn"])
+            for dims in _split_dim(head_dims, head_dims_per_node):
+                nodes.append(LLNode(hook_point, index.Ix[:, :, head, dims]))
         hook_point = f"blocks.{layer}.{suffixes['mlp']}"
-        nodes.append(LLNode(hook_point, index.Ix[[None]]))
+        if mlp_neurons_per_node is None:
+            nodes.append(LLNode(hook_point, index.Ix[[None]]))
+            continue
+        neurons = _get_last_dim_size(model, suffixes["mlp"])
+        for dims in _split_dim(neurons, mlp_neurons_per_node):
+            nodes.append(LLNode(hook_point, index.Ix[:, :, dims]))
     return nodes
 
 
+def _get_last_dim_size(model: HookedTransformer, suffix: str) -> int:
+    hook_type = suffix.split(".")[-1]
+    if hook_type in ["hook_q", "hook_k", "hook_v", "hook_z"]:
+        return model.cfg.d_head
+    if hook_type in ["hook_pre", "hook_post"]:
+        return model.cfg.d_mlp
+    return model.cfg.d_model
+
+
+def _split_dim(size: int, width: int) -> list[int | slice]:
+    if width < 1:
+        raise ValueError(f"Expected a positive node width, got {width}")
+    if width == 1:
+        return list(range(size))
+    return [slice(start, min(start + width, size)) for start in range(0, size, width)]
+
+
+def get_hook_names(nodes: Iterable[LLNode]) -> list[str]:
+    """
+    Returns the (deduplicated) hook names the given nodes live on.
+    Used as a names_filter so that only the activations we patch get cached.
+    """
+    hook_names = []
+    for node in nodes:
+        if node.name not in hook_names:
+            hook_names.append(node.name)
+    return hook_names
+
+
 def get_nodes_in_circuit(hl_ll_corr: 'Correspondence') -> list[LLNode]:
     nodes_in_circuit = set()
     for hl_node, ll_nodes in hl_ll_corr.items():
         nodes_in_circuit.update(ll_nodes)
     return list(nodes_in_circuit)
 
-def get_all_individual_nodes_in_circuit(ll_model: HookedTransformer, hl_ll_corr: 'Correspondence') -> list[LLNode]:
+def get_all_individual_nodes_in_circuit(
+    ll_model: HookedTransformer,
+    hl_ll_corr: 'Correspondence',
+    head_dims_per_node: int | None = None,
+    mlp_neurons_per_node: int | None = None,
+) -> list[LLNode]:
     suffixes = hl_ll_corr.get_suffixes()
-    all_nodes = get_all_nodes(ll_model, suffixes)
-    nodes_in_circuit = get_nodes_in_circuit(hl_ll_corr)
-    individual_nodes_in_circuit = []
-    for node in all_nodes:
-        if any(nodes_intersect(node, c) for c in nodes_in_circuit):
-            individual_nodes_in_circuit.append(node)
-    return individual_nodes_in_circuit
+    all_nodes = get_all_nodes(ll_model, suffixes, head_dims_per_node, mlp_neurons_per_node)
+    nodes_in_circuit = NodeIndex(get_nodes_in_circuit(hl_ll_corr))
+    return nodes_in_circuit.intersection(all_nodes)
 
 def nodes_intersect(a: LLNode, b: LLNode) -> bool:
     # return true if there is any intersection
@@ -52,16 +102,14 @@ def nodes_intersect(a: LLNode, b: LLNode) -> bool:
 
 def get_nodes_not_in_circuit(
     ll_model: HookedTransformer,
-    hl_ll_corr: 'Correspondence'
+    hl_ll_corr: 'Correspondence',
+    head_dims_per_node: int | None = None,
+    mlp_neurons_per_node: int | None = None,
 ) -> list[LLNode]:
     suffixes = hl_ll_corr.get_suffixes()
-    all_nodes = get_all_nodes(ll_model, suffixes)
-    nodes_in_circuit = get_nodes_in_circuit(hl_ll_corr)
-    nodes_not_in_circuit = []
-    for node in all_nodes:
-        if not any(nodes_intersect(node, c) for c in nodes_in_circuit):
-            nodes_not_in_circuit.append(node)
-    return nodes_not_in_circuit
+    all_nodes = get_all_nodes(ll_model, suffixes, head_dims_per_node, mlp_neurons_per_node)
+    nodes_in_circuit = NodeIndex(get_nodes_in_circuit(hl_ll_corr))
+    return nodes_in_circuit.complement(all_nodes)
 
 
 def get_post_nodes_not_in_circuit(
@@ -96,8 +144,7 @@ def _get_param_idx(
     node_idx = node.index
     none_ix = index.Ix[[None]]
 
-    if node.subspace is not None:
-        raise NotImplementedError("Subspaces are not supported")
+    # a subspace lives inside the node's index, so the params of the whole index are selected
     if node_idx == none_ix or param_type == "b_O":
         param_idx = none_ix
     elif param_type in ["W_Q", "W_K", "W_V", "W_O", "b_Q", "b_K", "b_V"]:
@@ -169,15 +216,11 @@ def get_params_not_in_circuit(
     ll_model: HookedTransformer,
     filter_out_embed: bool = True,
 ) -> list[LLParamNode]:
-    nodes_in_circuit = get_nodes_in_circuit(hl_ll_corr)
+    nodes_in_circuit = NodeIndex(get_nodes_in_circuit(hl_ll_corr))
     all_params = get_all_params(ll_model)
-    params_not_in_circuit = []
-    for param in all_params:
-        if filter_out_embed and "embed" in param.name:
-            continue
-        if not any(nodes_intersect(param, c) for c in nodes_in_circuit):
-            params_not_in_circuit.append(param)
-    return params_not_in_circuit
+    if filter_out_embed:
+        all_params = [param for param in all_params if "embed" not in param.name]
+    return nodes_in_circuit.complement(all_params)
 
 def find_ll_node_by_name(name: str, list_of_nodes: list[LLNode]) -> list[LLNode]:
     ll_nodes = []
@@ -0,0 +1,104 @@
+import math
+from typing import Callable, Iterator, Optional
+
+import torch as t
+from torch import Tensor
+from transformer_lens.hook_points import HookPoint # type: ignore
+
+from iit.model_pairs.ll_model import LLModel
+from iit.utils.intervention_planner import InterventionPlanner
+from iit.utils.nodes import LLNode
+
+
+class ChunkSizer:
+    """
+    Picks how many copies of a batch to tile into one forward: chunk_size if given, else as
+    many as keep the activations of the forward within memory_budget bytes.
+    """
+
+    def __init__(self, chunk_size: Optional[int] = None, memory_budget: int = 2**30):
+        assert chunk_size is None or chunk_size > 0, ValueError(
+            f"Expected a positive chunk size, got {chunk_size}"
+        )
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        # (sequence length measured at, bytes per sample), by input dtype and sample shape
+        self._activation_bytes: dict[tuple, tuple[int, int]] = {}
+
+    def get_activation_bytes(self, model: LLModel, x: Tensor) -> int:
+        """
+        Estimated bytes of all hook point activations and the output of a forward on x, summed.
+        They are measured once, with a hooked forward on one sample, and scaled by the batch size.
+        For token inputs of shape (batch, seq), one measurement serves every sequence length,
+        scaled linearly when shorter and quadratically (as attention patterns grow) when longer.
+        Other inputs are measured once per sample shape.
+        """
+        is_tokens = x.dim() == 2
+        key = (x.dtype, None if is_tokens else tuple(x.shape[1:]))
+        if key not in self._activation_bytes:
+            n_bytes = 0
+
+            def count_hook(hook_point_out: Tensor, hook: HookPoint) -> None:
+                nonlocal n_bytes
+                n_bytes += hook_point_out.nbytes
+
+            with t.no_grad():
+                out = model.run_with_hooks(x[:1], fwd_hooks=[(lambda name: True, count_hook)])
+            self._activation_bytes[key] = (x.shape[1] if is_tokens else 1, n_bytes + out.nbytes)
+        measured_len, sample_bytes = self._activation_bytes[key]
+        scale = float(x.shape[0])
+        if is_tokens and x.shape[1] != measured_len:
+            ratio = x.shape[1] / measured_len
+            scale *= max(ratio, ratio**2)
+        return math.ceil(sample_bytes * scale)
+
+    def get_chunk_size(self, model: LLModel, x: Tensor, n_nodes: int) -> int:
+        """Number of copies of x, out of n_nodes, to run in one forward."""
+        if self.chunk_size is not None:
+            return max(1, min(self.chunk_size, n_nodes))
+        chunk_size = self.memory_budget // max(1, self.get_activation_bytes(model, x))
+        return max(1, min(chunk_size, n_nodes))
+
+    def chunk(self, model: LLModel, x: Tensor, nodes: list) -> list[list]:
+        chunk_size = self.get_chunk_size(model, x, len(nodes))
+        return [nodes[i : i + chunk_size] for i in range(0, len(nodes), chunk_size)]
+
+
+class NodeSweep:
+    """
+    Ablates each of nodes separately with one forward per chunk of nodes instead of one per node.
+    The batch is tiled once per node in the chunk, and a single hook per hook name patches
+    every tile at its own node (see InterventionPlanner.make_replica_patch_hooks).
+    chunk_size defaults to the largest that keeps the activations of a forward within memory_budget bytes.
+    """
+
+    def __init__(
+        self,
+        nodes: list[LLNode],
+        chunk_size: Optional[int] = None,
+        memory_budget: int = 2**30,
+    ):
+        self.nodes = list(nodes)
+        self.sizer = ChunkSizer(chunk_size, memory_budget)
+        self.planner = InterventionPlanner()
+
+    def get_chunk_size(self, model: LLModel, x: Tensor) -> int:
+        return self.sizer.get_chunk_size(model, x, len(self.nodes))
+
+    def run(
+        self,
+        model: LLModel,
+        x: Tensor,
+        get_source: Callable[[str], Tensor | float],
+    ) -> Iterator[tuple[list[LLNode], Tensor]]:
+        """
+        Yields (chunk, outputs) with outputs[k] the output of model on x with chunk[k] patched
+        from get_source(chunk[k].name), which is broadcast against a single copy of the batch.
+        """
+        for chunk in self.sizer.chunk(model, x, self.nodes):
+            fwd_hooks = self.planner.make_replica_patch_hooks(
+                [[node] for node in chunk], x.shape[0], get_source
+            )
+            tiled_x = x.repeat(len(chunk), *([1] * (x.dim() - 1)))
+            out = model.run_with_hooks(tiled_x, fwd_hooks=fwd_hooks)
+            yield chunk, out.reshape(len(chunk), -1, *out.shape[1:])
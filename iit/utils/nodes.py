@@ -1,4 +1,3 @@
-import dataclasses
 from dataclasses import dataclass
 import torch as t
 from typing import Optional
@@ -37,12 +36,19 @@ class LLNode:
     subspace: Optional[t.Tensor] = None
 
     def __eq__(self, other: object) -> bool:
-        return isinstance(other, LLNode) and dataclasses.astuple(
-            self
-        ) == dataclasses.astuple(other)
+        if not isinstance(other, LLNode):
+            return False
+        if (self.name, self.index) != (other.name, other.index):
+            return False
+        # subspaces are compared by value, tensors are not hashable by value
+        if self.subspace is None or other.subspace is None:
+            return self.subspace is None and other.subspace is None
+        return self.subspace.shape == other.subspace.shape and bool(
+            t.equal(self.subspace.cpu(), other.subspace.cpu())
+        )
 
     def __hash__(self) -> int:
-        return hash(dataclasses.astuple(self))
+        return hash((self.name, self.index))
 
     def get_index(self) -> tuple[slice]:
         if self.index is None:
@@ -0,0 +1,170 @@
+from typing import Iterator, Optional
+
+import numpy as np
+from torch.utils.data import Sampler
+
+PAIR_SCHEDULE_MODES = ["random", "product", "strided", "sampled"]
+
+
+class PairSchedule:
+    """
+    Draws the (base, ablation) index arrays of a whole epoch in one vectorized call.
+    The arrays are reproducible from (seed, epoch); with resample_every_epoch=False
+    every epoch reuses the pairs of epoch 0.
+
+    Modes:
+        random: num_pairs (default n_base) independent uniform draws.
+        product: every combination, shuffled. Materializes n_base * n_ablation indices.
+        strided: every base paired with num_pairs // n_base ablations, shifted by a
+            stride every epoch, so that n_ablation / (num_pairs // n_base) epochs
+            cover the whole product once.
+        sampled: num_pairs combinations sampled without replacement from the product.
+    """
+
+    def __init__(
+        self,
+        n_base: int,
+        n_ablation: int,
+        mode: str = "random",
+        num_pairs: Optional[int] = None,
+        seed: int = 0,
+        resample_every_epoch: bool = True,
+    ):
+        if mode not in PAIR_SCHEDULE_MODES:
+            raise ValueError(f"Unexpected pair schedule mode: {mode}, expected one of {PAIR_SCHEDULE_MODES}")
+        self.n_base = n_base
+        self.n_ablation = n_ablation
+        self.mode = mode
+        self.seed = seed
+        self.resample_every_epoch = resample_every_epoch
+
+        if mode == "product":
+            num_pairs = n_base * n_ablation
+        elif num_pairs is None:
+            num_pairs = n_base
+        if mode == "strided":
+            # round to whole ablation strides per base
+            num_pairs = n_base * max(1, min(num_pairs // n_base, n_ablation))
+        if mode == "sampled" and num_pairs > n_base * n_ablation:
+            raise ValueError(
+                f"Cannot sample {num_pairs} pairs without replacement from {n_base * n_ablation} combinations"
+            )
+        self.num_pairs = num_pairs
+
+    def __len__(self) -> int:
+        return self.num_pairs
+
+    def get_indices(self, epoch: int = 0) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the base and ablation index arrays of the given epoch."""
+        if not self.resample_every_epoch:
+            epoch = 0
+        rng = np.random.default_rng([self.seed, epoch])
+
+        if self.mode == "random":
+            base = rng.integers(self.n_base, size=self.num_pairs)
+            ablation = rng.integers(self.n_ablation, size=self.num_pairs)
+            return base, ablation
+        if self.mode == "product":
+            flat = rng.permutation(self.num_pairs)
+        elif self.mode == "sampled":
+            flat = rng.choice(self.n_base * self.n_ablation, size=self.num_pairs, replace=False)
+        else:
+            ablations_per_base = self.num_pairs // self.n_base
+            base = np.repeat(np.arange(self.n_base), ablations_per_base)
+            offset = np.tile(np.arange(ablations_per_base), self.n_base) + epoch * ablations_per_base
+            order = rng.permutation(self.num_pairs)
+            return base[order], ((base + offset) % self.n_ablation)[order]
+        return flat // self.n_ablation, flat % self.n_ablation
+
+
+class PairBatchSampler(Sampler[np.ndarray]):
+    """
+    Batch sampler over a PairSchedule. Each batch is an int64 array of shape (batch_size, 2)
+    holding (base_index, ablation_index) rows, which IITDataset.__getitems__ indexes directly.
+    The epoch advances every time the sampler is iterated.
+    """
+
+    def __init__(self, schedule: PairSchedule, batch_size: int, drop_last: bool = False):
+        self.schedule = schedule
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        base, ablation = self.schedule.get_indices(self.epoch)
+        self.epoch += 1
+        pairs = np.stack([base, ablation], axis=1).astype(np.int64)
+        for batch in range(len(self)):
+            yield pairs[batch * self.batch_size : (batch + 1) * self.batch_size]
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.schedule) // self.batch_size
+        return -(-len(self.schedule) // self.batch_size)
+
+
+class LengthBucketBatchSampler(Sampler[np.ndarray]):
+    """
+    Batch sampler that only pairs samples of equal length, so that batches need no padding.
+    Every epoch, each base index is paired with a uniformly drawn ablation index of the same
+    length, and each batch holds pairs of a single length. Batches are (batch_size, 2) int64
+    (base_index, ablation_index) rows like PairBatchSampler's, in a shuffled order.
+    The pairs are reproducible from (seed, epoch). If fixed_epoch is set, every iteration
+    yields the batches of that epoch, e.g. so that a validation set is scored on the same pairs.
+    """
+
+    def __init__(
+        self,
+        base_lengths: np.ndarray,
+        ablation_lengths: np.ndarray,
+        batch_size: int,
+        seed: int = 0,
+        drop_last: bool = False,
+        fixed_epoch: Optional[int] = None,
+    ):
+        base_lengths = np.asarray(base_lengths)
+        ablation_lengths = np.asarray(ablation_lengths)
+        self.buckets = {
+            length: (np.flatnonzero(base_lengths == length), np.flatnonzero(ablation_lengths == length))
+            for length in np.unique(base_lengths).tolist()
+        }
+        missing = [length for length, (_, ablation) in self.buckets.items() if len(ablation) == 0]
+        if missing:
+            raise ValueError(f"No ablation samples of length {missing} to pair base samples with")
+        self.batch_size = batch_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.fixed_epoch = fixed_epoch
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def get_batches(self, epoch: int = 0) -> list[np.ndarray]:
+        rng = np.random.default_rng([self.seed, epoch])
+        batches = []
+        for base, ablation in self.buckets.values():
+            pairs = np.stack([rng.permutation(base), rng.choice(ablation, size=len(base))], axis=1)
+            for start in range(0, len(pairs), self.batch_size):
+                batch = pairs[start : start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.astype(np.int64))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        if self.fixed_epoch is not None:
+            yield from self.get_batches(self.fixed_epoch)
+            return
+        batches = self.get_batches(self.epoch)
+        self.epoch += 1
+        yield from batches
+
+    def __len__(self) -> int:
+        n_batches = [
+            len(base) // self.batch_size if self.drop_last else -(-len(base) // self.batch_size)
+            for base, _ in self.buckets.values()
+        ]
+        return sum(n_batches)
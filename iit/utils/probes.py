@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Optional
 
 import torch as t
 import torch.nn as nn
@@ -6,6 +6,7 @@ from torch import Tensor
 from tqdm import tqdm
 
 from iit.model_pairs.base_model_pair import HLNode, LLNode, BaseModelPair
+from iit.utils.activation_store import ActivationStore, IndexedDataset
 from iit.utils.config import DEVICE
 
 
@@ -42,12 +43,37 @@ def construct_probes(model_pair: BaseModelPair, input_shape: t.Size, bias: bool
     return probes
 
 
+def get_probe_cache(
+    model_pair: BaseModelPair,
+    x: Tensor,
+    indices: Tensor,
+    hook_names: list[str],
+    activation_store: Optional[ActivationStore] = None,
+) -> dict[str, Tensor]:
+    """
+    LL activations of a batch at hook_names, read from activation_store by sample index
+    if one is given instead of running the ll model.
+    """
+    if activation_store is None:
+        _, cache = model_pair.ll_model.run_with_cache(x)
+        return cache
+    return {
+        name: activation_store.get(name, indices).to(DEVICE, t.get_default_dtype())
+        for name in hook_names
+    }
+
+
 def train_probes_on_model_pair(
     model_pair: BaseModelPair,
     input_shape: t.Size,
     train_set: t.utils.data.Dataset,
     training_args: dict,
+    activation_store: Optional[ActivationStore] = None,
 ) -> dict[str, dict]:
+    """
+    activation_store: ActivationStore of model_pair.ll_model over train_set (default: None)
+    If given, the probes are trained on its activations instead of running the ll model.
+    """
     probes = construct_probes(model_pair, input_shape=input_shape)
     params = []
     for p in probes.values():
@@ -58,8 +84,9 @@ def train_probes_on_model_pair(
     criterion = nn.CrossEntropyLoss()
     probe_losses: dict[HLNode, list[Tensor]] = {k: [] for k in probes.keys()}
     probe_accuracies: dict[HLNode, list[Tensor]] = {k: [] for k in probes.keys()}
+    hook_names = list({ll_node.name for ll_nodes in model_pair.corr.values() for ll_node in ll_nodes})
     loader = t.utils.data.DataLoader(
-        train_set,
+        IndexedDataset(train_set),
         batch_size=training_args["batch_size"],
         shuffle=True,
         num_workers=training_args["num_workers"],
@@ -67,11 +94,11 @@ def train_probes_on_model_pair(
     for _ in tqdm(range(training_args["epochs"])):
         probe_accuracy_run = {k: t.zeros(1) for k in probes.keys()}
         probe_loss_run = {k: t.zeros(1) for k in probes.keys()}
-        for x, y, int_vars in loader:
+        for indices, x, y, int_vars in loader:
             probe_optimizer.zero_grad()
             x = x.to(DEVICE)
             y = y.to(DEVICE)
-            out, cache = model_pair.ll_model.run_with_cache(x)
+            cache = get_probe_cache(model_pair, x, indices, hook_names, activation_store)
             probe_loss = t.zeros(1)
             for hl_node_name, probe in probes.items():
                 ll_nodes = model_pair.corr[hl_node_name]
@@ -104,8 +131,13 @@ def evaluate_probe(
         probes: dict[str, nn.Linear],
         model_pair: BaseModelPair, 
         test_set: t.utils.data.Dataset, 
-        criterion: Callable[[Tensor, Tensor], Tensor]
+        criterion: Callable[[Tensor, Tensor], Tensor],
+        activation_store: Optional[ActivationStore] = None,
         ) -> dict[str, dict]:
+    """
+    activation_store: ActivationStore of model_pair.ll_model over test_set (default: None)
+    If given, the probes are evaluated on its activations instead of running the ll model.
+    """
     probe_stats: dict[str, dict] = {}
     probe_stats["test loss"] = {}
     probe_stats["test accuracy"] = {}
@@ -114,14 +146,16 @@ def evaluate_probe(
         probe_loss = t.zeros(1)
         probe_accuracy = t.zeros(1)
         loader = t.utils.data.DataLoader(
-            test_set, batch_size=256, shuffle=True, num_workers=0
+            IndexedDataset(test_set), batch_size=256, shuffle=True, num_workers=0
         )
         with t.no_grad():
-            for x, y, int_vars in loader:
+            for indices, x, y, int_vars in loader:
                 x = x.to(DEVICE)
                 y = y.to(DEVICE)
-                _, cache = model_pair.ll_model.run_with_cache(x)
                 ll_nodes = model_pair.corr[hl_node_name]
+                cache = get_probe_cache(
+                    model_pair, x, indices, [ll_node.name for ll_node in ll_nodes], activation_store
+                )
                 gt = model_pair.hl_model.get_idx_to_intermediate(hl_node_name)(
                     int_vars
                 ).to(DEVICE)
@@ -0,0 +1,168 @@
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch as t
+from torch import Tensor
+
+SAMPLE_CACHE_BACKENDS = ["memory", "shared", "mmap"]
+
+
+class LRUSampleCache:
+    """
+    Per-process cache of samples (tuples of tensors) by index, evicting the least recently
+    used samples once max_bytes is exceeded. max_bytes=None never evicts.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.items: OrderedDict[int, tuple[Tensor, ...]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, index: int) -> Optional[tuple[Tensor, ...]]:
+        item = self.items.get(index)
+        if item is not None:
+            self.items.move_to_end(index)
+        return item
+
+    def put(self, index: int, item: tuple[Tensor, ...]) -> None:
+        if index in self.items:
+            return
+        # copies, so that a cached view does not keep a whole batch alive
+        item = tuple(field.clone() for field in item)
+        self.items[index] = item
+        self.n_bytes += sum(field.nbytes for field in item)
+        while self.max_bytes is not None and self.n_bytes > self.max_bytes and len(self.items) > 0:
+            _, evicted = self.items.popitem(last=False)
+            self.n_bytes -= sum(field.nbytes for field in evicted)
+
+
+class SlotSampleCache:
+    """
+    Direct-mapped cache of fixed-shape samples: index i lives in slot i % n_slots and evicts
+    whatever was there. The slots are preallocated either in shared memory, so that DataLoader
+    workers started after construction see one copy, or in .npy files under path, which
+    are memory-mapped by every worker and reused by later runs.
+
+    There is no locking. A slot's key is cleared before its fields are written and set after,
+    and get re-checks the key after copying. This is only safe for samples that are a
+    deterministic function of their index, since two writers of the same index write the same bytes.
+    """
+
+    def __init__(
+        self,
+        n_slots: int,
+        fields: list[tuple[tuple[int, ...], t.dtype]],
+        path: Optional[str] = None,
+    ):
+        assert n_slots > 0, ValueError(f"Expected a positive number of slots, got {n_slots}")
+        self.n_slots = n_slots
+        self.fields = fields
+        self.path = path
+        self.keys: Optional[Tensor] = None
+        self.slots: list[Tensor] = []
+        if path is None:
+            self.keys = t.full((n_slots,), -1, dtype=t.long).share_memory_()  # type: ignore[no-untyped-call]
+            self.slots = [
+                t.zeros((n_slots, *shape), dtype=dtype).share_memory_()  # type: ignore[no-untyped-call]
+                for shape, dtype in fields
+            ]
+        else:
+            self.open()
+
+    def open(self) -> None:
+        """Memory-maps the slot files under self.path, creating them if needed."""
+        assert self.path is not None
+        os.makedirs(self.path, exist_ok=True)
+        keys_file = os.path.join(self.path, "keys.npy")
+        if not os.path.exists(keys_file):
+            for i, (shape, dtype) in enumerate(self.fields):
+                np.lib.format.open_memmap(  # type: ignore[no-untyped-call]
+                    os.path.join(self.path, f"field_{i}.npy"),
+                    mode="w+",
+                    dtype=t.empty(0, dtype=dtype).numpy().dtype,
+                    shape=(self.n_slots, *shape),
+                ).flush()
+            # keys are written last, so an interrupted creation is redone
+            keys = np.lib.format.open_memmap(  # type: ignore[no-untyped-call]
+                keys_file + ".tmp", mode="w+", dtype=np.int64, shape=(self.n_slots,)
+            )
+            keys[:] = -1
+            keys.flush()
+            del keys
+            os.replace(keys_file + ".tmp", keys_file)
+        self.keys = t.from_numpy(np.load(keys_file, mmap_mode="r+"))
+        self.slots = [
+            t.from_numpy(np.load(os.path.join(self.path, f"field_{i}.npy"), mmap_mode="r+"))
+            for i in range(len(self.fields))
+        ]
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if self.path is not None:
+            # workers reopen the files instead of receiving a pickled copy of their contents
+            state["keys"], state["slots"] = None, []
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.open()
+
+    def __len__(self) -> int:
+        assert self.keys is not None
+        return int((self.keys >= 0).sum())
+
+    def get(self, index: int) -> Optional[tuple[Tensor, ...]]:
+        assert self.keys is not None
+        slot = index % self.n_slots
+        if self.keys[slot] != index:
+            return None
+        item = tuple(field[slot].clone() for field in self.slots)
+        if self.keys[slot] != index:
+            return None
+        return item
+
+    def put(self, index: int, item: tuple[Tensor, ...]) -> None:
+        assert self.keys is not None
+        slot = index % self.n_slots
+        self.keys[slot] = -1
+        for field, value in zip(self.slots, item):
+            field[slot] = value
+        self.keys[slot] = index
+
+
+def make_sample_cache(
+    backend: str,
+    fields: list[tuple[tuple[int, ...], t.dtype]],
+    length: int,
+    max_bytes: Optional[int] = None,
+    path: Optional[str] = None,
+) -> LRUSampleCache | SlotSampleCache:
+    """
+    Makes a cache for length samples with the given field shapes and dtypes, using at most
+    about max_bytes.
+        memory: LRUSampleCache, private to each process. max_bytes=None never evicts.
+        shared: SlotSampleCache in shared memory.
+        mmap: SlotSampleCache in files under path.
+    The slot backends allocate max_bytes up front, so they need it to be given.
+    """
+    if backend not in SAMPLE_CACHE_BACKENDS:
+        raise ValueError(f"Unexpected sample cache backend: {backend}, expected one of {SAMPLE_CACHE_BACKENDS}")
+    if backend == "memory":
+        return LRUSampleCache(max_bytes)
+    if max_bytes is None:
+        raise ValueError(f"The {backend} sample cache is preallocated and needs max_bytes")
+    if backend == "mmap" and path is None:
+        raise ValueError("The mmap sample cache needs a path")
+    sample_bytes = sum(int(np.prod(shape)) * t.empty(0, dtype=dtype).element_size() for shape, dtype in fields)
+    n_slots = max(1, min(length, max_bytes // sample_bytes))
+    if backend == "mmap":
+        assert path is not None
+        shapes = "_".join("x".join(map(str, shape)) or "1" for shape, _ in fields)
+        path = os.path.join(path, f"slots_{n_slots}_{shapes}")
+    return SlotSampleCache(n_slots, fields, path=path if backend == "mmap" else None)
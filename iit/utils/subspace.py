@@ -0,0 +1,40 @@
+import torch as t
+from torch import Tensor
+
+
+def get_subspace_factors(subspace: Tensor) -> tuple[Tensor, Tensor]:
+    """
+    Returns (V, U) such that projecting x (over its last dimension) onto the subspace is (x @ V) @ U.T.
+    A (d, k) subspace with k < d is an orthonormal basis, so P = B B^T.
+    A (d, d) subspace is the projection matrix P itself.
+    """
+    if subspace.dim() != 2:
+        raise ValueError(f"Expected a 2D subspace, got shape {tuple(subspace.shape)}")
+    d, k = subspace.shape
+    if k > d:
+        raise ValueError(f"Subspace basis has more vectors ({k}) than dimensions ({d})")
+    if k == d:
+        return subspace, t.eye(d, dtype=subspace.dtype, device=subspace.device)
+    return subspace, subspace
+
+
+def project_onto_subspace(x: Tensor, subspace: Tensor) -> Tensor:
+    V, U = get_subspace_factors(subspace.to(x.device, x.dtype))
+    return (x @ V) @ U.T
+
+
+def patch_subspace(base: Tensor, source: Tensor, subspace: Tensor) -> Tensor:
+    """Distributed interchange: base + P(source - base)."""
+    return base + project_onto_subspace(source - base, subspace)
+
+
+def stack_subspace_factors(subspaces: list[Tensor]) -> tuple[Tensor, Tensor]:
+    """
+    Stacks the factors of subspaces over the same dimension into (n, d, k_max) tensors,
+    zero-padding the bases of smaller subspaces.
+    """
+    factors = [get_subspace_factors(subspace) for subspace in subspaces]
+    k_max = max(V.shape[1] for V, _ in factors)
+    V_stack = t.stack([t.nn.functional.pad(V, (0, k_max - V.shape[1])) for V, _ in factors])
+    U_stack = t.stack([t.nn.functional.pad(U, (0, k_max - U.shape[1])) for _, U in factors])
+    return V_stack, U_stack
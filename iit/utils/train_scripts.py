@@ -1,4 +1,5 @@
 from transformer_lens import HookedTransformer
+from transformers import AutoTokenizer
 
 from iit.model_pairs.ioi_model_pair import IOI_ModelPair
 from iit.utils.iit_dataset import train_test_split
@@ -6,6 +7,8 @@ from iit.model_pairs.base_model_pair import *
 from iit.utils.metric import *
 from iit.tasks.ioi import (
     make_ioi_dataset_and_hl,
+    make_ioi_vocab_from_config,
+    get_gpt2_cfg,
     make_corr_dict,
     ioi_cfg,
     suffixes
@@ -31,20 +34,23 @@ def train_ioi(args: IOIArgParseNamespace) -> IOI_ModelPair:
         "clip_grad_norm": args.clip_grad_norm,
         "early_stop": True,
         "use_single_loss": args.use_single_loss,
+        "fused_train_step": args.use_single_loss, # no batch dependent layers in the ioi model
     }
     t.manual_seed(0)
     np.random.seed(0)
 
-    ll_cfg = HookedTransformer.from_pretrained(
-        "gpt2"
-    ).cfg.to_dict()
+    ll_cfg = get_gpt2_cfg()
     ll_cfg.update(ioi_cfg)
+    vocab = None
+    if args.compact_vocab:
+        vocab = make_ioi_vocab_from_config(AutoTokenizer.from_pretrained(ll_cfg["tokenizer_name"]))
+        ll_cfg["d_vocab"] = ll_cfg["d_vocab_out"] = len(vocab)
 
     ll_cfg["init_weights"] = True
     ll_model = HookedTransformer(ll_cfg).to(device)
     print("making ioi dataset and hl")
     ioi_dataset, hl_model = make_ioi_dataset_and_hl(
-        num_samples, ll_model, device=device, verbose=True
+        num_samples, ll_model, device=device, verbose=True, vocab=vocab
     )
     print("making IIT dataset")
     train_ioi_dataset, test_ioi_dataset = train_test_split(
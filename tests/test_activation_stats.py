@@ -0,0 +1,50 @@
+import torch
+
+from iit.utils.activation_stats import ActivationMoments, get_activation_moments
+from iit.utils.eval_ablations import get_mean_cache
+from iit.utils.eval_datasets import IITUniqueDataset
+from tests.test_model_pairs import get_test_ioi_model_pair_ingredients
+
+
+def test_activation_moments_are_exact_over_uneven_batches():
+    x = torch.randn(23, 3, 5, dtype=torch.float64) * 10 + 3
+    for dtype in [torch.float32, torch.float64]:
+        moments = ActivationMoments(dtype)
+        for batch in x.float().split([8, 8, 7, 0]):
+            moments.update(batch)
+        assert moments.count == 23 and moments.mean.dtype == dtype
+        atol = 1e-10 if dtype == torch.float64 else 1e-4
+        assert torch.allclose(moments.mean, x.float().double().mean(dim=0).to(dtype), atol=atol)
+        assert torch.allclose(moments.variance, x.float().double().var(dim=0, unbiased=False).to(dtype), atol=atol * 100)
+        restored = ActivationMoments.from_state_dict(moments.state_dict())
+        assert restored.count == 23 and restored.activation_dtype == torch.float32
+        assert torch.equal(restored.mean, moments.mean)
+
+
+def test_mean_cache_is_filtered_exact_and_persisted(tmp_path):
+    ll_model, _, _, _, _ = get_test_ioi_model_pair_ingredients()
+    xs = torch.randint(0, 40, (11, 9), generator=torch.Generator().manual_seed(0))
+    data = [(x, x) for x in xs]
+    dataset = IITUniqueDataset(data, data, device=torch.device("cpu"))
+    hook_names = ["blocks.0.attn.hook_z", "blocks.1.mlp.hook_post"]
+
+    mean_cache = get_mean_cache(ll_model.model, dataset, batch_size=4, hook_names=hook_names, dtype=torch.float64)
+    assert set(mean_cache.keys()) == set(hook_names)
+    _, full_cache = ll_model.run_with_cache(xs)
+    for name in hook_names:
+        assert mean_cache[name].dtype == torch.float32 and mean_cache[name].shape == (1, *full_cache[name].shape[1:])
+        assert torch.allclose(mean_cache[name], full_cache[name].mean(dim=0, keepdim=True), atol=1e-5)
+
+    moments = get_activation_moments(ll_model, dataset, hook_names, batch_size=4, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    calls = []
+    ll_model.embed.register_forward_hook(lambda *args: calls.append(1))
+    reloaded = get_activation_moments(ll_model, dataset, hook_names, batch_size=4, cache_dir=str(tmp_path))
+    assert calls == []
+    for name in hook_names:
+        assert torch.equal(reloaded[name].mean, moments[name].mean)
+
+    with torch.no_grad():
+        ll_model.embed.W_E[0] += 1
+    get_activation_moments(ll_model, dataset, hook_names, batch_size=4, cache_dir=str(tmp_path))
+    assert len(calls) > 0 and len(list(tmp_path.iterdir())) == 2
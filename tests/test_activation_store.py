@@ -0,0 +1,69 @@
+import json
+
+import torch
+
+from iit.utils.activation_store import ActivationStore, IndexedDataset
+from iit.utils.eval_ablations import get_mean_cache
+from iit.utils.eval_datasets import IITUniqueDataset
+from tests.test_model_pairs import get_test_ioi_model_pair_ingredients
+
+
+def make_store_ingredients():
+    ll_model, _, _, _, _ = get_test_ioi_model_pair_ingredients()
+    xs = torch.randint(0, 40, (11, 9), generator=torch.Generator().manual_seed(0))
+    data = [(x, x) for x in xs]
+    return ll_model, xs, IITUniqueDataset(data, data, device=torch.device("cpu"))
+
+
+def test_activation_store_matches_cache(tmp_path):
+    ll_model, xs, dataset = make_store_ingredients()
+    hook_names = ["blocks.0.attn.hook_z", "blocks.1.hook_resid_post"]
+    _, cache = ll_model.run_with_cache(xs)
+
+    for dtype in [None, torch.float16, torch.bfloat16]:
+        path = tmp_path / str(dtype)
+        store = ActivationStore.build(ll_model, dataset, str(path), hook_names, batch_size=3, chunk_size=4, dtype=dtype)
+        assert len(store) == 11 and store.n_chunks == 3
+        assert sorted(p.name for p in (path / hook_names[0]).iterdir()) == [f"chunk_0000{i}.npy" for i in range(3)]
+        for name in hook_names:
+            expected = cache[name] if dtype is None else cache[name].to(dtype)
+            assert store.get_dtype(name) == expected.dtype
+            assert torch.equal(torch.cat(list(store.iter_chunks(name))), expected)
+            assert torch.equal(store.get(name, [10, 0, 5, 4]), expected[[10, 0, 5, 4]])
+            assert torch.equal(store.get(name, slice(2, 9)), expected[2:9])
+            view = store.get(name, slice(5, 7))
+            assert view.data_ptr() == store.get_chunk(name, 1)[1:].data_ptr()
+
+    mean_cache = get_mean_cache(ll_model.model, dataset, batch_size=4, hook_names=hook_names)
+    stored_means = get_mean_cache(ll_model.model, dataset, hook_names=hook_names, activation_store=ActivationStore(str(tmp_path / "None")))
+    for name in hook_names:
+        assert torch.allclose(mean_cache[name], stored_means[name], atol=1e-6)
+
+
+def test_activation_store_is_reused_for_same_model_and_dataset(tmp_path):
+    ll_model, xs, dataset = make_store_ingredients()
+    hook_names = ["blocks.0.hook_resid_post"]
+    path = str(tmp_path / "store")
+    ActivationStore.load_or_build(ll_model, dataset, path, hook_names, batch_size=4, chunk_size=5)
+    with open(tmp_path / "store" / "manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest["hooks"] == {hook_names[0]: {"shape": [9, 32], "dtype": "float32"}}
+
+    calls = []
+    ll_model.embed.register_forward_hook(lambda *args: calls.append(1))
+    store = ActivationStore.load_or_build(ll_model, dataset, path, hook_names, batch_size=4, chunk_size=5)
+    assert calls == [] and store.chunk_size == 5
+    ActivationStore.load_or_build(ll_model, dataset, path, ["blocks.1.hook_resid_post"], batch_size=4)
+    assert len(calls) > 0
+
+    calls.clear()
+    with torch.no_grad():
+        ll_model.embed.W_E[0] += 1
+    store = ActivationStore.load_or_build(ll_model, dataset, path, hook_names, batch_size=4)
+    assert len(calls) > 0 and store.hook_names == hook_names
+
+    indexed = IndexedDataset(dataset)
+    index, x, _ = indexed[3]
+    assert index == 3 and torch.equal(x, xs[3])
+    _, cache = ll_model.run_with_cache(xs[[3]])
+    assert torch.allclose(store.get(hook_names[0], [index]), cache[hook_names[0]], atol=1e-5)
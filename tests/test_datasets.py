@@ -7,6 +7,8 @@ TODO: Add tests for the datasets module.
 
 import numpy as np
 import torch as t
+import torchvision
+from PIL import Image, ImageOps
 from torch.utils.data import Dataset
 from iit.tasks.mnist_pvr.dataset import ImagePVRDataset
 from iit.tasks.mnist_pvr.pvr_check_leaky_hl import MNIST_PVR_Leaky_HL
@@ -86,3 +88,56 @@ def test_patch_quadrant():
     assert t.all(patch_br_out[0][0][tl_idx] == image[tl_idx])  # top left
     assert t.all(patch_br_out[0][0][tr_idx] == image[tr_idx])  # top right
     assert t.all(patch_br_out[0][0][bl_idx] == image[bl_idx])  # bottom left
+
+
+def make_random_mnist(n=40, seed=0):
+    rng = np.random.default_rng(seed)
+    images = [Image.fromarray(rng.integers(0, 256, (28, 28), dtype=np.uint8), mode="L") for _ in range(n)]
+    return SmallMNIST(images, [i % 10 for i in range(n)])
+
+
+def compose_with_pil(dataset, index):
+    # the per-sample PIL composition that ImagePVRDataset used to do
+    rng = np.random.default_rng(dataset.seed * dataset.length + index)
+    base_items = [dataset.base_dataset[rng.integers(0, len(dataset.base_dataset))] for _ in range(4)]
+    while dataset.unique_per_quad and len(set(item[1] for item in base_items)) < 4:
+        base_items = [dataset.base_dataset[rng.integers(0, len(dataset.base_dataset))] for _ in range(4)]
+    images = [ImageOps.expand(item[0], border=dataset.pad_size, fill="black") for item in base_items]
+    image = torchvision.transforms.functional.to_tensor(ImagePVRDataset.concatenate_2x2(images))
+    intermediate_vars = t.tensor([item[1] for item in base_items])
+    return image, intermediate_vars[dataset.class_map[base_items[0][1]]], intermediate_vars
+
+
+def test_tensor_composition_matches_pil_composition():
+    base = make_random_mnist()
+    for pad_size, unique_per_quad in [(0, False), (3, True)]:
+        dataset = ImagePVRDataset(base, length=16, seed=2, pad_size=pad_size, unique_per_quad=unique_per_quad)
+        assert dataset.get_input_shape() == (1, 3, (28 + 2 * pad_size) * 2, (28 + 2 * pad_size) * 2)
+        batch = dataset.__getitems__(list(range(16)))
+        for index in range(16):
+            expected = compose_with_pil(dataset, index)
+            for value, batched, reference in zip(dataset[index], batch[index], expected):
+                assert t.equal(value, reference) and t.equal(batched, reference)
+
+
+def test_batched_patch_quadrant():
+    base = make_random_mnist()
+    dataset = ImagePVRDataset(base, length=8, pad_size=2)
+    images, labels, intermediate_vars = (t.stack(field) for field in zip(*dataset.__getitems__(list(range(8)))))
+    hl_model = MNIST_PVR_Leaky_HL()
+    for k, hl_node in enumerate([hl_model.hook_tl, hl_model.hook_tr, hl_model.hook_bl, hl_model.hook_br]):
+        new_images, new_labels, new_vars = dataset.patch_batch_tensors_at_hl(images, intermediate_vars, hl_node)
+        idx, _ = dataset.get_idx_and_intermediate(hl_node)
+        quad_index = (slice(None), *idx.as_index)
+        outside = t.ones_like(images, dtype=t.bool)
+        outside[quad_index] = False
+        assert t.equal(new_images[outside], images[outside])
+        assert t.all(new_vars[:, k] != intermediate_vars[:, k])
+        assert t.equal(new_vars[:, [i for i in range(4) if i != k]], intermediate_vars[:, [i for i in range(4) if i != k]])
+        assert t.equal(new_labels, t.stack([dataset.make_label_from_intermediate(v) for v in new_vars]))
+        for image, label in zip(new_images[quad_index], new_vars[:, k]):
+            matches = [j for j in range(len(base)) if t.equal(dataset.store.images[j].float().div(255).expand(3, -1, -1), image)]
+            assert len(matches) == 1 and base.labels[matches[0]] == label
+
+    draws = dataset.store.sample_excluding_labels(t.full((2000,), 3), np.random.default_rng(0))
+    assert set(draws.tolist()) == {j for j in range(len(base)) if base.labels[j] != 3}
@@ -0,0 +1,177 @@
+import torch
+
+from iit.utils.eval_ablations import (
+    Categorical_Metric,
+    check_causal_effect,
+    check_causal_effect_attribution,
+    check_causal_effect_on_ablation,
+    make_ablation_batch,
+    make_ablation_hook,
+    resample_ablate_node,
+)
+from iit.utils.eval_datasets import IITUniqueDataset
+from iit.utils.iit_dataset import IITDataset
+from iit.utils.index import Ix
+from iit.utils.node_picker import get_all_nodes
+from iit.utils.node_sweep import NodeSweep
+from iit.utils.nodes import LLNode
+from tests.test_model_pairs import get_test_ioi_model_pair_ingredients
+
+
+def make_ioi_eval_model_pair():
+    from iit.model_pairs.ioi_model_pair import IOI_ModelPair
+
+    ll_model, hl_model, corr, _, _ = get_test_ioi_model_pair_ingredients()
+    generator = torch.Generator().manual_seed(0)
+    xs = torch.randint(0, 40, (12, 9), generator=generator)
+    xs[:, 1::2] = torch.tensor([10, 20, 30])[torch.randint(0, 3, (12, 4), generator=generator)]
+    data = [(x, hl_model(x)) for x in xs]
+    model_pair = IOI_ModelPair(hl_model, ll_model, corr, training_args={"next_token": True})
+    return model_pair, IITDataset(data, data, seed=0, device=torch.device("cpu"))
+
+
+def test_shared_ablation_batch_matches_per_node_runs():
+    model_pair, dataset = make_ioi_eval_model_pair()
+    base_in, ablation_in = next(iter(dataset.make_loader(batch_size=12, num_workers=0)))
+    nodes = get_all_nodes(model_pair.ll_model)
+
+    n_forwards = []
+    model_pair.ll_model.embed.register_forward_hook(lambda *args: n_forwards.append(1))
+    with torch.no_grad():
+        for metric in Categorical_Metric:
+            ablation_batch = make_ablation_batch(
+                model_pair, base_in, ablation_in, [node.name for node in nodes], metric
+            )
+            n_forwards.clear()
+            for node in nodes:
+                hook_fn = model_pair.make_ll_ablation_hook(node)
+                shared = resample_ablate_node(
+                    model_pair, base_in, ablation_in, node, hook_fn,
+                    categorical_metric=metric, ablation_batch=ablation_batch,
+                )
+                assert len(n_forwards) == 1
+                n_forwards.clear()
+                separate = resample_ablate_node(
+                    model_pair, base_in, ablation_in, node, hook_fn, categorical_metric=metric
+                )
+                n_forwards.clear()
+                assert abs(shared - separate) < 1e-5, (metric, node)
+
+    results = check_causal_effect(model_pair, dataset, batch_size=4, node_type="a")
+    assert set(results.keys()) == set(nodes)
+
+
+def test_node_sweep_matches_per_node_hooks():
+    model_pair, dataset = make_ioi_eval_model_pair()
+    ll_model = model_pair.ll_model
+    x = torch.stack([dataset.base_data[i][0] for i in range(5)])
+    subspace = torch.linalg.qr(torch.randn(32, 4))[0]
+    nodes = get_all_nodes(ll_model) + [
+        LLNode("blocks.0.hook_resid_post", Ix[:, 2], subspace=subspace),
+        LLNode("blocks.0.hook_resid_post", Ix[:, 3]),
+    ]
+    cache = dict(ll_model.run_with_cache(x.flip(0))[1].items())
+
+    with torch.no_grad():
+        for source in [None, cache]:
+            expected = [
+                ll_model.run_with_hooks(x, fwd_hooks=[(node.name, make_ablation_hook(node, source, source is not None))])
+                for node in nodes
+            ]
+            for chunk_size in [1, 4, len(nodes)]:
+                sweep = NodeSweep(nodes, chunk_size)
+                outs = []
+                for chunk, ll_outs in sweep.run(ll_model, x, lambda name: cache[name] if source is not None else 0.):
+                    assert len(chunk) <= chunk_size and ll_outs.shape == (len(chunk), *expected[0].shape)
+                    outs.extend(ll_outs)
+                for node, out, expected_out in zip(nodes, outs, expected):
+                    assert torch.allclose(out, expected_out, atol=1e-5), (source is None, chunk_size, node)
+
+    activation_bytes = NodeSweep(nodes).sizer.get_activation_bytes(ll_model, x)
+    assert NodeSweep(nodes, memory_budget=3 * activation_bytes).get_chunk_size(ll_model, x) == 3
+    assert NodeSweep(nodes, memory_budget=0).get_chunk_size(ll_model, x) == 1
+
+    # measured once, then scaled to other batch sizes and sequence lengths without a forward
+    sizer = NodeSweep(nodes).sizer
+    n_forwards = []
+    ll_model.embed.register_forward_hook(lambda *args: n_forwards.append(1))
+    assert sizer.get_activation_bytes(ll_model, x) == activation_bytes
+    assert len(n_forwards) == 1
+    n_bytes = 0
+
+    def count_hook(hook_point_out, hook):
+        nonlocal n_bytes
+        n_bytes += hook_point_out.nbytes
+
+    for shape in [(10, x.shape[1]), (3, x.shape[1] - 4), (2, x.shape[1] + 1)]:
+        x_other = torch.randint(0, 40, shape)
+        estimate = sizer.get_activation_bytes(ll_model, x_other)
+        n_bytes = 0
+        with torch.no_grad():
+            out = ll_model.run_with_hooks(x_other, fwd_hooks=[(lambda name: True, count_hook)])
+        assert n_bytes + out.nbytes <= estimate <= 2 * (n_bytes + out.nbytes), shape
+    assert len(n_forwards) == 4
+
+
+def test_chunked_ablation_sweeps_match_per_node_sweeps():
+    model_pair, dataset = make_ioi_eval_model_pair()
+    uni_dataset = IITUniqueDataset(dataset.base_data, dataset.base_data, device=torch.device("cpu"))
+    for kwargs in [{}, {"categorical_metric": Categorical_Metric.KL}]:
+        results = []
+        for chunk_size in [1, 3, None]:
+            torch.manual_seed(0)
+            results.append(check_causal_effect(model_pair, dataset, batch_size=5, node_chunk_size=chunk_size, **kwargs))
+        for result in results[1:]:
+            assert all(abs(result[node] - results[0][node]) < 1e-5 for node in result)
+
+    results = []
+    for chunk_size in [1, 3, None]:
+        torch.manual_seed(0)
+        results.append(check_causal_effect_on_ablation(model_pair, uni_dataset, batch_size=5, node_chunk_size=chunk_size))
+    for result in results[1:]:
+        assert all(abs(result[node] - results[0][node]) < 1e-5 for node in result)
+
+
+def test_attribution_patching_matches_directional_derivative():
+    model_pair, dataset = make_ioi_eval_model_pair()
+    ll_model = model_pair.ll_model
+    ll_model.model.to(torch.float64)
+    nodes = [
+        LLNode("blocks.0.mlp.hook_post", Ix[[None]]),
+        LLNode("blocks.1.mlp.hook_post", Ix[[None]]),
+        LLNode("blocks.0.attn.hook_z", Ix[:, :, 1, :]),
+        LLNode("blocks.1.hook_resid_mid", Ix[:, -1, :]),
+    ]
+    param = next(ll_model.parameters())
+    param.grad = torch.ones_like(param)
+
+    estimates = check_causal_effect_attribution(model_pair, dataset, batch_size=12, nodes=nodes)
+    assert set(estimates.keys()) == set(nodes)
+    assert torch.equal(param.grad, torch.ones_like(param))
+    candidates = sorted(estimates, key=estimates.get, reverse=True)[:2]
+    assert set(check_causal_effect(model_pair, dataset, batch_size=12, nodes=candidates)) == set(candidates)
+
+    base_in, ablation_in = next(iter(dataset.make_loader(batch_size=12, num_workers=0)))
+    label_idx = model_pair.get_label_idxs()
+    base_label = base_in[1][label_idx.as_index].argmax(-1)
+    label_changed = (base_label != ablation_in[1][label_idx.as_index].argmax(-1)).double()
+    assert label_changed.sum() > 0
+
+    def metric(ll_out):
+        log_probs = torch.log_softmax(ll_out[label_idx.as_index], dim=-1)
+        return (log_probs.gather(-1, base_label.unsqueeze(-1)).squeeze(-1) * label_changed).sum()
+
+    eps = 1e-6
+    with torch.no_grad():
+        _, ablation_cache = ll_model.run_with_cache(ablation_in[0])
+        clean_metric = metric(ll_model(base_in[0]))
+        for node in nodes:
+            def nudge(hook_point_out, hook, node=node):
+                source = ablation_cache[node.name][node.index.as_index]
+                base = hook_point_out[node.index.as_index]
+                hook_point_out[node.index.as_index] = base + eps * (source - base)
+                return hook_point_out
+
+            nudged_metric = metric(ll_model.run_with_hooks(base_in[0], fwd_hooks=[(node.name, nudge)]))
+            expected = -(nudged_metric - clean_metric).item() / eps / label_changed.sum().item()
+            assert abs(estimates[node] - expected) < 1e-4 * max(1.0, abs(expected)), node
@@ -1,5 +1,15 @@
+import random
+
 import numpy as np
-from tests.test_utils.ioi_utils import make_ioi_test_dataset
+import torch as t
+import transformer_lens.loading_from_pretrained as loading
+from transformer_lens import HookedTransformer
+from transformers import GPT2Config
+from iit.tasks.ioi import get_gpt2_cfg, ioi_cfg
+from iit.tasks.ioi.ioi_dataset_tl import IOIDatasetWrapper
+from iit.tasks.ioi.ioi_hl import IOI_HL
+from iit.tasks.ioi.vocab import make_ioi_vocab
+from tests.test_utils.ioi_utils import make_ioi_test_dataset, make_word_level_tokenizer
 
 
 def test_ioi_dataset() -> None:
@@ -19,3 +29,109 @@ def test_ioi_dataset() -> None:
     max_len = len(dataset[0][0])
     for num, i in enumerate(dataset):
         assert len(i[0]) == max_len, f"Error in {num}"
+
+
+def test_ioi_dataset_cache(tmp_path) -> None:
+    templates = ["Then, [A] and [B] went to the [LOCATION]. [B] gave the [OBJECT] to [A]"]
+    names = ["John", "Mary", "Anna", "Paul"]
+    nouns = {"LOCATION": ["store", "market"], "OBJECT": ["milk", "eggs"]}
+    words = names + ["Then", "and", "went", "to", "the", "gave"] + sum(nouns.values(), [])
+    tokenizer = make_word_level_tokenizer(words)
+    kwargs = dict(tokenizer=tokenizer, templates=templates, names=names, nouns=nouns, num_samples=20)
+
+    dataset = IOIDatasetWrapper(**kwargs, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    for i, sample in enumerate(dataset.samples):
+        prompt = [tokenizer.bos_token_id] + tokenizer.encode(sample["text"])
+        assert dataset.get_prompt(i) == prompt
+        assert dataset[i][2].tolist() == tokenizer.encode(sample["IO"])
+        assert dataset.template_ids[i] == 0
+
+    cached = IOIDatasetWrapper(**kwargs, cache_dir=str(tmp_path))
+    assert isinstance(cached.prompt_ids, np.memmap)
+    assert cached.samples == dataset.samples
+    assert t.equal(cached.get_inputs(), dataset.get_inputs())
+    for i in range(len(dataset)):
+        for a, b in zip(cached[i], dataset[i]):
+            assert t.equal(a, b)
+
+    # a different seed is a different cache entry
+    IOIDatasetWrapper(**kwargs, seed=0, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # neither a cold nor a warm construction touches the global random state
+    for cache_dir in [None, str(tmp_path)]:
+        random.seed(1)
+        IOIDatasetWrapper(**kwargs, cache_dir=cache_dir)
+        drawn = random.random()
+        random.seed(1)
+        assert drawn == random.random()
+    assert IOIDatasetWrapper(**kwargs).samples == dataset.samples
+
+
+def test_ioi_dataset_compact_vocab() -> None:
+    templates = [
+        "Then, [A] and [B] went to the [LOCATION]. [B] gave the [OBJECT] to [A]",
+        "When [B] and [A] got a [OBJECT] at the [LOCATION], [B] decided to give it to [A]",
+    ]
+    names = ["John", "Mary", "Anna", "Paul"]
+    nouns = {"LOCATION": ["store", "market"], "OBJECT": ["milk", "eggs"]}
+    words = names + sum(nouns.values(), []) + "Then and went to the gave When got a at decided give it".split()
+    tokenizer = make_word_level_tokenizer(words + ["unused", "tokens"])
+    kwargs = dict(tokenizer=tokenizer, templates=templates, names=names, nouns=nouns, num_samples=50)
+
+    vocab = make_ioi_vocab(tokenizer, templates, names, nouns)
+    assert len(vocab) == len(tokenizer) - 3  # "unused", "tokens" and <unk>
+    dataset = IOIDatasetWrapper(**kwargs)
+    compact = IOIDatasetWrapper(**kwargs, vocab=vocab)
+    assert t.equal(vocab.expand(compact.get_inputs()), dataset.get_inputs())
+    assert t.equal(vocab.compact(dataset.get_inputs()), compact.get_inputs())
+
+    name_ids = t.tensor([tokenizer.encode(" " + name)[0] for name in names])
+    hl = IOI_HL(d_vocab=len(tokenizer), names=name_ids, return_ids=True)
+    compact_hl = IOI_HL(d_vocab=len(vocab), names=vocab.compact(name_ids), return_ids=True)
+    out, compact_out = hl(dataset.get_inputs())[:, -1], compact_hl(compact.get_inputs())[:, -1]
+    assert t.equal(vocab.expand(compact_out), out)
+    assert t.equal(compact_out, t.stack([compact[i][2][0] for i in range(len(compact))]))
+
+
+def test_ioi_dataset_unpadded_inputs_by_length() -> None:
+    templates = [
+        "Then, [A] and [B] went to the [LOCATION]. [B] gave the [OBJECT] to [A]",
+        "When [B] and [A] got a [OBJECT] at the [LOCATION], [B] decided to give it to [A]",
+    ]
+    names = ["John", "Mary", "Anna", "Paul"]
+    nouns = {"LOCATION": ["store", "market"], "OBJECT": ["milk", "eggs"]}
+    words = names + sum(nouns.values(), []) + "Then and went to the gave When got a at decided give it".split()
+    tokenizer = make_word_level_tokenizer(words)
+    kwargs = dict(tokenizer=tokenizer, templates=templates, names=names, nouns=nouns, num_samples=30)
+
+    padded = IOIDatasetWrapper(**kwargs)
+    assert isinstance(padded.get_inputs(), t.Tensor)
+    unpadded = IOIDatasetWrapper(**kwargs, pad_prompts=False)
+    inputs, targets = unpadded.get_inputs(), unpadded.get_targets()
+    groups = unpadded.get_length_groups()
+    assert isinstance(inputs, dict) and isinstance(targets, dict) and len(groups) == 2
+    assert sorted(np.concatenate(list(groups.values())).tolist()) == list(range(len(unpadded)))
+    for length, indices in groups.items():
+        assert inputs[length].shape == (len(indices), length)
+        for row, i in enumerate(indices.tolist()):
+            assert t.equal(inputs[length][row], unpadded[i][0])
+            assert t.equal(targets[length][row], unpadded[i][1])
+            # without padding, each input is the tail of its padded version
+            assert t.equal(padded[i][0][-length:], inputs[length][row])
+
+
+def test_gpt2_cfg_matches_pretrained_cfg(monkeypatch) -> None:
+    # GPT2Config's defaults are gpt2-small, so this needs no download
+    hf_cfg = GPT2Config(architectures=["GPT2LMHeadModel"], n_ctx=1024)
+    monkeypatch.setattr(loading.AutoConfig, "from_pretrained", lambda *args, **kwargs: hf_cfg)
+    pretrained_cfg = loading.get_pretrained_model_config("gpt2", fold_ln=True).to_dict()
+    cfg = get_gpt2_cfg()
+    for key, value in cfg.items():
+        if key != "tokenizer_prepends_bos":
+            assert pretrained_cfg[key] == value, key
+
+    cfg.update(ioi_cfg, tokenizer_name=None, d_vocab=40, d_vocab_out=40)
+    model = HookedTransformer(cfg)
+    assert model.cfg.n_layers == ioi_cfg["n_layers"] and model.cfg.normalization_type == "LNPre"
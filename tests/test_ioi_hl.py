@@ -13,7 +13,9 @@ from iit.tasks.ioi.ioi_hl import (
     PreviousHead,
     SInhibitionHead,
 )
+from iit.utils.nodes import HLNode
 from tests.test_utils.ioi_utils import make_ioi_test_dataset
+from iit.utils.eval_metrics import get_label_ids
 
 IOI_TEST_NAMES = t.tensor([10, 20, 30])
 
@@ -229,5 +231,26 @@ def test_ioi_hl_model():
 
     for batch in loader:
         hl_out = hl_model(batch[0])[:, -1].argmax(dim=-1)
-        labels = batch[1][:, -1].argmax(dim=-1)
-        assert t.equal(hl_out, labels)
\ No newline at end of file
+        labels = get_label_ids(batch[1])[:, -1]
+        assert t.equal(hl_out, labels)
+
+def test_dual_batch_intervention() -> None:
+    hl_model = IOI_HL(d_vocab=61, names=t.tensor(range(10, 60, 1)))
+    base_x = t.tensor([[1, 12, 2, 13, 4, 12, 5, 6, 12], [1, 20, 2, 21, 4, 21, 5, 6, 20]])
+    ablation_x = t.tensor([[1, 30, 2, 31, 4, 31, 5, 6, 30], [1, 40, 2, 41, 4, 40, 5, 6, 40]])
+    _, ablation_cache = hl_model.run_with_cache((ablation_x, None, None))
+    for hl_node in [HLNode(name, -1) for name in ["all_nodes_hook", "hook_duplicate", "hook_s_inhibition", "hook_name_mover"]]:
+        expected = hl_model.run_with_hooks(
+            (base_x, None, None),
+            fwd_hooks=[(hl_node.name, make_hook(ablation_cache, hl_node.name))],
+        )
+        out = hl_model.run_dual_batch_intervention((base_x, None, None), (ablation_x, None, None), hl_node)
+        assert t.equal(out, expected), hl_node
+
+
+def test_ioi_hl_return_ids() -> None:
+    x = t.tensor([[3, 10, 4, 10, 5, 9, 2, 6, 5], [1, 20, 2, 30, 3, 30, 4, 20, 30]])
+    one_hot = IOI_HL(d_vocab=31, names=IOI_TEST_NAMES)(x)
+    ids = IOI_HL(d_vocab=31, names=IOI_TEST_NAMES, return_ids=True)(x)
+    assert ids.dtype == t.int64 and ids.shape == x.shape
+    assert t.equal(ids, one_hot.argmax(dim=-1))
@@ -4,6 +4,7 @@ from iit.utils.correspondence import Correspondence
 from iit.utils.nodes import HLNode, LLNode
 import iit.utils.index as index
 from iit.model_pairs.ll_model import LLModel
+import numpy as np
 import torch
 
 def get_test_model_pair_ingredients():
@@ -66,4 +67,330 @@ def test_model_pair_gradients():
         assert model_pair.ll_cache[next_hook].grad is None, f'{next_hook} has grad, but should not'
     model_pair.ll_cache[hook_point].grad[hook_idx.as_index] 
     assert (model_pair.ll_cache[hook_point].grad[hook_idx_complement.as_index] == 0).all()
-    assert (model_pair.ll_grad_cache[hook_point].grad[hook_idx.as_index] != 0).all()
\ No newline at end of file
+    assert (model_pair.ll_grad_cache[hook_point].grad[hook_idx.as_index] != 0).all()
+
+def get_test_ioi_model_pair_ingredients():
+    from iit.tasks.ioi.ioi_hl import IOI_HL
+
+    ll_model = LLModel(cfg={
+        'n_layers': 2,
+        'd_model': 32,
+        'n_ctx': 10,
+        'd_head': 8,
+        'act_fn': 'gelu',
+        'd_vocab': 40,
+    })
+    hl_model = IOI_HL(d_vocab=40, names=torch.tensor([10, 20, 30]), device=torch.device("cpu"))
+    corr = Correspondence.make_corr_from_dict({
+        "hook_duplicate": [("blocks.0.attn.hook_z", index.Ix[:, :, 0, :], None)],
+        "hook_s_inhibition": [
+            ("blocks.1.attn.hook_z", index.Ix[:, :, 1, :], None),
+            ("blocks.1.attn.hook_z", index.Ix[:, :, 2, :], None),
+        ],
+        "hook_name_mover": [("blocks.1.mlp.hook_post", index.Ix[[None]], None)],
+    }, suffixes={"attn": "attn.hook_z", "mlp": "mlp.hook_post"})
+    base_x = torch.tensor([[1, 10, 2, 20, 3, 10, 4, 20, 10], [1, 20, 2, 30, 3, 30, 4, 20, 30]])
+    ablation_x = torch.tensor([[1, 30, 2, 10, 3, 10, 4, 30, 10], [1, 10, 2, 20, 3, 10, 4, 20, 20]])
+    base_input = (base_x, hl_model(base_x), None)
+    ablation_input = (ablation_x, hl_model(ablation_x), None)
+    return ll_model, hl_model, corr, base_input, ablation_input
+
+
+def test_do_intervention_caches_only_corresponded_hooks():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    model_pair = StrictIITModelPair(hl_model, ll_model, corr)
+    for hl_node, ll_nodes in corr.items():
+        model_pair.do_intervention(base_input, ablation_input, hl_node)
+        assert set(model_pair.ll_cache.keys()) == {ll_node.name for ll_node in ll_nodes}
+
+
+def test_dual_batch_hl_intervention_matches_hooked_run():
+    from iit.model_pairs.iit_behavior_model_pair import IITBehaviorModelPair
+    from iit.tasks.mnist_pvr.pvr_hl import MNIST_PVR_HL
+
+    ll_model, ioi_hl_model, ioi_corr, ioi_base_input, ioi_ablation_input = get_test_ioi_model_pair_ingredients()
+    pvr_hl_model = MNIST_PVR_HL(device=torch.device("cpu"))
+    pvr_corr = Correspondence({
+        HLNode(name, 10): {LLNode("blocks.0.attn.hook_z", index.Ix[:, :, i, :])}
+        for i, name in enumerate(["hook_tl", "hook_tr", "hook_bl", "hook_br"])
+    })
+    pvr_base_input = (None, None, torch.randint(0, 10, (8, 4)))
+    pvr_ablation_input = (None, None, torch.randint(0, 10, (8, 4)))
+
+    for hl_model, corr, base_input, ablation_input in [
+        (ioi_hl_model, ioi_corr, ioi_base_input, ioi_ablation_input),
+        (pvr_hl_model, pvr_corr, pvr_base_input, pvr_ablation_input),
+    ]:
+        dual_pair = IITBehaviorModelPair(hl_model, ll_model, corr, training_args={"use_dual_batch_hl": True})
+        hooked_pair = IITBehaviorModelPair(hl_model, ll_model, corr, training_args={"use_dual_batch_hl": False})
+        assert dual_pair.uses_dual_batch_hl() and not hooked_pair.uses_dual_batch_hl()
+        for hl_node in corr.keys():
+            dual_out = dual_pair.get_hl_intervention_output(base_input, ablation_input, hl_node)
+            hooked_out = hooked_pair.get_hl_intervention_output(base_input, ablation_input, hl_node)
+            assert torch.equal(dual_out, hooked_out), hl_node
+
+
+def test_node_parallel_IIA_eval_matches_serial_eval():
+    from iit.model_pairs.iit_behavior_model_pair import IITBehaviorModelPair
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    results = []
+    for training_args in [
+        {"val_IIA_node_parallel": False},
+        {"val_IIA_node_parallel": True},
+        {"val_IIA_node_parallel": True, "eval_node_chunk_size": 2},
+    ]:
+        model_pair = IITBehaviorModelPair(
+            hl_model, ll_model, corr, training_args={"val_IIA_sampling": "all", **training_args}
+        )
+        with torch.no_grad():
+            results.append(model_pair.run_eval_step(base_input, ablation_input, model_pair.loss_fn))
+    for result in results[1:]:
+        assert result["val/IIA"] == results[0]["val/IIA"]
+        assert abs(result["val/iit_loss"] - results[0]["val/iit_loss"]) < 1e-5
+
+
+def test_batched_strict_accuracies_match_per_node_runs():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    model_pair = StrictIITModelPair(hl_model, ll_model, corr, training_args={"eval_node_chunk_size": 3})
+    assert len(model_pair.nodes_not_in_circuit) > 3
+    with torch.no_grad():
+        accuracies = model_pair.get_strict_accuracies(base_input, ablation_input)
+        _, model_pair.ll_cache = model_pair.ll_model.run_with_cache(ablation_input[0])
+        for node, accuracy in zip(model_pair.nodes_not_in_circuit, accuracies):
+            out = model_pair.ll_model.run_with_hooks(
+                base_input[0], fwd_hooks=[(node.name, model_pair.make_ll_ablation_hook(node))]
+            )
+            expected = (out.argmax(dim=-1) == base_input[1].argmax(dim=-1)).float().mean()
+            assert abs(accuracy.item() - expected.item()) < 1e-6, node
+
+
+def test_strict_eval_chunks_by_memory_and_reports_per_node_accuracy():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+    from iit.utils.iit_dataset import IITDataset
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    model_pair = StrictIITModelPair(hl_model, ll_model, corr)
+    nodes = model_pair.nodes_not_in_circuit
+    activation_bytes = model_pair.eval_chunk_sizer.get_activation_bytes(ll_model, base_input[0])
+    model_pair.eval_chunk_sizer.memory_budget = 2 * activation_bytes
+    assert [len(chunk) for chunk in model_pair.chunk_nodes(nodes, base_input[0])][0] == 2
+
+    with torch.no_grad():
+        accuracies = model_pair.get_strict_accuracies(base_input, ablation_input)
+    xs = base_input[0]
+    data = list(zip(xs, hl_model(xs)))
+    dataset = IITDataset(data, data, seed=0, device=torch.device("cpu"))
+    metrics = model_pair._run_eval_epoch(dataset.make_loader(len(data), 0), model_pair.loss_fn)
+    per_node = next(m for m in metrics if m.get_name() == "val/per_node_strict_accuracy")
+    assert list(per_node.get_node_values().keys()) == nodes
+    strict = next(m for m in metrics if m.get_name() == "val/strict_accuracy")
+    assert abs(per_node.get_value().mean() * 100 - strict.get_value()) < 1e-4
+    assert accuracies.shape == per_node.get_value().shape
+    assert "min" in str(metrics)
+
+
+def test_fused_train_step_matches_separate_losses():
+    import copy
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    results = []
+    for fused in [False, True]:
+        model_pair = StrictIITModelPair(
+            hl_model,
+            LLModel(copy.deepcopy(ll_model.model)),
+            corr,
+            training_args={"use_single_loss": True, "fused_train_step": fused, "seed": 1},
+        )
+        optimizer = torch.optim.Adam(model_pair.ll_model.parameters())
+        results.append(
+            model_pair.run_train_step(base_input, ablation_input, model_pair.loss_fn, optimizer)
+        )
+    for k in results[0].keys():
+        assert abs(results[0][k] - results[1][k]) < 1e-5, k
+
+
+def test_masked_ablation_hooks_match_per_node_hooks():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    model_pair = StrictIITModelPair(hl_model, ll_model, corr)
+    ll_nodes = model_pair.nodes_not_in_circuit + [n for nodes in corr.values() for n in nodes]
+    _, model_pair.ll_cache = model_pair.ll_model.run_with_cache(ablation_input[0])
+    masked_hooks = model_pair.make_ll_ablation_hooks(ll_nodes)
+    assert len(masked_hooks) == len({n.name for n in ll_nodes})
+    masked_out = model_pair.ll_model.run_with_hooks(base_input[0], fwd_hooks=masked_hooks)
+    per_node_out = model_pair.ll_model.run_with_hooks(
+        base_input[0], fwd_hooks=[(n.name, model_pair.make_ll_ablation_hook(n)) for n in ll_nodes]
+    )
+    assert torch.allclose(masked_out, per_node_out)
+
+
+def test_subspace_interventions():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+    from iit.utils.intervention_planner import InterventionPlanner
+
+    torch.manual_seed(0)
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    model_pair = StrictIITModelPair(hl_model, ll_model, corr)
+    basis = torch.linalg.qr(torch.randn(8, 8))[0]
+    projection = basis[:, 4:7] @ basis[:, 4:7].T
+    hook_name = "blocks.0.attn.hook_z"
+    ll_nodes = [
+        LLNode(hook_name, index.Ix[:, :, 0, :], subspace=basis[:, :2]),
+        LLNode(hook_name, index.Ix[:, :, 0, :], subspace=basis[:, 2:3]),
+        LLNode(hook_name, index.Ix[:, :, 1, :], subspace=projection),
+        LLNode("blocks.1.mlp.hook_post", index.Ix[[None]]),
+    ]
+
+    base, source = torch.randn(2, 10, 2, 8), torch.randn(2, 10, 2, 8)
+    planner = InterventionPlanner()
+    ((_, hook),) = planner.make_patch_hooks(ll_nodes[:3], lambda _: source)
+    patched = hook(base, type("Hook", (), {"name": hook_name})())
+    expected = base.clone()
+    expected[:, :, 0] += (source - base)[:, :, 0] @ basis[:, :3] @ basis[:, :3].T
+    expected[:, :, 1] += (source - base)[:, :, 1] @ projection
+    assert torch.allclose(patched, expected, atol=1e-5)
+
+    _, model_pair.ll_cache = model_pair.ll_model.run_with_cache(ablation_input[0])
+    masked_out = model_pair.ll_model.run_with_hooks(
+        base_input[0], fwd_hooks=model_pair.make_ll_ablation_hooks(ll_nodes)
+    )
+    per_node_out = model_pair.ll_model.run_with_hooks(
+        base_input[0], fwd_hooks=[(n.name, model_pair.make_ll_ablation_hook(n)) for n in ll_nodes]
+    )
+    assert torch.allclose(masked_out, per_node_out, atol=1e-5)
+    assert LLNode(hook_name, index.Ix[:, :, 1, :], subspace=projection.clone()) == ll_nodes[2]
+    assert len({*ll_nodes, *ll_nodes}) == len(ll_nodes)
+
+    # replica k of a tiled batch is patched exactly as the untiled batch with replica_nodes[k]
+    replica_nodes = [ll_nodes[:2], [], ll_nodes[2:], [LLNode(hook_name, index.Ix[1:, :, 1, :])]]
+    batch_size = base_input[0].shape[0]
+    tiled_out = model_pair.ll_model.run_with_hooks(
+        model_pair.tile_input((base_input[0],), len(replica_nodes))[0],
+        fwd_hooks=model_pair.make_ll_replica_ablation_hooks(replica_nodes, batch_size),
+    )
+    for nodes, out in zip(replica_nodes, tiled_out.chunk(len(replica_nodes))):
+        expected = model_pair.ll_model.run_with_hooks(
+            base_input[0], fwd_hooks=[(n.name, model_pair.make_ll_ablation_hook(n)) for n in nodes]
+        )
+        assert torch.allclose(out, expected, atol=1e-5), nodes
+
+
+def test_precomputed_hl_targets_match_hl_interventions(tmp_path):
+    from iit.model_pairs.iit_behavior_model_pair import IITBehaviorModelPair
+    from iit.utils.iit_dataset import IITDataset
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    xs = torch.cat([base_input[0], ablation_input[0]])
+    data = list(zip(xs, hl_model(xs)))
+    model_pair = IITBehaviorModelPair(
+        hl_model, ll_model, corr, training_args={"batch_size": 3, "hl_targets_dir": str(tmp_path), "val_IIA_sampling": "all"}
+    )
+
+    dataset = IITDataset(data, data, seed=0, device=torch.device("cpu"))
+    model_pair.precompute_hl_targets(dataset, "test")
+    assert len(list(tmp_path.glob("test_hl_targets_*.pt"))) == 1
+    reloaded = IITDataset(data, data, seed=0, device=torch.device("cpu"))
+    model_pair.precompute_hl_targets(reloaded, "test")
+    assert len(list(tmp_path.glob("test_hl_targets_*.pt"))) == 1
+    for name, table in dataset.hl_targets.items():
+        assert torch.equal(table, reloaded.hl_targets[name])
+
+    # same size and seed, different data: the saved table must not be reused
+    other_data = list(zip(xs.flip(0), hl_model(xs.flip(0))))
+    other = IITDataset(other_data, other_data, seed=0, device=torch.device("cpu"))
+    model_pair.precompute_hl_targets(other, "test")
+    assert len(list(tmp_path.glob("test_hl_targets_*.pt"))) == 2
+    for base, ablation, hl_targets in other.make_loader(batch_size=3, num_workers=0):
+        for hl_node in corr.keys():
+            assert torch.equal(hl_targets[hl_node.name], model_pair.get_hl_intervention_output(base, ablation, hl_node))
+
+    for base, ablation, hl_targets in dataset.make_loader(batch_size=3, num_workers=0):
+        for hl_node in corr.keys():
+            expected = model_pair.get_hl_intervention_output(base, ablation, hl_node)
+            assert torch.equal(hl_targets[hl_node.name], expected), hl_node
+
+    plain = IITDataset(data, data, seed=0, device=torch.device("cpu"))
+    precomputed_metrics = model_pair._run_eval_epoch(dataset.make_loader(4, 0), model_pair.loss_fn)
+    plain_metrics = model_pair._run_eval_epoch(plain.make_loader(4, 0), model_pair.loss_fn)
+    for precomputed, plain_metric in zip(precomputed_metrics, plain_metrics):
+        assert abs(precomputed.get_value() - plain_metric.get_value()) < 1e-5, precomputed.get_name()
+
+
+def test_ioi_model_pair_sparse_labels_match_one_hot_labels():
+    from iit.model_pairs.ioi_model_pair import IOI_ModelPair
+    from iit.tasks.ioi.ioi_hl import IOI_HL
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    sparse_hl_model = IOI_HL(
+        d_vocab=40, names=torch.tensor([10, 20, 30]), device=torch.device("cpu"), return_ids=True
+    )
+    sparse_base_input = (base_input[0], sparse_hl_model(base_input[0]), None)
+    sparse_ablation_input = (ablation_input[0], sparse_hl_model(ablation_input[0]), None)
+    assert sparse_base_input[1].dtype == torch.int64
+
+    results = []
+    for hl, base, ablation in [
+        (hl_model, base_input, ablation_input),
+        (sparse_hl_model, sparse_base_input, sparse_ablation_input),
+    ]:
+        model_pair = IOI_ModelPair(hl, ll_model, corr, training_args={"next_token": True})
+        with torch.no_grad():
+            results.append(model_pair.run_eval_step(base, ablation, model_pair.loss_fn))
+            behavior_loss = model_pair.get_behaviour_loss_over_batch(base, model_pair.loss_fn)
+            results[-1]["behavior_loss"] = behavior_loss.item()
+    for k, v in results[0].items():
+        assert np.allclose(v, results[1][k], atol=1e-5), k
+
+
+def test_ioi_model_pair_length_bucketed_batches():
+    from iit.model_pairs.ioi_model_pair import IOI_ModelPair
+    from iit.tasks.ioi.ioi_hl import IOI_HL
+    from iit.utils.iit_dataset import IITDataset
+
+    ll_model, _, corr, _, _ = get_test_ioi_model_pair_ingredients()
+    hl_model = IOI_HL(d_vocab=40, names=torch.tensor([10, 20, 30]), device=torch.device("cpu"), return_ids=True)
+    generator = torch.Generator().manual_seed(0)
+    xs = [torch.randint(0, 40, (length,), generator=generator) for length in [5, 9, 7, 9, 5, 7, 9, 5, 9]]
+    data = [(x, hl_model(x)) for x in xs]
+    dataset = IITDataset(data, data, seed=0, bucket_by_length=True, device=torch.device("cpu"))
+    model_pair = IOI_ModelPair(hl_model, ll_model, corr, training_args={"next_token": True, "batch_size": 2})
+
+    loader = dataset.make_loader(batch_size=2, num_workers=0)
+    seen = []
+    for base_input, ablation_input in loader:
+        assert base_input[0].shape == ablation_input[0].shape
+        for hl_node in corr.keys():
+            hl_output, ll_output = model_pair.do_intervention(base_input, ablation_input, hl_node)
+            assert ll_output.shape[:2] == hl_output.shape == base_input[0].shape
+        seen.extend(base_input[0].tolist())
+    assert sorted(seen) == sorted(x.tolist() for x in xs)
+
+    metrics = model_pair._run_eval_epoch(loader, model_pair.loss_fn)
+    per_token_accuracy = [m for m in metrics if m.get_name() == "val/per_token_accuracy"][0]
+    assert per_token_accuracy.get_value().shape == (9,)
+
+
+def test_node_granularity_from_training_args():
+    from iit.model_pairs.strict_iit_model_pair import StrictIITModelPair
+    from iit.utils.eval_ablations import get_resample_ablation_nodes
+    import iit.utils.node_picker as node_picker
+
+    ll_model, hl_model, corr, base_input, ablation_input = get_test_ioi_model_pair_ingredients()
+    coarse = StrictIITModelPair(hl_model, ll_model, corr)
+    fine = StrictIITModelPair(
+        hl_model, ll_model, corr, training_args={"head_dims_per_node": 2, "mlp_neurons_per_node": 8}
+    )
+    granularity = {"head_dims_per_node": 2, "mlp_neurons_per_node": 8}
+    assert fine.nodes_not_in_circuit == node_picker.get_nodes_not_in_circuit(ll_model, corr, **granularity)
+    assert len(fine.nodes_not_in_circuit) > len(coarse.nodes_not_in_circuit)
+    assert get_resample_ablation_nodes(fine, "a") == node_picker.get_all_nodes(ll_model, **granularity)
+    with torch.no_grad():
+        accuracies = fine.get_strict_accuracies(base_input, ablation_input)
+    assert accuracies.shape == (len(fine.nodes_not_in_circuit),)
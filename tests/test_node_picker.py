@@ -135,3 +135,94 @@ def test_suffix_maker():
         "attn": "attn.hook_result",
         "mlp": "mlp.hook_post"
     }
+
+def test_node_index_matches_dense_masks():
+    from iit.utils.node_index import NodeIndex
+    import torch
+
+    hook_points = ["blocks.0.attn.hook_result", "blocks.0.mlp.hook_post"]
+    circuit = [
+        LLNode(hook_points[0], Ix[:, :, 1, :]),
+        LLNode(hook_points[0], Ix[:, :, 2:4, :3]),
+        LLNode(hook_points[1], Ix[:, :, 5]),
+    ]
+    candidates = [
+        LLNode(hook_points[0], Ix[:, :, head, dims])
+        for head in range(4)
+        for dims in [slice(None), slice(0, 2), slice(3, 6), 4]
+    ] + [
+        LLNode(hook_points[1], Ix[:, :, neuron]) for neuron in range(8)
+    ] + [
+        LLNode(hook_points[1], Ix[[None]]),
+        LLNode("blocks.1.mlp.hook_post", Ix[[None]]),
+    ]
+    node_index = NodeIndex(circuit)
+    shape = (2, 3, 8, 6)
+
+    def mask(node):
+        m = torch.zeros(shape, dtype=torch.bool)
+        m[node.index.as_index] = True
+        return m
+
+    expected = [
+        any((mask(node) & mask(c)).any().item() for c in circuit if c.name == node.name)
+        for node in candidates
+    ]
+    assert node_index.intersects(candidates).tolist() == expected
+    assert node_index.complement(candidates) == [n for n, e in zip(candidates, expected) if not e]
+    assert circuit[0] in node_index and candidates[0] not in node_index
+
+def test_node_index_with_negative_indices_matches_pairwise_intersects():
+    from iit.utils.node_index import NodeIndex
+    from iit.utils.node_picker import get_nodes_not_in_circuit, nodes_intersect
+
+    hook_point = "blocks.0.hook_resid_post"
+    circuit = [
+        LLNode(hook_point, Ix[:, -1, :]),
+        LLNode(hook_point, Ix[:, 2, :]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, -2:, 3]),
+    ]
+    candidates = [
+        LLNode(hook_point, Ix[:, -1, :]),
+        LLNode(hook_point, Ix[:, -2, :]),
+        LLNode(hook_point, Ix[:, 2, :]),
+        LLNode(hook_point, Ix[:, 3, :]),
+        LLNode(hook_point, Ix[:, :, :]),
+        LLNode(hook_point, Ix[[None]]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, :, 3]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, -2:, 4]),
+    ]
+    expected = [any(nodes_intersect(node, c) for c in circuit) for node in candidates]
+    assert NodeIndex(circuit).intersects(candidates).tolist() == expected
+
+    model = HookedTransformer(
+        {"n_layers": 1, "d_model": 8, "n_ctx": 4, "d_head": 4, "n_heads": 2, "d_vocab": 10, "act_fn": "relu"}
+    )
+    corr = Correspondence({"a": {LLNode("blocks.0.mlp.hook_post", Ix[:, -1, :])}})
+    not_in_circuit = get_nodes_not_in_circuit(model, corr)
+    all_nodes = get_all_nodes(model, corr.get_suffixes())
+    assert not_in_circuit == [node for node in all_nodes if node.name != "blocks.0.mlp.hook_post"]
+
+
+def test_get_all_nodes_granularity():
+    cfg = {
+        "n_layers": 1,
+        "n_heads": 2,
+        "d_model": 8,
+        "d_head": 4,
+        "d_mlp": 3,
+        "n_ctx": 16,
+        "act_fn": "gelu",
+        "d_vocab": 21
+    }
+    model = HookedTransformer(cfg)
+    suffixes = {"attn": "attn.hook_z", "mlp": "mlp.hook_post"}
+    assert get_all_nodes(model, suffixes, head_dims_per_node=3, mlp_neurons_per_node=1) == [
+        LLNode("blocks.0.attn.hook_z", Ix[:, :, 0, 0:3]),
+        LLNode("blocks.0.attn.hook_z", Ix[:, :, 0, 3:4]),
+        LLNode("blocks.0.attn.hook_z", Ix[:, :, 1, 0:3]),
+        LLNode("blocks.0.attn.hook_z", Ix[:, :, 1, 3:4]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, :, 0]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, :, 1]),
+        LLNode("blocks.0.mlp.hook_post", Ix[:, :, 2]),
+    ]
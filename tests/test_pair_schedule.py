@@ -0,0 +1,118 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from iit.utils.iit_dataset import DeviceDataLoader, IITDataset
+from iit.utils.pair_schedule import LengthBucketBatchSampler, PairBatchSampler, PairSchedule
+
+
+def test_pair_schedule_is_reproducible_per_epoch():
+    for mode in ["random", "product", "strided", "sampled"]:
+        schedule = PairSchedule(7, 5, mode=mode, num_pairs=14, seed=3)
+        base_0, ablation_0 = schedule.get_indices(0)
+        assert len(base_0) == len(ablation_0) == len(schedule)
+        assert base_0.max() < 7 and ablation_0.max() < 5
+        again_0 = schedule.get_indices(0)
+        assert np.array_equal(base_0, again_0[0]) and np.array_equal(ablation_0, again_0[1])
+        if mode != "product":
+            base_1, ablation_1 = schedule.get_indices(1)
+            assert not (np.array_equal(base_0, base_1) and np.array_equal(ablation_0, ablation_1))
+
+    fixed = PairSchedule(7, 5, seed=3, resample_every_epoch=False)
+    assert all(np.array_equal(a, b) for a, b in zip(fixed.get_indices(0), fixed.get_indices(4)))
+
+
+def test_strided_and_sampled_schedules_cover_product():
+    n_base, n_ablation = 6, 4
+    strided = PairSchedule(n_base, n_ablation, mode="strided", num_pairs=2 * n_base)
+    seen = set()
+    for epoch in range(n_ablation // 2):
+        seen.update(zip(*(idx.tolist() for idx in strided.get_indices(epoch))))
+    assert len(seen) == n_base * n_ablation
+
+    sampled = PairSchedule(n_base, n_ablation, mode="sampled", num_pairs=n_base * n_ablation)
+    assert len(set(zip(*(idx.tolist() for idx in sampled.get_indices(0))))) == n_base * n_ablation
+
+
+def test_pair_batch_sampler_loader():
+    data = [(torch.tensor([i]), torch.tensor([10 * i])) for i in range(10)]
+    dataset = IITDataset(data, data, seed=0, device=torch.device("cpu"), pair_schedule="random", num_pairs=9)
+    loader = dataset.make_loader(batch_size=4, num_workers=0)
+    assert len(loader) == 3
+    sampler = loader.batch_sampler
+    assert isinstance(sampler, PairBatchSampler)
+
+    expected_base, expected_ablation = dataset.pair_schedule.get_indices(0)
+    base_x = torch.cat([base[0][:, 0] for base, _ in loader])
+    assert torch.equal(base_x, torch.tensor(expected_base))
+    sampler.set_epoch(0)
+    ablation_x = torch.cat([ablation[0][:, 0] for _, ablation in loader])
+    assert torch.equal(ablation_x, torch.tensor(expected_ablation))
+    assert sampler.epoch == 1
+
+
+def test_worker_loader_matches_main_process_loader():
+    data = [(torch.tensor([i, i + 1]), torch.tensor([10 * i])) for i in range(10)]
+    dataset = IITDataset(data, data, seed=0, device=torch.device("cpu"), pair_schedule="random", num_pairs=10)
+    collate_fn = pickle.loads(pickle.dumps(dataset.get_loader_collate_fn()))
+    batch = collate_fn(dataset.__getitems__([0, 1]))
+    assert batch[0][0].shape == (2, 2)
+
+    expected = list(dataset.make_loader(batch_size=4, num_workers=0))
+    loader = dataset.make_loader(batch_size=4, num_workers=2, prefetch_factor=2, persistent_workers=True)
+    assert len(loader) == len(expected)
+    loader.batch_sampler.set_epoch(0)
+    for expected_batch, batch in zip(expected, loader):
+        for expected_input, worker_input in zip(expected_batch, batch):
+            for expected_field, worker_field in zip(expected_input, worker_input):
+                assert torch.equal(expected_field, worker_field)
+
+    device_loader = DeviceDataLoader(
+        dataset, batch_size=4, collate_fn=dataset.get_loader_collate_fn(), device=torch.device("cpu")
+    )
+    assert [batch[0][0].device.type for batch in device_loader] == ["cpu"] * 3
+
+
+def test_materialized_batches_match_collated_batches():
+    data = [(torch.tensor([i, i + 1]), torch.tensor([10 * i]), torch.tensor(i % 3)) for i in range(10)]
+    for kwargs in [{}, {"every_combination": True}, {"pair_schedule": "sampled", "num_pairs": 20}]:
+        dataset = IITDataset(data, data, seed=1, device=torch.device("cpu"), **kwargs)
+        materialized = IITDataset(data, data, seed=1, device=torch.device("cpu"), materialize=True, **kwargs)
+        assert materialized.base_fields[0].shape == (10, 2)
+        if "pair_schedule" in kwargs:
+            indices = next(iter(PairBatchSampler(dataset.pair_schedule, 6)))
+        else:
+            indices = [0, 7, 3, 5, 9]
+        expected = dataset.collate_fn(dataset.__getitems__(indices), torch.device("cpu"))
+        gathered = materialized.__getitems__(indices)
+        for expected_input, gathered_input in zip(expected, gathered):
+            for expected_field, gathered_field in zip(expected_input, gathered_input):
+                assert torch.equal(expected_field, gathered_field)
+
+    loader = IITDataset(data, data, device=torch.device("cpu"), materialize=True).make_loader(4, 2)
+    batches = list(loader)
+    assert len(batches) == 3 and batches[0][0][0].shape == (4, 2)
+
+
+def test_length_bucket_batch_sampler():
+    base_lengths = np.array([3, 5, 3, 4, 5, 5, 3, 4, 5])
+    ablation_lengths = np.array([5, 4, 3, 3])
+    sampler = LengthBucketBatchSampler(base_lengths, ablation_lengths, batch_size=2, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 2 + 1 + 2
+    assert sorted(np.concatenate(batches)[:, 0].tolist()) == list(range(9))
+    for batch in batches:
+        assert len(set(base_lengths[batch[:, 0]])) == 1
+        assert np.array_equal(base_lengths[batch[:, 0]], ablation_lengths[batch[:, 1]])
+    again = LengthBucketBatchSampler(base_lengths, ablation_lengths, batch_size=2, seed=1)
+    assert all(np.array_equal(a, b) for a, b in zip(batches, again))
+
+    with pytest.raises(ValueError):
+        LengthBucketBatchSampler(base_lengths, np.array([3, 4]), batch_size=2)
+
+    fixed = LengthBucketBatchSampler(base_lengths, ablation_lengths, batch_size=2, seed=1, fixed_epoch=0)
+    first, second = list(fixed), list(fixed)
+    assert all(np.array_equal(a, b) for a, b in zip(first, second))
+    assert all(np.array_equal(a, b) for a, b in zip(first, batches))
@@ -0,0 +1,63 @@
+import pickle
+
+import pytest
+import torch as t
+from torch.utils.data import DataLoader
+
+from iit.tasks.mnist_pvr.dataset import ImagePVRDataset
+from iit.utils.sample_cache import LRUSampleCache, make_sample_cache
+from tests.test_datasets import make_random_mnist
+
+FIELDS = [((2, 3), t.uint8), ((), t.long)]
+
+
+def make_item(index):
+    return t.full((2, 3), index, dtype=t.uint8), t.tensor(index)
+
+
+def test_lru_sample_cache_evicts_least_recently_used():
+    cache = LRUSampleCache(max_bytes=3 * (6 + 8))
+    for index in range(3):
+        cache.put(index, make_item(index))
+    assert cache.get(0) is not None
+    cache.put(3, make_item(3))
+    assert len(cache) == 3 and cache.get(1) is None
+    assert all(t.equal(a, b) for a, b in zip(cache.get(0), make_item(0)))
+
+
+def test_slot_sample_caches(tmp_path):
+    for backend in ["shared", "mmap"]:
+        cache = make_sample_cache(backend, FIELDS, length=10, max_bytes=4 * (6 + 8), path=str(tmp_path))
+        assert cache.n_slots == 4
+        for index in range(6):
+            cache.put(index, make_item(index))
+        # 4 and 5 evicted 0 and 1
+        assert cache.get(0) is None and cache.get(1) is None
+        for index in range(2, 6):
+            assert all(t.equal(a, b) for a, b in zip(cache.get(index), make_item(index)))
+        if backend == "mmap":
+            reopened = pickle.loads(pickle.dumps(cache))
+            assert reopened.get(5) is not None
+            again = make_sample_cache(backend, FIELDS, length=10, max_bytes=4 * (6 + 8), path=str(tmp_path))
+            assert len(again) == 4
+        with pytest.raises(ValueError):
+            make_sample_cache(backend, FIELDS, length=10, path=str(tmp_path))
+
+
+def test_pvr_dataset_cache_is_shared_by_workers(tmp_path):
+    base = make_random_mnist()
+    for backend in ["shared", "mmap"]:
+        dataset = ImagePVRDataset(
+            base, length=16, cache_backend=backend, cache_max_bytes=2**20, cache_dir=str(tmp_path)
+        )
+        uncached = ImagePVRDataset(base, length=16, use_cache=False)
+        loader = DataLoader(dataset, batch_size=4, num_workers=2, collate_fn=lambda batch: batch)
+        assert sum(len(batch) for batch in loader) == 16
+        assert len(dataset.cache) == 16
+        for index in range(16):
+            for cached, value in zip(dataset[index], uncached[index]):
+                assert t.equal(cached, value)
+    reloaded = ImagePVRDataset(
+        base, length=16, cache_backend="mmap", cache_max_bytes=2**20, cache_dir=str(tmp_path)
+    )
+    assert len(reloaded.cache) == 16
@@ -1,5 +1,9 @@
 from iit.tasks.ioi.ioi_dataset_tl import IOIDatasetWrapper
 import transformer_lens as tl
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import PreTrainedTokenizerFast
 from iit.tasks.ioi.ioi_config import NAMES, PLACES, OBJECTS
 from iit.tasks.ioi.ioi_config import ALL_TEMPLATES
 
@@ -10,4 +14,13 @@ def make_ioi_test_dataset(num_samples=1000) -> IOIDatasetWrapper:
     dataset = IOIDatasetWrapper(
         tokenizer=tokenizer, templates=ALL_TEMPLATES, names=NAMES, nouns=NOUNS_DICT, num_samples=num_samples
     )
-    return dataset
\ No newline at end of file
+    return dataset
+
+def make_word_level_tokenizer(words: list[str]) -> PreTrainedTokenizerFast:
+    """Offline whitespace tokenizer, enough for IOI templates over the given words."""
+    vocab = {word: i for i, word in enumerate(["<bos>", "<pad>", "<unk>", ".", ","] + sorted(set(words)))}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<bos>", pad_token="<pad>", unk_token="<unk>"
+    )
@@ -21,6 +21,7 @@ if __name__ == "__main__":
     parser.add_argument("--save-to-wandb", action="store_true")
     parser.add_argument("--output-dir", type=str, default="./results")
     parser.add_argument("--include-mlp", action="store_true")
+    parser.add_argument("--compact-vocab", action="store_true")
 
     args = parser.parse_args()
     namespace = IOIArgParseNamespace(**vars(args))